@@ -42,6 +42,7 @@ setup(
     extras_require={
         'lzma:python_version<="3.3"': ['backports.lzma'],
         'platform_specific': ["lionshead"],
+        's3': ['boto3'],
     },
     entry_points={
         'console_scripts': [
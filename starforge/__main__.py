@@ -0,0 +1,6 @@
+from __future__ import absolute_import
+
+from .cli import starforge
+
+
+starforge()
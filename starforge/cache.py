@@ -2,29 +2,109 @@
 """
 from __future__ import absolute_import
 
+import errno
+import hashlib
+import json
+import re
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
-from os import makedirs, listdir
-from os.path import exists, join, basename
+from os import chmod, fdopen, getpid, lstat, makedirs, listdir, rename, stat, unlink, walk
+from os.path import exists, getsize, isdir, join, basename, dirname, relpath
+from shutil import rmtree
 from abc import ABCMeta, abstractmethod
 try:
-    from urllib.parse import urlparse
+    from collections import OrderedDict
 except ImportError:
-    from urlparse import urlparse
+    from ordereddict import OrderedDict
+try:
+    from urllib.parse import urljoin, urlparse
+except ImportError:
+    from urlparse import urljoin, urlparse
 
 import requests
+
 import yaml
 from pkg_resources import parse_version
-from six import with_metaclass
+from six import iteritems, text_type, with_metaclass
 
+from .download import CHUNK_SIZE, Downloader
 from .io import warn, info, debug, fatal
+from .packaging.setup import PythonSdist, setup_info_key
+from .remote import remote_cache
 from .util import (
+    Archive,
+    clone_or_copy,
+    link_or_copy,
     pip_install,
     py_to_pip,
     stringify_cmd
 )
 
+# seconds to wait for another process holding the cache database lock
+DB_LOCK_TIMEOUT = 300
+DEFAULT_VERIFY_JOBS = 4
+# partial and temporary download files older than this (in seconds) are removed by `CacheManager.prune`
+STALE_PARTIAL_AGE = 24 * 60 * 60
+PYPI_JSON_URL = 'https://pypi.org/pypi/{name}/{version}/json'
+PYPI_SIMPLE_URL = 'https://pypi.org/simple/'
+SIMPLE_INDEX_LINK_RE = re.compile(r'<a\s[^>]*href="([^"]+)"[^>]*>([^<]+)</a>', re.I)
+TARBALL_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.zip')
+
+
+def _tmp_name(path):
+    """ Return a temporary name for `path` that is unique to this thread, for files that are placed by renaming.
+    """
+    return '%s.%s.%s.tmp' % (path, getpid(), threading.current_thread().ident)
+
+
+def normalize_name(name):
+    """ Normalize a project name per PEP 503
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def normalize_version(version):
+    """ Normalize a version such that versions which compare equal with `parse_version` are identical strings
+    """
+    with warnings.catch_warnings():
+        # silence setuptools' legacy version deprecation warnings
+        warnings.simplefilter('ignore')
+        version = str(parse_version(version))
+    # trailing zeros are insignificant, '1.0' == '1.0.0'
+    return re.sub(r'^((?:\d+!)?\d+?(?:\.\d+)*?)(?:\.0+)+(?=$|\+|\.?[a-z])', r'\1', version)
+
+
+def parse_tarball_name(cfile):
+    """ Return all (normalized name, normalized version) pairs that the sdist filename `cfile` could represent.
+
+    Since both names and versions can contain '-', every split point that yields a valid version is returned. Returns
+    None if `cfile` does not have a known sdist extension.
+    """
+    for ext in TARBALL_EXTENSIONS:
+        if cfile.lower().endswith(ext):
+            stem = cfile[:-len(ext)]
+            break
+    else:
+        return None
+    keys = []
+    for match in re.finditer('-', stem):
+        name, version = stem[:match.start()], stem[match.end():]
+        try:
+            keys.append((normalize_name(name), normalize_version(version)))
+        except ValueError:
+            # InvalidVersion on newer setuptools
+            continue
+    return keys
+
 
 class BaseCacher(with_metaclass(ABCMeta, object)):
     def __init__(self, cache_path):
@@ -46,59 +126,559 @@ class BaseCacher(with_metaclass(ABCMeta, object)):
         """
 
 
+class TarballIndex(object):
+    """ On-disk index of the tarball cache, keyed by normalized name and version.
+
+    The index records the mtime of the tarball directory it was built from. If the directory has changed since (e.g.
+    another process or `pip download` added a file), only the added and removed files are (re)parsed.
+
+    The index is shared by the threads fetching sources concurrently, so all access to it is locked.
+    """
+    index_file = '__tarball_index.json'
+
+    def __init__(self, cache_path, tarball_path):
+        self.index_file = join(cache_path, TarballIndex.index_file)
+        self.tarball_path = tarball_path
+        self.mtime = None
+        self.files = {}
+        self.entries = {}
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file) as handle:
+                index = json.load(handle)
+            self.mtime = index['mtime']
+            self.files = index['files']
+        except (OSError, IOError, ValueError, KeyError) as exc:
+            debug('Tarball index unreadable, will rebuild: %s', exc)
+            self.mtime = None
+            self.files = {}
+        self.entries = {}
+        for cfile, keys in iteritems(self.files):
+            self._add_entries(cfile, keys)
+
+    def save(self):
+        with self.lock:
+            tmp = None
+            try:
+                fd, tmp = tempfile.mkstemp(dir=dirname(self.index_file), prefix=basename(self.index_file),
+                                           suffix='.tmp')
+                with fdopen(fd, 'w') as handle:
+                    json.dump({'mtime': self.mtime, 'files': self.files}, handle)
+                rename(tmp, self.index_file)
+            except (OSError, IOError) as exc:
+                # e.g. the cache is shared read-only with a build guest
+                debug('Unable to write tarball index: %s', exc)
+            finally:
+                if tmp is not None and exists(tmp):
+                    unlink(tmp)
+
+    def refresh(self):
+        """ Bring the index up to date with the directory if its mtime has changed.
+        """
+        with self.lock:
+            # stat before listing so that a file added during the scan leaves the index stale rather than wrong
+            mtime = stat(self.tarball_path).st_mtime
+            if mtime == self.mtime:
+                return
+            current = set(listdir(self.tarball_path))
+            for cfile in set(self.files) - current:
+                self._remove_entries(cfile)
+                del self.files[cfile]
+            for cfile in current - set(self.files):
+                self.add(cfile, save=False)
+            self.mtime = mtime
+            self.save()
+
+    def add(self, cfile, save=True):
+        keys = parse_tarball_name(cfile)
+        if keys is None:
+            warn('Unknown extension on cached file: %s', cfile)
+        with self.lock:
+            self.files[cfile] = keys or []
+            self._add_entries(cfile, self.files[cfile])
+            if save:
+                # the mtime is only advanced by refresh(), after a full listing, since other processes may have added
+                # files to the directory since it was last listed
+                self.save()
+
+    def lookup(self, name, version):
+        self.refresh()
+        try:
+            key = (normalize_name(name), normalize_version(version))
+        except ValueError:
+            return None
+        with self.lock:
+            cfile = self.entries.get(key)
+        if cfile is not None:
+            return join(self.tarball_path, cfile)
+        return None
+
+    def _add_entries(self, cfile, keys):
+        for name, version in keys:
+            self.entries[(name, version)] = cfile
+
+    def _remove_entries(self, cfile):
+        for name, version in self.files[cfile] or []:
+            if self.entries.get((name, version)) == cfile:
+                del self.entries[(name, version)]
+
+
 class TarballCacher(BaseCacher):
-    def __init__(self, cache_path):
-        cache_path = join(cache_path, 'tarballs')
-        super(TarballCacher, self).__init__(cache_path)
+    def __init__(self, cache_path, blobs=None):
+        tarball_path = join(cache_path, 'tarballs')
+        super(TarballCacher, self).__init__(tarball_path)
+        self.index = TarballIndex(cache_path, tarball_path)
+        self.blobs = blobs or BlobStore(cache_path)
 
     def check(self, name, version=None):
         if version is None:
             cfpath = self.abspath(name)
             if exists(cfpath):
                 return cfpath
-        else:
-            name = name.lower()
-            for cfile in listdir(self.cache_path):
-                if cfile.lower().startswith(name + '-'):
-                    cver = cfile[len(name + '-'):]
-                    if cver.endswith('.tar.gz'):
-                        ext = len('.tar.gz')
-                    elif cver.endswith('.tgz'):
-                        ext = len('.tgz')
-                    elif cver.endswith('.tar.bz2'):
-                        ext = len('.tar.bz2')
-                    elif cver.endswith('.zip'):
-                        ext = len('.zip')
-                    else:
-                        warn('Unknown extension on cached file: %s', cfile)
-                        continue
-                    cver = cver[:-ext]
-                    if parse_version(cver) == parse_version(version):
-                        return self.abspath(cfile)
-        return None
+            return None
+        return self.index.lookup(name, version)
 
 
-class PlatformStringCacher(BaseCacher):
-    cache_file = '__platform_cache.yml'
+class CacheDatabase(object):
+    """ SQLite database for cache metadata that must be shared safely between concurrent Starforge processes.
+    """
+    db_file = '__cache.sqlite'
+    schema = (
+        """CREATE TABLE IF NOT EXISTS probes (
+               kind TEXT NOT NULL,
+               name TEXT NOT NULL,
+               value TEXT NOT NULL,
+               updated REAL NOT NULL,
+               PRIMARY KEY (kind, name))""",
+        """CREATE TABLE IF NOT EXISTS blobs (
+               digest TEXT PRIMARY KEY,
+               size INTEGER NOT NULL,
+               atime REAL NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS manifest (
+               path TEXT PRIMARY KEY,
+               source TEXT NOT NULL,
+               digest TEXT NOT NULL REFERENCES blobs (digest))""",
+        """CREATE TABLE IF NOT EXISTS builds (
+               key TEXT NOT NULL,
+               filename TEXT NOT NULL,
+               digest TEXT NOT NULL REFERENCES blobs (digest),
+               PRIMARY KEY (key, filename))""",
+        """CREATE TABLE IF NOT EXISTS metrics (
+               kind TEXT NOT NULL,
+               counter TEXT NOT NULL,
+               value REAL NOT NULL,
+               PRIMARY KEY (kind, counter))""",
+    )
 
     def __init__(self, cache_path):
-        super(PlatformStringCacher, self).__init__(cache_path)
-        self.cache_file = join(cache_path, PlatformStringCacher.cache_file)
-        if not exists(self.cache_file):
-            with open(self.cache_file, 'w') as handle:
-                handle.write(yaml.dump({}))
+        self.cache_path = cache_path
+        self.db_file = join(cache_path, CacheDatabase.db_file)
+        self.readonly = False
+        # autocommit mode, transactions are explicit
+        self.conn = sqlite3.connect(self.db_file, timeout=DB_LOCK_TIMEOUT, isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.RLock()
+        try:
+            with self.transaction() as cursor:
+                for statement in CacheDatabase.schema:
+                    cursor.execute(statement)
+        except sqlite3.OperationalError as exc:
+            # e.g. the cache is shared read-only with a build guest
+            debug('Cache database is read-only: %s', exc)
+            self.readonly = True
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            else:
+                cursor.execute('COMMIT')
+
+    def execute(self, query, args=()):
+        with self.lock:
+            return self.conn.execute(query, args).fetchall()
+
+
+class CacheMetrics(object):
+    """ Counters of cache hits, misses, bytes fetched, and time spent fetching and probing, per cacher kind.
+
+    Counters are collected in memory for the lifetime of a `CacheManager` and added to the running totals in the cache
+    database by `save`.
+    """
+    counters = (
+        'hits',
+        'misses',
+        'bytes_fetched',
+        'fetch_seconds',
+        'lookup_seconds',
+        'probe_seconds',
+        'probe_start_seconds',
+    )
+
+    def __init__(self):
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, kind, counter, value=1):
+        with self.lock:
+            counters = self.values.setdefault(kind, OrderedDict((c, 0) for c in CacheMetrics.counters))
+            counters[counter] += value
+
+    def result(self, kind, hit):
+        self.add(kind, 'hits' if hit else 'misses')
+
+    @contextmanager
+    def timer(self, kind, counter):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(kind, counter, time.time() - start)
+
+    def dump(self):
+        with self.lock:
+            return OrderedDict((kind, OrderedDict(counters)) for kind, counters in self.values.items())
+
+    def save(self, db):
+        """ Add the counters to the totals in `db` and reset them.
+        """
+        if db.readonly:
+            return
+        with self.lock:
+            with db.transaction() as cursor:
+                for kind, counters in self.values.items():
+                    for counter, value in counters.items():
+                        cursor.execute('INSERT OR IGNORE INTO metrics (kind, counter, value) VALUES (?, ?, 0)',
+                                       (kind, counter))
+                        cursor.execute('UPDATE metrics SET value = value + ? WHERE kind = ? AND counter = ?',
+                                       (value, kind, counter))
+            self.values.clear()
+
+    @staticmethod
+    def totals(db):
+        totals = OrderedDict()
+        for kind, counter, value in db.execute('SELECT kind, counter, value FROM metrics ORDER BY kind'):
+            if not counter.endswith('_seconds'):
+                value = int(value)
+            totals.setdefault(kind, OrderedDict((c, 0) for c in CacheMetrics.counters))[counter] = value
+        return totals
+
+
+class DigestMismatch(Exception):
+    pass
+
+
+class BlobStore(object):
+    """ Content-addressed (sha256) store for cached source files.
+
+    Blobs live under `blobs/sha256/`. Files handed out by the cachers (in `tarballs/`, `urls/`) are hardlinks (or
+    reflinks, where hardlinking is not possible) to blobs, so identical files are only stored once. The manifest maps
+    those paths, relative to the cache directory, to the source they were fetched from and their digest, so that a file
+    is only ever hashed once, as it is fetched.
+    """
+    def __init__(self, cache_path, db=None):
+        self.cache_path = cache_path
+        self.blob_path = join(cache_path, 'blobs', 'sha256')
+        self.tmp_path = join(cache_path, 'blobs', 'tmp')
+        if db is None:
+            db = CacheDatabase(cache_path)
+        self.db = db
+
+    def path(self, digest):
+        return join(self.blob_path, digest[:2], digest)
+
+    def relpath(self, path):
+        return relpath(path, self.cache_path)
+
+    def digest(self, path):
+        """ Return the recorded digest of the cached file at `path`, or None if it is not in the manifest.
+        """
+        rows = self.db.execute('SELECT digest FROM manifest WHERE path = ?', (self.relpath(path),))
+        return rows[0][0] if rows else None
+
+    def ingest(self, chunks, sha256=None):
+        """ Store the data in iterable `chunks`, hashing it as it is written, and return its digest.
+
+        If `sha256` is set, the data must match it or DigestMismatch is raised and nothing is stored.
+        """
+        if not exists(self.tmp_path):
+            makedirs(self.tmp_path)
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_path)
+        try:
+            sha = hashlib.sha256()
+            size = 0
+            with fdopen(fd, 'wb') as handle:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    handle.write(chunk)
+                    size += len(chunk)
+            digest = sha.hexdigest()
+            self.add(tmp, digest, size, sha256=sha256)
+        finally:
+            if exists(tmp):
+                unlink(tmp)
+        return digest
+
+    def add(self, tmp, digest, size, sha256=None):
+        """ Move the already hashed file `tmp` into the store.
+        """
+        if sha256 is not None and digest != sha256.lower():
+            raise DigestMismatch('Expected sha256 %s but got %s' % (sha256, digest))
+        blob = self.path(digest)
+        if exists(blob):
+            debug('Blob already stored: %s', digest)
+            unlink(tmp)
+        else:
+            if not exists(dirname(blob)):
+                makedirs(dirname(blob))
+            chmod(tmp, 0o444)
+            rename(tmp, blob)
+        with self.db.transaction() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO blobs (digest, size, atime) VALUES (?, ?, ?)',
+                           (digest, size, time.time()))
+            cursor.execute('UPDATE blobs SET atime = ? WHERE digest = ?', (time.time(), digest))
+        return digest
+
+    def ingest_file(self, path, source, sha256=None):
+        """ Move the existing file at `path` into the store and replace it with a link to its blob.
+        """
+        with open(path, 'rb') as handle:
+            digest = self.ingest(iter(partial(handle.read, CHUNK_SIZE), b''), sha256=sha256)
+        self.checkout(digest, path, source)
+        return digest
+
+    def checkout(self, digest, path, source):
+        """ Place the blob `digest` at `path` (atomically replacing anything already there) and record it in the manifest.
+        """
+        if not exists(dirname(path)):
+            makedirs(dirname(path))
+        tmp = _tmp_name(path)
+        link_or_copy(self.path(digest), tmp)
+        rename(tmp, path)
+        with self.db.transaction() as cursor:
+            cursor.execute('INSERT OR REPLACE INTO manifest (path, source, digest) VALUES (?, ?, ?)',
+                           (self.relpath(path), source, digest))
+        return path
+
+    def touch_digest(self, digest):
+        if self.db.readonly:
+            return
+        with self.db.transaction() as cursor:
+            cursor.execute('UPDATE blobs SET atime = ? WHERE digest = ?', (time.time(), digest))
+
+    def touch(self, path):
+        """ Record an access of the cached file at `path`, for LRU eviction.
+        """
+        if self.db.readonly or path is None:
+            return
+        with self.db.transaction() as cursor:
+            cursor.execute('UPDATE blobs SET atime = ? WHERE digest = (SELECT digest FROM manifest WHERE path = ?)',
+                           (time.time(), self.relpath(path)))
+
+    def adopt(self, directory, source='adopted'):
+        """ Ingest any files under `directory` that are not in the manifest (e.g. cached by older versions of Starforge)
+        """
+        known = set(row[0] for row in self.db.execute('SELECT path FROM manifest'))
+        adopted = 0
+        for root, dirs, files in walk(directory):
+            for name in files:
+                path = join(root, name)
+                if self.relpath(path) not in known and not name.endswith('.tmp'):
+                    debug('Adopting unmanaged cache file: %s', path)
+                    self.ingest_file(path, source)
+                    adopted += 1
+        return adopted
+
+    def blobs(self):
+        """ Return a list of (digest, size, atime) for all blobs, least recently used first
+        """
+        return self.db.execute('SELECT digest, size, atime FROM blobs ORDER BY atime')
+
+    def paths(self, digest):
+        return [join(self.cache_path, row[0])
+                for row in self.db.execute('SELECT path FROM manifest WHERE digest = ?', (digest,))]
+
+    def remove(self, digest):
+        """ Remove a blob and every cached file linked to it.
+        """
+        paths = self.paths(digest)
+        with self.db.transaction() as cursor:
+            cursor.execute('DELETE FROM manifest WHERE digest = ?', (digest,))
+            cursor.execute('DELETE FROM builds WHERE digest = ?', (digest,))
+            cursor.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+        for path in paths + [self.path(digest)]:
+            try:
+                unlink(path)
+            except OSError as exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+        return paths
+
+    def verify(self, jobs=DEFAULT_VERIFY_JOBS):
+        """ Hash all blobs in a pool of `jobs` threads, returning a list of digests whose blob is missing or corrupt.
+        """
+        def check(digest):
+            try:
+                with open(self.path(digest), 'rb') as handle:
+                    sha = hashlib.sha256()
+                    for chunk in iter(partial(handle.read, CHUNK_SIZE), b''):
+                        sha.update(chunk)
+            except (OSError, IOError) as exc:
+                warn('Unable to read blob %s: %s', digest, exc)
+                return False
+            return sha.hexdigest() == digest
+        digests = [row[0] for row in self.blobs()]
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(check, digests)
+        finally:
+            pool.close()
+            pool.join()
+        return [digest for digest, ok in zip(digests, results) if not ok]
+
+
+class ProbeStore(object):
+    """ Results of probing images (platform strings, Python versions), memoized in-process.
+
+    Values are loaded from the database once per kind, after which lookups never leave memory. New values are inserted
+    with INSERT OR IGNORE so that when concurrent runs probe the same image, all of them agree on the first result.
+
+    If the database is read-only (e.g. in a build guest), new values are kept in memory and can be exported to be
+    imported by a process that can write to the database.
+
+    The `updated` time of a value is when it was last used (at most once per process), so that `prune()` forgets
+    values that are no longer used, like the blob store evicts blobs by access time.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.memo = {}
+        self.unsaved = []
+        self.touched = set()
+
+    def _load(self, kind):
+        # the database lock also keeps concurrent builds (threads) from replacing a memo that another is updating
+        with self.db.lock:
+            if kind not in self.memo:
+                rows = self.db.execute('SELECT name, value FROM probes WHERE kind = ?', (kind,))
+                self.memo[kind] = dict(rows)
+            return self.memo[kind]
+
+    def get(self, kind, name):
+        value = self._load(kind).get(name, None)
+        if value is not None:
+            self._touch(kind, name)
+        return value
+
+    def _touch(self, kind, name):
+        if self.db.readonly or (kind, name) in self.touched:
+            return
+        self.touched.add((kind, name))
+        with self.db.transaction() as cursor:
+            cursor.execute('UPDATE probes SET updated = ? WHERE kind = ? AND name = ?', (time.time(), kind, name))
+
+    def set(self, kind, name, value):
+        values = self._load(kind)
+        if self.db.readonly:
+            values[name] = value
+            self.unsaved.append((kind, name, value))
+            return value
+        with self.db.transaction() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO probes (kind, name, value, updated) VALUES (?, ?, ?, ?)',
+                           (kind, name, value, time.time()))
+            cursor.execute('SELECT value FROM probes WHERE kind = ? AND name = ?', (kind, name))
+            values[name] = cursor.fetchone()[0]
+        return values[name]
+
+    def prune(self, older_than):
+        """ Forget probe results last used before the timestamp `older_than`
+        """
+        with self.db.transaction() as cursor:
+            cursor.execute('DELETE FROM probes WHERE updated < ?', (older_than,))
+            pruned = cursor.rowcount
+        self.memo = {}
+        return pruned
+
+    def export_json(self, path):
+        """ Write the values that could not be stored in the read-only database to `path`, if there are any. Returns
+        the number of values written.
+        """
+        if self.unsaved:
+            with open(path, 'w') as handle:
+                json.dump(self.unsaved, handle)
+        return len(self.unsaved)
+
+    def import_json(self, path):
+        """ Import values written by `export_json()`.
+        """
+        with open(path) as handle:
+            values = json.load(handle)
+        for kind, name, value in values:
+            self.set(kind, name, value)
+        return len(values)
+
+    def import_yaml(self, kind, path):
+        """ Import probe results from the YAML cache files used by older versions of Starforge.
+        """
+        if self.db.readonly or not exists(path):
+            return
+        try:
+            with open(path) as handle:
+                values = yaml.safe_load(handle) or {}
+        except (OSError, IOError, yaml.YAMLError) as exc:
+            warn('Unable to import legacy probe cache %s: %s', path, exc)
+            return
+        for name, value in iteritems(values):
+            if isinstance(value, bytes):
+                value = value.decode('utf-8')
+            self.set(kind, name, text_type(value))
+        try:
+            rename(path, path + '.imported')
+        except OSError as exc:
+            debug('Unable to rename imported legacy probe cache %s: %s', path, exc)
+
+
+class ProbeCacher(BaseCacher):
+    kind = None
+    legacy_cache_file = None
+
+    def __init__(self, cache_path, store=None):
+        super(ProbeCacher, self).__init__(cache_path)
+        if store is None:
+            store = ProbeStore(CacheDatabase(cache_path))
+        self.store = store
+        if self.legacy_cache_file is not None:
+            self.store.import_yaml(self.kind, join(cache_path, self.legacy_cache_file))
 
     def check(self, name, **kwargs):
-        platforms = yaml.safe_load(open(self.cache_file).read())
-        return platforms.get(name, None)
+        return self.store.get(self.kind, name)
+
+    def _run(self, run, cmd):
+        output = run(cmd, capture_output=True)
+        if isinstance(output, bytes):
+            output = output.decode('utf-8')
+        return output.splitlines()[0].strip()
+
+
+class PlatformStringCacher(ProbeCacher):
+    kind = 'platform'
+    legacy_cache_file = '__platform_cache.yml'
 
     def cache(self, name, execctx=None, buildpy='python', plat_specific=False, **kwargs):
-        platforms = yaml.safe_load(open(self.cache_file).read())
-        if name not in platforms:
+        platform = self.check(name)
+        if platform is None:
             with execctx() as run:
                 # ugly...
                 cmd = "python -c 'import os; print os.uname()[4]'"
-                arch = run(cmd, capture_output=True).splitlines()[0].strip()
+                arch = self._run(run, cmd)
                 if plat_specific:
                     cmd = ("{buildpy} -c 'import starforge.interface.wheel; "
                            "print starforge.interface.wheel.get_platforms"
@@ -108,140 +688,810 @@ class PlatformStringCacher(BaseCacher):
                            "print wheel.pep425tags.get_platforms"
                            "(major_only=True)[0]'".format(buildpy=buildpy))
                 cmd = cmd.format(arch=arch)
-                platform = run(
-                    cmd,
-                    capture_output=True
-                ).splitlines()[0].strip()
-            platforms[name] = platform
-            with open(self.cache_file, 'w') as handle:
-                handle.write(yaml.dump(platforms))
-        return platforms[name]
+                platform = self._run(run, cmd)
+            platform = self.store.set(self.kind, name, platform)
+        return platform
 
 
-class PythonVersionCacher(BaseCacher):
-    cache_file = '__pyvers_cache.yml'
+class PythonVersionCacher(ProbeCacher):
+    kind = 'pyversion'
+    legacy_cache_file = '__pyvers_cache.yml'
 
-    def __init__(self, cache_path):
-        super(PythonVersionCacher, self).__init__(cache_path)
-        self.cache_file = join(cache_path, PythonVersionCacher.cache_file)
-        if not exists(self.cache_file):
-            with open(self.cache_file, 'w') as handle:
-                handle.write(yaml.dump({}))
+    def cache(self, name, execctx=None, buildpy='python', **kwargs):
+        vers = self.check(name)
+        if vers is None:
+            with execctx() as run:
+                cmd = "{buildpy} -c 'import sys; print(sys.version_info[0])'".format(buildpy=buildpy)
+                vers = 'py%d' % int(self._run(run, cmd))
+            vers = self.store.set(self.kind, name, vers)
+        return vers
+
+
+class ImageManifestCacher(ProbeCacher):
+    """ Metadata of an image needed to compute the names of the wheels built on it (architecture, platform tag, and
+    the version and ABI of each Python), probed in a single run of the image.
+
+    Probing also records the image's platform and Python version results, so that the other probes of the image are
+    cache hits.
+    """
+    kind = 'manifest'
+    # the arch is probed first, since it is needed to format the paths of the pythons (e.g. `/python/cp27m-{arch}/...`)
+    ARCH_PROBE = 'uname -m'
+    # print() with a single argument works on Python 2 and 3
+    PLATFORM_PROBE = ("{python} -c 'import {module} as m; "
+                      "print(m.get_platforms(major_only=True)[0])'")
+    PYTHON_PROBE = ("{python} -c 'import json, platform, sys, sysconfig; "
+                    "print(json.dumps({{\"version\": platform.python_version(), \"major\": sys.version_info[0], "
+                    "\"soabi\": sysconfig.get_config_var(\"SOABI\"), \"maxunicode\": sys.maxunicode}}))'")
 
     def check(self, name, **kwargs):
-        versions = yaml.safe_load(open(self.cache_file).read())
-        return versions.get(name, None)
+        manifest = super(ImageManifestCacher, self).check(name)
+        return json.loads(manifest) if manifest is not None else None
 
-    def cache(self, name, execctx=None, buildpy='python', **kwargs):
-        versions = yaml.safe_load(open(self.cache_file).read())
-        if name not in versions:
+    def cache(self, name, execctx=None, pythons=None, plat_specific=False, **kwargs):
+        manifest = self.check(name)
+        if manifest is None:
+            module = 'starforge.interface.wheel' if plat_specific else 'wheel.pep425tags'
             with execctx() as run:
-                cmd = "{buildpy} -c 'import sys; print(sys.version_info[0])'".format(buildpy=buildpy)
-                vers = run(cmd, capture_output=True).splitlines()[0].strip()
-                vers = 'py%d' % int(vers)
-            versions[name] = vers
-            with open(self.cache_file, 'w') as handle:
-                handle.write(yaml.dump(versions))
-        return versions[name]
+                arch = self._run(run, self.ARCH_PROBE)
+                manifest = OrderedDict([('arch', arch)])
+                probe = self.PLATFORM_PROBE.format(python=pythons[0].format(arch=arch), module=module)
+                manifest['platform'] = self._run(run, probe)
+                manifest['pythons'] = OrderedDict()
+                for python in pythons:
+                    probe = self.PYTHON_PROBE.format(python=python.format(arch=arch))
+                    manifest['pythons'][python] = json.loads(self._run(run, probe))
+            manifest['plat_specific'] = plat_specific
+            self.store.set(PlatformStringCacher.kind, name, manifest['platform'])
+            self.store.set(PythonVersionCacher.kind, name, 'py%d' % manifest['pythons'][pythons[0]]['major'])
+            manifest = json.loads(self.store.set(self.kind, name, json.dumps(manifest)))
+        return manifest
 
 
 class UrlCacher(TarballCacher):
+    """ Cache sources fetched from URLs.
+
+    Files are placed at `urls/<url hash>/<basename>`, so that sources from different URLs with the same basename do not
+    collide.
+    """
+    def __init__(self, cache_path, blobs=None, downloader=None):
+        super(UrlCacher, self).__init__(cache_path, blobs=blobs)
+        self.url_path = join(cache_path, 'urls')
+        self.downloader = downloader or Downloader(join(cache_path, 'blobs', 'partial'))
+
+    def url_abspath(self, name):
+        url_hash = hashlib.sha256(name.encode('utf-8')).hexdigest()[:16]
+        return join(self.url_path, url_hash, basename(urlparse(name).path))
+
     def check(self, name, **kwargs):
-        tgz = basename(urlparse(name).path)
-        return super(UrlCacher, self).check(tgz)
+        cfpath = self.url_abspath(name)
+        if exists(cfpath):
+            return cfpath
+        # sources cached by older versions of Starforge
+        return super(UrlCacher, self).check(basename(urlparse(name).path))
 
-    def cache(self, name, **kwargs):
-        cfpath = self.check(name)
-        tgz = basename(urlparse(name).path)
-        if cfpath is not None:
-            info('Using cached file: %s', cfpath)
-        else:
-            cfpath = self.abspath(tgz)
-            r = requests.get(name)
-            with open(cfpath, 'wb') as handle:
-                for chunk in r.iter_content(chunk_size=1024):
-                    handle.write(chunk)
+    def _check_cached(self, name, sha256=None):
+        cfpath = self.url_abspath(name)
+        if exists(cfpath):
+            digest = self.blobs.digest(cfpath)
+            if sha256 is None or digest == sha256.lower():
+                info('Using cached file: %s', cfpath)
+                return cfpath
+            warn('Cached file %s has sha256 %s, expected %s, refetching', cfpath, digest, sha256)
+        legacy = super(UrlCacher, self).check(basename(urlparse(name).path))
+        if legacy is not None:
+            info('Importing cached file: %s', legacy)
+            try:
+                with open(legacy, 'rb') as handle:
+                    digest = self.blobs.ingest(iter(partial(handle.read, CHUNK_SIZE), b''), sha256=sha256)
+                return self.blobs.checkout(digest, cfpath, name)
+            except DigestMismatch as exc:
+                warn('Ignoring cached file %s: %s', legacy, exc)
+        return None
+
+    def _fetch(self, name, sha256=None):
+        def complete(result):
+            self.blobs.add(result.path, result.digest, result.size, sha256=sha256)
+            self.blobs.checkout(result.digest, cfpath, name)
+        cfpath = self.url_abspath(name)
+        info('Fetching: %s', name)
+        self.downloader.fetch(name, complete=complete,
+                              cached=lambda: self._check_cached(name, sha256=sha256) is not None)
         return cfpath
 
+    def cache(self, name, sha256=None, **kwargs):
+        return self._check_cached(name, sha256=sha256) or self._fetch(name, sha256=sha256)
+
+    def cache_many(self, names, digests=None):
+        """ Cache all of the URLs in `names`, fetching those that are not already cached concurrently.
+
+        `digests` is an optional dict of URL to sha256 pin. Returns the cached paths in the same order as `names`.
+        """
+        digests = digests or {}
+        cached = dict((name, self._check_cached(name, sha256=digests.get(name))) for name in names)
+        missing = [name for name in OrderedDict.fromkeys(names) if cached[name] is None]
+        fetched = self.downloader.map(lambda name: self._fetch(name, sha256=digests.get(name)), missing)
+        cached.update(zip(missing, fetched))
+        return [cached[name] for name in names]
+
 
 class PipSourceCacher(TarballCacher):
-    def cache(self, name, version=None, fail_ok=False, **kwargs):
+    """ Cache sdists from PyPI.
+
+    sdist URLs are resolved with the PyPI JSON API (falling back to the PEP 503 simple index) and fetched directly with
+    the shared `Downloader`. `pip download` is only used if that fails, e.g. for packages not on the index.
+    """
+    def __init__(self, cache_path, blobs=None, downloader=None, json_url=PYPI_JSON_URL, simple_url=PYPI_SIMPLE_URL):
+        super(PipSourceCacher, self).__init__(cache_path, blobs=blobs)
+        self.downloader = downloader or Downloader(join(cache_path, 'blobs', 'partial'))
+        self.json_url = json_url
+        self.simple_url = simple_url
+
+    def resolve(self, name, version):
+        """ Return (url, filename, sha256) of the sdist for `name` `version`, or None if it cannot be found.
+        """
+        url = self.json_url.format(name=name, version=version)
+        r = self.downloader.session(url).get(url, timeout=self.downloader.timeout)
+        if r.status_code == 200:
+            for release_file in r.json().get('urls', []):
+                if release_file['packagetype'] == 'sdist' and parse_tarball_name(release_file['filename']):
+                    return (release_file['url'], release_file['filename'],
+                            release_file.get('digests', {}).get('sha256'))
+        debug("sdist for %s %s not found via JSON API (status %s), trying simple index", name, version, r.status_code)
+        key = (normalize_name(name), normalize_version(version))
+        url = self.simple_url.rstrip('/') + '/' + normalize_name(name) + '/'
+        r = self.downloader.session(url).get(url, timeout=self.downloader.timeout)
+        if r.status_code != 200:
+            return None
+        for href, filename in SIMPLE_INDEX_LINK_RE.findall(r.text):
+            if key in (parse_tarball_name(filename) or []):
+                href, _, fragment = urljoin(r.url, href).partition('#')
+                sha256 = fragment[len('sha256='):] if fragment.startswith('sha256=') else None
+                return (href, filename, sha256)
+        return None
+
+    def fetch(self, name, version):
+        """ Fetch the sdist for `name` `version` without pip, returning its cached path or None if it was not found.
+        """
+        try:
+            resolved = self.resolve(name, version)
+        except (requests.RequestException, ValueError) as exc:
+            warn('Unable to resolve sdist for %s %s: %s', name, version, exc)
+            return None
+        if resolved is None:
+            return None
+        url, filename, sha256 = resolved
+        cfpath = self.abspath(filename)
+
+        def complete(result):
+            self.blobs.add(result.path, result.digest, result.size, sha256=sha256)
+            self.blobs.checkout(result.digest, cfpath, '%s==%s' % (name, version))
+            self.index.add(filename)
+        info('Fetching sdist: %s', url)
+        self.downloader.fetch(url, complete=complete, cached=lambda: exists(cfpath))
+        return cfpath
+
+    def pip_download(self, name, version, setup_requires=None):
+        if setup_requires:
+            # this is done due to pypa/pip#1884 - `pip download` fails under certain circumstances if setup_requires is
+            # set
+            info("Installing packages to Starforge Python at '%s' for '%s' setup requirements: %s",
+                 sys.executable, name, ', '.join(setup_requires))
+            pip_install(pip=py_to_pip(sys.executable), packages=setup_requires)
+        cmd = [
+            'pip', '--no-cache-dir', 'download', '-d', self.cache_path, '--no-binary', ':all:',
+            '--no-deps', name + '==' + version
+        ]
+        info('Fetching sdist with pip: %s', name)
+        debug('Executing: %s', stringify_cmd(cmd))
+        subprocess.check_call(cmd, stdout=sys.stderr)
+        cfpath = self.check(name, version=version)
+        if cfpath is not None:
+            self.blobs.ingest_file(cfpath, '%s==%s' % (name, version))
+        return cfpath
+
+    def cache(self, name, version=None, fail_ok=False, setup_requires=None, **kwargs):
         if version is None:
             fatal('A version must be provided when caching from pip')
         cfpath = self.check(name, version=version)
         if cfpath is not None:
             info('Using cached sdist: %s', cfpath)
-        else:
+            return cfpath
+        cfpath = self.fetch(name, version)
+        if cfpath is None:
             try:
-                cmd = [
-                    'pip', '--no-cache-dir', 'download', '-d', self.cache_path, '--no-binary', ':all:',
-                    '--no-deps', name + '==' + version
-                ]
-                info('Fetching sdist: %s', name)
-                debug('Executing: %s', stringify_cmd(cmd))
-                subprocess.check_call(cmd, stdout=sys.stderr)
-                cfpath = self.check(name, version=version)
+                cfpath = self.pip_download(name, version, setup_requires=setup_requires)
             except subprocess.CalledProcessError:
                 if not fail_ok:
                     raise
         return cfpath
 
+    def cache_many(self, specs):
+        """ Fetch sdists for all (name, version) pairs in `specs` that are not already cached, concurrently.
+
+        Only the native fetch is attempted, packages that cannot be fetched are reported and skipped. Returns a dict of
+        (name, version) to cached path (or None).
+        """
+        def fetch(spec):
+            try:
+                return self.fetch(*spec)
+            except Exception as exc:
+                warn('Failed to fetch sdist for %s %s: %s', spec[0], spec[1], exc)
+                return None
+        cached = OrderedDict((spec, self.check(*spec)) for spec in specs)
+        missing = [spec for spec in cached if cached[spec] is None]
+        info('%d of %d sdists already cached, fetching %d', len(cached) - len(missing), len(cached), len(missing))
+        cached.update(zip(missing, self.downloader.map(fetch, missing)))
+        return cached
+
+
+class BuildCacher(BaseCacher):
+    """ Cache build products (wheels) by a key that identifies everything that went into the build.
+
+    Products are stored in the blob store, the key is typically computed by `ForgeWheel.build_key`.
+    """
+    def __init__(self, cache_path, blobs=None):
+        super(BuildCacher, self).__init__(cache_path)
+        self.blobs = blobs or BlobStore(cache_path)
+
+    def check(self, name, filenames=None, **kwargs):
+        """ Return a dict of filename to blob path of the products of build `name`, or None if any of `filenames` (or
+        of nothing, if `filenames` is not set) were not stored.
+        """
+        rows = self.blobs.db.execute('SELECT filename, digest FROM builds WHERE key = ?', (name,))
+        products = dict((filename, self.blobs.path(digest)) for filename, digest in rows)
+        if not products or any(filename not in products for filename in filenames or []):
+            return None
+        if not all(exists(path) for path in products.values()):
+            return None
+        return products
+
+    def cache(self, name, paths=None, **kwargs):
+        """ Store the files in `paths` as the products of build `name`.
+        """
+        if self.blobs.db.readonly:
+            return None
+        products = {}
+        for path in paths or []:
+            with open(path, 'rb') as handle:
+                products[basename(path)] = self.blobs.ingest(iter(partial(handle.read, CHUNK_SIZE), b''))
+        self.record(name, products)
+        return products
+
+    def record(self, name, products):
+        """ Record the blobs in `products`, a dict of filename to digest, as the products of build `name`.
+        """
+        with self.blobs.db.transaction() as cursor:
+            for filename, digest in products.items():
+                cursor.execute('INSERT OR REPLACE INTO builds (key, filename, digest) VALUES (?, ?, ?)',
+                               (name, filename, digest))
+                debug('Cached build product %s for build %s', filename, name)
+
+    def restore(self, name, filenames, output):
+        """ Place the stored products of build `name` named in `filenames` in directory `output`.
+
+        Returns True if all were restored, False if the build is not (fully) cached.
+        """
+        products = self.check(name, filenames=filenames)
+        if products is None:
+            return False
+        for filename in filenames:
+            dest = join(output, filename)
+            tmp = _tmp_name(dest)
+            # not a hardlink, since wheels may be modified in place afterward (e.g. signed), which must not change the blob
+            method = clone_or_copy(products[filename], tmp)
+            rename(tmp, dest)
+            self.blobs.touch_digest(basename(products[filename]))
+            info('Restored %s from build cache (%s)', filename, method)
+        return True
+
+
+class SourceTreeCacher(BaseCacher):
+    """ Cache extracted source archives, so builds can check out a source tree instead of extracting the archive.
+
+    Trees live at `trees/<archive digest>/`. They are extracted to a temporary directory and renamed into place, so a
+    tree that exists is complete. Trees are never modified after extraction: builds get a checkout (see
+    `util.checkout_tree`).
+    """
+    def __init__(self, cache_path, blobs=None):
+        super(SourceTreeCacher, self).__init__(cache_path)
+        self.blobs = blobs or BlobStore(cache_path)
+        self.tree_path = join(cache_path, 'trees')
+        self.tmp_path = join(self.tree_path, 'tmp')
+
+    def path(self, digest):
+        return join(self.tree_path, digest)
+
+    def check(self, name, **kwargs):
+        """ Return the extracted tree of the cached archive at path `name`, or None if it has not been extracted.
+        """
+        digest = self.blobs.digest(name)
+        if digest is not None and exists(self.path(digest)):
+            return self.path(digest)
+        return None
+
+    def cache(self, name, digest=None, **kwargs):
+        tree = self.check(name)
+        if tree is not None or self.blobs.db.readonly:
+            return tree
+        digest = digest or self.blobs.digest(name)
+        if digest is None:
+            return None
+        if not exists(self.tmp_path):
+            makedirs(self.tmp_path)
+        tmp = tempfile.mkdtemp(dir=self.tmp_path)
+        try:
+            # mkdtemp creates the directory 0700, but trees are read by build guests
+            chmod(tmp, 0o755)
+            info('Extracting source tree: %s', name)
+            Archive.open(name).extractall(tmp)
+            try:
+                rename(tmp, self.path(digest))
+            except OSError as exc:
+                # extracted concurrently by another process
+                if not exists(self.path(digest)):
+                    raise
+                debug('Source tree already extracted: %s', exc)
+        finally:
+            if exists(tmp):
+                rmtree(tmp)
+        return self.path(digest)
+
+    def sizes(self):
+        """ Return a dict of archive digest to the size in bytes of its extracted tree, for all extracted trees.
+        """
+        sizes = {}
+        if not exists(self.tree_path):
+            return sizes
+        for digest in listdir(self.tree_path):
+            if digest == basename(self.tmp_path):
+                continue
+            sizes[digest] = 0
+            for dirpath, dirnames, filenames in walk(self.path(digest)):
+                for name in filenames:
+                    try:
+                        sizes[digest] += lstat(join(dirpath, name)).st_size
+                    except OSError:
+                        pass
+        return sizes
+
+    def remove(self, digest):
+        if exists(self.path(digest)):
+            rmtree(self.path(digest))
+
 
 class CacheManager(object):
-    def __init__(self, cache_path):
+    """ Manage the local cache, and the remote cache described by the `remote_cache` config, if set.
+
+    The local cache is a read-through tier for the remote cache: sources and build products that are not cached
+    locally are fetched from the remote cache, and those fetched from their origin or built are uploaded to it.
+    Failures of the remote cache are reported but never fatal.
+    """
+    def __init__(self, cache_path, remote=None):
         self.cache_path = cache_path
         self.cachers = {}
         self.load_cachers()
+        self.remote = remote_cache(remote)
+        self.metrics = CacheMetrics()
 
     def load_cachers(self):
-        self.cachers['pip'] = PipSourceCacher(self.cache_path)
-        self.cachers['url'] = UrlCacher(self.cache_path)
-        self.cachers['platform'] = PlatformStringCacher(self.cache_path)
-        self.cachers['pyversion'] = PythonVersionCacher(self.cache_path)
+        if not exists(self.cache_path):
+            makedirs(self.cache_path)
+        self.db = CacheDatabase(self.cache_path)
+        self.probe_store = ProbeStore(self.db)
+        self.blobs = BlobStore(self.cache_path, self.db)
+        self.downloader = Downloader(join(self.cache_path, 'blobs', 'partial'))
+        self.cachers['pip'] = PipSourceCacher(self.cache_path, blobs=self.blobs, downloader=self.downloader)
+        self.cachers['url'] = UrlCacher(self.cache_path, blobs=self.blobs, downloader=self.downloader)
+        self.cachers['platform'] = PlatformStringCacher(self.cache_path, store=self.probe_store)
+        self.cachers['pyversion'] = PythonVersionCacher(self.cache_path, store=self.probe_store)
+        self.cachers['manifest'] = ImageManifestCacher(self.cache_path, store=self.probe_store)
+        self.cachers['build'] = BuildCacher(self.cache_path, blobs=self.blobs)
+        self.cachers['tree'] = SourceTreeCacher(self.cache_path, blobs=self.blobs)
 
     def pip_check(self, name, version):
-        return self.cachers['pip'].check(name, version=version)
+        path = self.cachers['pip'].check(name, version=version)
+        self.blobs.touch(path)
+        return path
 
     def url_check(self, name):
-        return self.cachers['url'].check(name)
+        path = self.cachers['url'].check(name)
+        self.blobs.touch(path)
+        return path
 
     def platform_check(self, name):
         return self.cachers['platform'].check(name)
 
-    def pip_cache(self, name, version, fail_ok=False):
-        return self.cachers['pip'].cache(
-            name,
-            version=version,
-            fail_ok=fail_ok)
+    def pip_cache(self, name, version, fail_ok=False, setup_requires=None):
+        hit = self.cachers['pip'].check(name, version=version) is not None
+        self.metrics.result('pip', hit)
+        fetch = not hit and self._pip_pull((name, version)) is None
+        with self.metrics.timer('pip', 'fetch_seconds' if fetch else 'lookup_seconds'):
+            path = self.cachers['pip'].cache(
+                name,
+                version=version,
+                fail_ok=fail_ok,
+                setup_requires=setup_requires)
+        if fetch and path is not None:
+            self.metrics.add('pip', 'bytes_fetched', getsize(path))
+            self._push('pip', '%s==%s' % (name, version), self._files([path]))
+        self.blobs.touch(path)
+        return path
+
+    def pip_cache_many(self, specs):
+        missing = [spec for spec in specs if self.cachers['pip'].check(*spec) is None]
+        self.metrics.add('pip', 'hits', len(specs) - len(missing))
+        self.metrics.add('pip', 'misses', len(missing))
+        if self.remote is not None:
+            pulled = self.remote.map(self._pip_pull, missing)
+            missing = [spec for spec, path in zip(missing, pulled) if path is None]
+        with self.metrics.timer('pip', 'fetch_seconds' if missing else 'lookup_seconds'):
+            cached = self.cachers['pip'].cache_many(specs)
+        self.metrics.add('pip', 'bytes_fetched', sum(getsize(cached[spec]) for spec in missing if cached[spec] is not None))
+        self._push_many('pip', [('%s==%s' % spec, self._files([cached[spec]])) for spec in missing if cached[spec] is not None])
+        return cached
 
-    def url_cache(self, name):
-        return self.cachers['url'].cache(name)
+    def url_cache(self, name, sha256=None):
+        return self.url_cache_many([name], digests={name: sha256} if sha256 else None)[0]
 
-    def platform_cache(self, name, execctx, buildpy, plat_specific=False):
-        return self.cachers['platform'].cache(
-            name,
-            execctx=execctx,
-            buildpy=buildpy,
-            plat_specific=plat_specific)
+    def url_cache_many(self, names, digests=None):
+        unique = list(OrderedDict.fromkeys(names))
+        missing = [name for name in unique if self.cachers['url'].check(name) is None]
+        self.metrics.add('url', 'hits', len(unique) - len(missing))
+        self.metrics.add('url', 'misses', len(missing))
+        if self.remote is not None:
+            pulled = self.remote.map(self._url_pull, missing)
+            missing = [name for name, path in zip(missing, pulled) if path is None]
+        with self.metrics.timer('url', 'fetch_seconds' if missing else 'lookup_seconds'):
+            paths = self.cachers['url'].cache_many(names, digests=digests)
+        fetched = dict(zip(names, paths))
+        self.metrics.add('url', 'bytes_fetched', sum(getsize(fetched[name]) for name in missing))
+        self._push_many('url', [(name, self._files([fetched[name]])) for name in missing])
+        for path in paths:
+            self.blobs.touch(path)
+        return paths
+
+    def platform_cache(self, name, execctx, buildpy, plat_specific=False, metadata=None):
+        self._metadata_probe('platform', name, metadata)
+        self.metrics.result('platform', self.cachers['platform'].check(name) is not None)
+        with self.metrics.timer('platform', 'probe_seconds'):
+            return self.cachers['platform'].cache(
+                name,
+                execctx=self._timed_execctx('platform', execctx),
+                buildpy=buildpy,
+                plat_specific=plat_specific)
+
+    def pyversion_cache(self, name, execctx, buildpy, metadata=None):
+        self._metadata_probe('pyversion', name, metadata)
+        self.metrics.result('pyversion', self.cachers['pyversion'].check(name) is not None)
+        with self.metrics.timer('pyversion', 'probe_seconds'):
+            return self.cachers['pyversion'].cache(
+                name,
+                execctx=self._timed_execctx('pyversion', execctx),
+                buildpy=buildpy)
+
+    def _metadata_probe(self, kind, name, metadata):
+        """ If the probe result `kind` of image `name` is not cached, but the image's metadata (e.g. Docker labels,
+        returned by the `metadata` callable) contains it, record it so that the image does not have to be run.
+        """
+        if metadata is None or self.cachers[kind].check(name) is not None:
+            return
+        value = metadata().get(kind)
+        if value:
+            debug('Using %s of image %s from image metadata: %s', kind, name, value)
+            self.probe_store.set(kind, name, value)
 
-    def pyversion_cache(self, name, execctx, buildpy):
-        return self.cachers['pyversion'].cache(name, execctx=execctx, buildpy=buildpy)
+    def manifest_check(self, name):
+        return self.cachers['manifest'].check(name)
+
+    def manifest_cache(self, name, execctx, pythons, plat_specific=False):
+        self.metrics.result('manifest', self.manifest_check(name) is not None)
+        with self.metrics.timer('manifest', 'probe_seconds'):
+            return self.cachers['manifest'].cache(
+                name,
+                execctx=self._timed_execctx('manifest', execctx),
+                pythons=pythons,
+                plat_specific=plat_specific)
+
+    def tree_check(self, path):
+        return self.cachers['tree'].check(path)
+
+    def tree_cache(self, path):
+        """ Extract the cached source archive at `path` to the source tree cache (if not already extracted).
+        """
+        self.metrics.result('tree', self.tree_check(path) is not None)
+        try:
+            with self.metrics.timer('tree', 'fetch_seconds'):
+                return self.cachers['tree'].cache(path, digest=self.source_digest(path))
+        except Exception as exc:
+            warn('Unable to extract source tree of %s, builds will extract it: %s', path, exc)
+            return None
+
+    def wheel_type_cache(self, path):
+        """ Return the wheel type of the sdist at `path`, which is only probed once per sdist digest.
+        """
+        digest = self.source_digest(path)
+        wheel_type = self.probe_store.get('wheeltype', digest) if digest is not None else None
+        self.metrics.result('wheeltype', wheel_type is not None)
+        if wheel_type is None:
+            with self.metrics.timer('wheeltype', 'probe_seconds'):
+                sdist = PythonSdist.open(path)
+                wheel_type = sdist.detect_wheel_type(introspect=lambda: self.setup_info_cache(path, sdist.setup_info))
+            if wheel_type is not None and digest is not None:
+                wheel_type = self.probe_store.set('wheeltype', digest, wheel_type)
+        return wheel_type
+
+    def setup_info_cache(self, path, introspect, **config):
+        """ Return the introspection of the setup script (see `starforge.packaging.setup.setup_info`) of the sdist at
+        `path` by this interpreter, calling `introspect()` to run it only once per key (see
+        `starforge.packaging.setup.setup_info_key`, which is called with the sdist digest and `config`).
+        """
+        digest = self.source_digest(path)
+        key = setup_info_key(digest, **config) if digest is not None else None
+        setup_info = self.probe_store.get('setupinfo', key) if key is not None else None
+        self.metrics.result('setupinfo', setup_info is not None)
+        if setup_info is not None:
+            return json.loads(setup_info)
+        with self.metrics.timer('setupinfo', 'probe_seconds'):
+            setup_info = introspect()
+        if setup_info is not None and key is not None:
+            self.probe_store.set('setupinfo', key, json.dumps(setup_info, sort_keys=True))
+        return setup_info
+
+    def export_probes(self, path):
+        """ Write probe results that could not be stored because the cache is read-only to `path`, for
+        `import_probes()`.
+        """
+        return self.probe_store.export_json(path)
+
+    def import_probes(self, path):
+        return self.probe_store.import_json(path)
+
+    def _timed_execctx(self, kind, execctx):
+        """ Wrap the execution context `execctx` to record the time spent starting it (e.g. a container) for probes.
+        """
+        @contextmanager
+        def timed_execctx(**kwargs):
+            start = time.time()
+            with execctx(**kwargs) as run:
+                self.metrics.add(kind, 'probe_start_seconds', time.time() - start)
+                yield run
+        return timed_execctx
+
+    def build_cache(self, key, paths):
+        products = self.cachers['build'].cache(key, paths=paths)
+        if products:
+            self._push('build', key, products)
+        return products
+
+    def build_restore(self, key, filenames, output):
+        if self.cachers['build'].check(key, filenames=filenames) is None:
+            products = self._pull('build', key)
+            if products is not None:
+                self.cachers['build'].record(key, products)
+        restored = self.cachers['build'].restore(key, filenames, output)
+        self.metrics.result('build', restored)
+        return restored
+
+    def _pull(self, kind, name):
+        """ Fetch the ref `name` of `kind` and its blobs from the remote cache into the blob store.
+
+        Returns the ref, a dict of filename to digest, or None if it is not in the remote cache or cannot be fetched.
+        """
+        if self.remote is None or self.db.readonly:
+            return None
+        try:
+            with self.metrics.timer('remote', 'fetch_seconds'):
+                files = self.remote.get_ref(kind, name)
+                self.metrics.result('remote', files is not None)
+                if files is None:
+                    debug('Not in remote cache: %s %s', kind, name)
+                    return None
+                missing = [digest for digest in set(files.values()) if not exists(self.blobs.path(digest))]
+                for digest, chunks in zip(missing, self.remote.map(self.remote.get_blob, missing)):
+                    if chunks is None:
+                        warn('Remote cache ref %s %s refers to missing blob %s', kind, name, digest)
+                        return None
+                    self.blobs.ingest(chunks, sha256=digest)
+                    self.metrics.add('remote', 'bytes_fetched', getsize(self.blobs.path(digest)))
+        except Exception as exc:
+            warn('Unable to fetch %s %s from remote cache: %s', kind, name, exc)
+            return None
+        info('Fetched %s from remote cache', name)
+        return files
+
+    def _pip_pull(self, spec):
+        files = self._pull('pip', '%s==%s' % spec)
+        if not files:
+            return None
+        filename, digest = list(files.items())[0]
+        path = self.blobs.checkout(digest, self.cachers['pip'].abspath(filename), '%s==%s' % spec)
+        self.cachers['pip'].index.add(filename)
+        return path
+
+    def _url_pull(self, name):
+        files = self._pull('url', name)
+        if not files:
+            return None
+        return self.blobs.checkout(list(files.values())[0], self.cachers['url'].url_abspath(name), name)
+
+    def _files(self, paths):
+        if self.remote is None or self.db.readonly:
+            return {}
+        return dict((basename(path), self.source_digest(path)) for path in paths)
+
+    def _push(self, kind, name, files):
+        """ Upload the blobs in `files`, a dict of filename to digest, and a ref `name` of `kind` to them to the remote
+        cache.
+        """
+        if self.remote is None or self.remote.readonly or self.db.readonly:
+            return
+        try:
+            self.remote.map(lambda digest: self.remote.put_blob(digest, self.blobs.path(digest)), set(files.values()))
+            self.remote.put_ref(kind, name, files)
+            info('Uploaded %s to remote cache', name)
+        except Exception as exc:
+            warn('Unable to upload %s %s to remote cache: %s', kind, name, exc)
+
+    def _push_many(self, kind, refs):
+        """ Upload each (name, files) in `refs` to the remote cache, concurrently.
+        """
+        if self.remote is None or not refs:
+            return
+        self.remote.map(lambda ref: self._push(kind, *ref), refs)
+
+    def source_digest(self, path):
+        """ Return the digest of the cached source at `path`, adding it to the blob store if it is not yet managed.
+        """
+        digest = self.blobs.digest(path)
+        if digest is None and not self.db.readonly:
+            digest = self.blobs.ingest_file(path, 'adopted')
+        return digest
+
+    def pinned_digests(self, wheel_config_manager):
+        """ Return the set of blob digests of all cached sources used by wheels in `wheel_config_manager`
+        """
+        pinned = set()
+        for name, wheel_config in wheel_config_manager:
+            paths = [self.cachers['pip'].check(name, version=wheel_config.version)]
+            paths.extend(self.cachers['url'].check(url) for url in wheel_config.sources)
+            for path in paths:
+                digest = path and self.blobs.digest(path)
+                if digest:
+                    pinned.add(digest)
+        return pinned
+
+    def adopt(self):
+        """ Bring files cached by older versions of Starforge under management of the blob store
+        """
+        return self.blobs.adopt(self.cachers['pip'].cache_path) + self.blobs.adopt(self.cachers['url'].url_path)
+
+    def _evict(self, digest, size, tree_size=0):
+        for path in self.blobs.remove(digest):
+            info('Evicted: %s (%d bytes)', path, size)
+        if tree_size:
+            info('Evicted source tree: %s (%d bytes)', self.cachers['tree'].path(digest), tree_size)
+        self.cachers['tree'].remove(digest)
+
+    def _evict_orphan_trees(self, blobs, tree_sizes):
+        """ Remove extracted trees whose archive is no longer in the blob store. Returns the bytes freed.
+        """
+        freed = 0
+        digests = set(digest for digest, _, _ in blobs)
+        for digest, size in tree_sizes.items():
+            if digest not in digests:
+                info('Evicted orphaned source tree: %s (%d bytes)', self.cachers['tree'].path(digest), size)
+                self.cachers['tree'].remove(digest)
+                freed += size
+        return freed
+
+    def gc(self, max_bytes, pinned=None):
+        """ Evict least recently used sources (and their extracted trees) until the blob store and source trees
+        together are no larger than `max_bytes`.
+
+        Blobs with digests in `pinned` are never evicted. Returns (evicted count, evicted bytes).
+        """
+        pinned = pinned or set()
+        blobs = self.blobs.blobs()
+        tree_sizes = self.cachers['tree'].sizes()
+        total = sum(size for _, size, _ in blobs) + sum(tree_sizes.values())
+        evicted = 0
+        freed = self._evict_orphan_trees(blobs, tree_sizes)
+        for digest, size, atime in blobs:
+            if total - freed <= max_bytes:
+                break
+            if digest in pinned:
+                continue
+            self._evict(digest, size, tree_sizes.get(digest, 0))
+            evicted += 1
+            freed += size + tree_sizes.get(digest, 0)
+        if total - freed > max_bytes:
+            warn('Cache is still %d bytes after evicting all unpinned sources (limit: %d)', total - freed, max_bytes)
+        return (evicted, freed)
+
+    def prune(self, older_than, pinned=None):
+        """ Evict sources (and forget probe results) not used since the timestamp `older_than`.
+
+        Blobs with digests in `pinned` are never evicted. Returns (evicted count, evicted bytes, pruned probes).
+        """
+        pinned = pinned or set()
+        blobs = self.blobs.blobs()
+        tree_sizes = self.cachers['tree'].sizes()
+        evicted = 0
+        freed = self._evict_orphan_trees(blobs, tree_sizes)
+        for digest, size, atime in blobs:
+            if atime >= older_than:
+                break
+            if digest in pinned:
+                continue
+            self._evict(digest, size, tree_sizes.get(digest, 0))
+            evicted += 1
+            freed += size + tree_sizes.get(digest, 0)
+        for path in (self.blobs.tmp_path, self.downloader.partial_path, self.cachers['tree'].tmp_path):
+            if not exists(path):
+                continue
+            for name in listdir(path):
+                if stat(join(path, name)).st_mtime < time.time() - STALE_PARTIAL_AGE:
+                    debug('Removing stale partial file: %s', join(path, name))
+                    if isdir(join(path, name)):
+                        rmtree(join(path, name))
+                    else:
+                        unlink(join(path, name))
+        return (evicted, freed, self.probe_store.prune(older_than))
+
+    def verify(self, jobs=DEFAULT_VERIFY_JOBS, delete=False):
+        """ Verify the digest of every blob, optionally evicting corrupt ones. Returns the list of corrupt digests.
+        """
+        corrupt = self.blobs.verify(jobs=jobs)
+        for digest in corrupt:
+            paths = self.blobs.paths(digest)
+            warn('Corrupt or missing blob %s, linked from: %s', digest, ', '.join(paths) or '(nothing)')
+            if delete:
+                self._evict(digest, 0)
+        return corrupt
+
+    def stats(self):
+        blobs = self.blobs.blobs()
+        tree_sizes = self.cachers['tree'].sizes()
+        return OrderedDict([
+            ('cache_path', self.cache_path),
+            ('blobs', len(blobs)),
+            ('blob_bytes', sum(size for _, size, _ in blobs)),
+            ('cached_files', self.db.execute('SELECT COUNT(*) FROM manifest')[0][0]),
+            ('probes', self.db.execute('SELECT COUNT(*) FROM probes')[0][0]),
+            ('source_trees', len(tree_sizes)),
+            ('source_tree_bytes', sum(tree_sizes.values())),
+            ('oldest_access', min(atime for _, _, atime in blobs) if blobs else None),
+        ])
+
+    def save_metrics(self):
+        """ Add this session's cache metrics to the totals in the cache database, and return them.
+        """
+        metrics = self.metrics.dump()
+        self.metrics.save(self.db)
+        return metrics
+
+    def metrics_totals(self):
+        return CacheMetrics.totals(self.db)
 
 
 def cache_wheel_sources(cache_manager, wheel_config):
     fail_ok = wheel_config.sources != []
     sources = []
-    if wheel_config.setup_requires:
-        # this is done due to pypa/pip#1884 - `pip download` fails under certain circumstances if setup_requires is set
-        info("Installing packages to Starforge Python at '%s' for '%s' setup requirements: %s",
-             sys.executable, wheel_config.name, ', '.join(wheel_config.setup_requires))
-        pip_install(pip=py_to_pip(sys.executable), packages=wheel_config.setup_requires)
-    sources.append(cache_manager.pip_cache(wheel_config.name, wheel_config.version, fail_ok=fail_ok))
-    for src_url in wheel_config.sources:
-        sources.append(cache_manager.url_cache(src_url))
+    sources.append(cache_manager.pip_cache(wheel_config.name, wheel_config.version, fail_ok=fail_ok,
+                                           setup_requires=wheel_config.setup_requires))
+    sources.extend(cache_manager.url_cache_many(wheel_config.sources, digests=wheel_config.source_digests))
     return sources
 
 
+def cache_wheel_trees(cache_manager, wheel_config):
+    """ Extract the cached sources of `wheel_config` to the source tree cache.
+    """
+    paths = [cache_manager.pip_check(wheel_config.name, wheel_config.version)]
+    paths.extend(cache_manager.url_check(url) for url in wheel_config.sources)
+    return [cache_manager.tree_cache(path) for path in paths if path is not None]
+
+
 def check_wheel_source(cache_manager, wheel_config):
     cached_source = cache_manager.pip_check(wheel_config.name, wheel_config.version)
     missing = '%s %s' % (wheel_config.name, wheel_config.version)
@@ -4,8 +4,9 @@ from __future__ import absolute_import
 
 import click
 
-from os import getcwd
+from os import chown, getcwd
 
+from .. import trace
 from ..cli import pass_context
 from ..config.wheels import WheelConfigManager
 from ..forge.wheels import ForgeWheel
@@ -42,9 +43,30 @@ from ..util import xdg_config_file
               default=False,
               help='Enable or disable fetching/caching of sources (normally '
                    'this is done by `starforge wheel`')
+@click.option('--install-deps/--no-install-deps',
+              default=True,
+              envvar='STARFORGE_INSTALL_DEPS',
+              help='Install system dependencies with the image\'s package tool (disabled by `starforge wheel` when '
+                   'building in an image with the dependencies preinstalled)')
+@click.option('--trace', 'trace_file',
+              default=None,
+              envvar='STARFORGE_TRACE',
+              type=click.Path(dir_okay=False, writable=True),
+              help='Write a Chrome trace of the build phases to TRACE_FILE (set by `starforge wheel --trace`)')
+@click.option('--probes', 'probes_file',
+              default=None,
+              envvar='STARFORGE_PROBES',
+              type=click.Path(dir_okay=False, writable=True),
+              help='Write results of probes (e.g. setup.py introspection) that could not be stored in the read-only '
+                   'cache to PROBES_FILE (set by `starforge wheel`)')
+@click.option('--image-id',
+              default=None,
+              envvar='STARFORGE_IMAGE_ID',
+              help='ID of the image contents, for caching probe results per image (set by `starforge wheel`)')
 @click.argument('wheel')
 @pass_context
-def cli(ctx, wheels_config, image, output, uid, gid, fetch_srcs, wheel):
+def cli(ctx, wheels_config, image, output, uid, gid, fetch_srcs, install_deps, trace_file, probes_file, image_id,
+        wheel):
     """ Build a wheel without virtualization.
 
     This command is not typically meant to be run directly, you should use
@@ -69,7 +91,18 @@ def cli(ctx, wheels_config, image, output, uid, gid, fetch_srcs, wheel):
         wheel_config.set_imageset(imageset=ctx.config.make_imageset('_ephemeral_', [image]), force=True)
         image = wheel_config.get_image(image)
     ectx = LocalExecutionContext(image)
-    forge = ForgeWheel(wheel_config, cachemgr, ectx.run_context, image=image)
-    if fetch_srcs:
-        forge.cache_sources()
-    forge.bdist_wheel(output=output, uid=uid, gid=gid)
+    forge = ForgeWheel(wheel_config, cachemgr, ectx.run_context, image=image,
+                       image_id=(lambda: image_id) if image_id else None)
+    if trace_file:
+        trace.enable()
+    try:
+        with trace.span('bdist_wheel', wheel=wheel, image=image.name):
+            if fetch_srcs:
+                forge.cache_sources()
+            forge.bdist_wheel(output=output, uid=uid, gid=gid, install_deps=install_deps)
+    finally:
+        if probes_file and cachemgr.export_probes(probes_file):
+            chown(probes_file, int(uid), int(gid))
+        if trace_file:
+            trace.save(trace_file, process_name=None)
+            chown(trace_file, int(uid), int(gid))
@@ -0,0 +1,198 @@
+"""
+"""
+from __future__ import absolute_import
+
+import json
+import time
+
+import click
+
+from ..cache import CacheManager, DEFAULT_VERIFY_JOBS
+from ..cli import pass_context
+from ..config.wheels import WheelConfigManager
+from ..execution.docker import gc_dependency_images
+from ..io import fatal, info, warn
+from ..util import parse_size, xdg_config_file
+
+
+def wheels_config_option(f):
+    return click.option('--wheels-config',
+                        default=xdg_config_file(name='wheels.yml'),
+                        type=click.Path(file_okay=True,
+                                        writable=False,
+                                        resolve_path=True),
+                        help='Path to wheels config file, sources of wheels in this file are never evicted (default: '
+                             '%s)' % xdg_config_file(name='wheels.yml'))(f)
+
+
+def pin_option(f):
+    return click.option('--pin/--no-pin',
+                        default=True,
+                        help='Never evict sources of wheels in the wheels config (with --no-pin, the wheels config is '
+                             'not read and any source may be evicted)')(f)
+
+
+def _pinned(ctx, cache_manager, wheels_config, pin):
+    if not pin:
+        warn('Not pinning sources, any cached source may be evicted')
+        return set()
+    try:
+        wheel_config_manager = WheelConfigManager.open(ctx.config, wheels_config)
+    except (OSError, IOError) as exc:
+        fatal('Unable to read wheels config to determine the sources to pin (use --no-pin to evict without pinning): '
+              '%s', exc)
+    pinned = cache_manager.pinned_digests(wheel_config_manager)
+    info('%d cached sources are pinned by %s', len(pinned), wheels_config)
+    return pinned
+
+
+@click.group('cache')
+def cli():
+    """ Manage the Starforge cache.
+    """
+
+
+@cli.command('prefetch')
+@click.option('--wheels-config',
+              default=xdg_config_file(name='wheels.yml'),
+              type=click.Path(file_okay=True,
+                              writable=False,
+                              resolve_path=True),
+              help='Path to wheels config file (default: '
+                   '%s)' % xdg_config_file(name='wheels.yml'))
+@click.argument('wheels', nargs=-1)
+@pass_context
+def prefetch(ctx, wheels_config, wheels):
+    """ Fetch sources for all wheels (or WHEELS) in the wheels config.
+
+    sdists are fetched directly from the package index, concurrently. Wheels whose sdists cannot be found on the index
+    are left for `starforge wheel` to fetch with pip.
+    """
+    wheel_config_manager = WheelConfigManager.open(ctx.config, wheels_config)
+    cache_manager = CacheManager(ctx.config.cache_path, remote=ctx.config.remote_cache)
+    wheel_configs = []
+    for name in wheels or [name for name, _ in wheel_config_manager]:
+        try:
+            wheel_configs.append(wheel_config_manager.get_wheel_config(name))
+        except KeyError:
+            fatal('Package not found in %s: %s', wheels_config, name)
+    specs = [(wheel_config.name, wheel_config.version) for wheel_config in wheel_configs]
+    cached = cache_manager.pip_cache_many(specs)
+    urls = []
+    digests = {}
+    for wheel_config in wheel_configs:
+        urls.extend(wheel_config.sources)
+        digests.update(wheel_config.source_digests)
+        if cached[(wheel_config.name, wheel_config.version)] is None and not wheel_config.sources:
+            warn('No sdist found on index for %s %s', wheel_config.name, wheel_config.version)
+    cache_manager.url_cache_many(urls, digests=digests)
+    cache_manager.save_metrics()
+    info('Prefetched sources for %d wheels', len(wheel_configs))
+
+
+@cli.command('stats')
+@click.option('--json', 'as_json',
+              is_flag=True,
+              help='Output stats as JSON')
+@pass_context
+def stats(ctx, as_json):
+    """ Show cache usage and hit/miss, transfer, and probe time totals.
+    """
+    cache_manager = CacheManager(ctx.config.cache_path)
+    stats = cache_manager.stats()
+    stats['cache_max_bytes'] = ctx.config.cache_max_bytes
+    metrics = cache_manager.metrics_totals()
+    if as_json:
+        stats['metrics'] = metrics
+        click.echo(json.dumps(stats, indent=2))
+        return
+    for key, value in stats.items():
+        if key == 'oldest_access' and value is not None:
+            value = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(value))
+        info('%s: %s', key, value, bold=False, fg=None, err=False)
+    for kind, counters in metrics.items():
+        lookups = counters['hits'] + counters['misses']
+        info('%s: %d hits, %d misses (%.1f%% hit rate), %d bytes fetched, %.1fs fetching, %.1fs probing (%.1fs starting '
+             'probe environments)', kind, counters['hits'], counters['misses'],
+             100.0 * counters['hits'] / lookups if lookups else 0, counters['bytes_fetched'], counters['fetch_seconds'],
+             counters['probe_seconds'], counters['probe_start_seconds'], bold=False, fg=None, err=False)
+
+
+@cli.command('gc')
+@wheels_config_option
+@pin_option
+@click.option('--max-bytes',
+              default=None,
+              help='Evict least recently used sources until the cache is at most this size, e.g. 20G (default: '
+                   '`cache_max_bytes` from the Starforge config)')
+@pass_context
+def gc(ctx, wheels_config, pin, max_bytes):
+    """ Evict least recently used sources (and their extracted source trees) to keep the cache within its size limit.
+    """
+    max_bytes = parse_size(max_bytes) if max_bytes is not None else ctx.config.cache_max_bytes
+    if max_bytes is None:
+        fatal('No cache size limit: use --max-bytes or set `cache_max_bytes` in the Starforge config')
+    cache_manager = CacheManager(ctx.config.cache_path)
+    cache_manager.adopt()
+    evicted, freed = cache_manager.gc(max_bytes, pinned=_pinned(ctx, cache_manager, wheels_config, pin))
+    info('Evicted %d sources, %d bytes', evicted, freed)
+
+
+@cli.command('prune')
+@wheels_config_option
+@pin_option
+@click.option('--older-than',
+              required=True,
+              type=click.FLOAT,
+              help='Evict sources and forget image probe results not used in this many days')
+@pass_context
+def prune(ctx, wheels_config, pin, older_than):
+    """ Evict sources that have not been used recently.
+    """
+    cache_manager = CacheManager(ctx.config.cache_path)
+    cache_manager.adopt()
+    evicted, freed, probes = cache_manager.prune(time.time() - older_than * 24 * 60 * 60,
+                                                 pinned=_pinned(ctx, cache_manager, wheels_config, pin))
+    info('Evicted %d sources, %d bytes, and %d probe results', evicted, freed, probes)
+
+
+@cli.command('gc-images')
+@click.option('--older-than',
+              default=None,
+              type=click.FLOAT,
+              help='Also remove dependency images created more than this many days ago')
+@click.option('--all', 'remove_all',
+              is_flag=True,
+              default=False,
+              help='Remove all dependency images')
+@pass_context
+def gc_images(ctx, older_than, remove_all):
+    """ Remove stale Docker dependency images.
+
+    Dependency images (images with a wheel's system packages preinstalled)
+    are stale once their base image has been updated or removed.
+    """
+    if older_than is not None:
+        older_than = time.time() - older_than * 24 * 60 * 60
+    removed = gc_dependency_images(ctx.config.docker, older_than=older_than, remove_all=remove_all)
+    info('Removed %d dependency images', len(removed))
+
+
+@cli.command('verify')
+@click.option('-j', '--jobs',
+              default=DEFAULT_VERIFY_JOBS,
+              type=click.INT,
+              help='Number of files to hash concurrently (default: %d)' % DEFAULT_VERIFY_JOBS)
+@click.option('--delete/--no-delete',
+              default=False,
+              help='Evict sources that fail verification')
+@pass_context
+def verify(ctx, jobs, delete):
+    """ Verify the checksums of all cached sources.
+    """
+    cache_manager = CacheManager(ctx.config.cache_path)
+    cache_manager.adopt()
+    corrupt = cache_manager.verify(jobs=jobs, delete=delete)
+    if corrupt:
+        fatal('%d cached sources failed verification', len(corrupt))
+    info('All cached sources OK')
@@ -0,0 +1,46 @@
+"""
+"""
+from __future__ import absolute_import
+
+from os.path import abspath, join
+
+import click
+
+from ..cli import pass_context
+from ..index import DEFAULT_INDEX_HOST, DEFAULT_INDEX_PORT, serve as serve_index
+
+
+@click.group('index')
+def cli():
+    """ Local package index.
+    """
+
+
+@cli.command('serve')
+@click.option('--host',
+              default=None,
+              help='Address to listen on (default: `index.host` from the Starforge config or %s)' % DEFAULT_INDEX_HOST)
+@click.option('-p', '--port',
+              default=None,
+              type=click.INT,
+              help='Port to listen on (default: `index.port` from the Starforge config or %s)' % DEFAULT_INDEX_PORT)
+@click.option('-w', '--wheel-dir',
+              multiple=True,
+              type=click.Path(file_okay=False),
+              help='Serve wheels in WHEEL-DIR, in addition to `index.wheel_dirs` from the Starforge config (may be '
+                   'specified multiple times)')
+@pass_context
+def serve(ctx, host, port, wheel_dir):
+    """ Serve cached sdists and built wheels as a PEP 503 simple index.
+
+    Set `index.url` in the Starforge config to the address of this index as
+    reachable from build guests to have builds install their dependencies from
+    it.
+    """
+    config = ctx.config.index
+    host = host or config.get('host', DEFAULT_INDEX_HOST)
+    port = port if port is not None else config.get('port', DEFAULT_INDEX_PORT)
+    directories = [join(ctx.config.cache_path, 'tarballs')]
+    directories.extend(abspath(d) for d in config.get('wheel_dirs', []))
+    directories.extend(abspath(d) for d in wheel_dir)
+    serve_index(directories, host=host, port=port)
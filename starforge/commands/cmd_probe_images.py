@@ -0,0 +1,87 @@
+"""
+"""
+from __future__ import absolute_import
+
+import json
+from multiprocessing.pool import ThreadPool
+
+import click
+
+from ..cache import CacheManager
+from ..cli import pass_context
+from ..forge.wheels import execution_context
+from ..io import error, fatal, info, warn
+from ..util import xdg_config_file
+
+
+DEFAULT_JOBS = 4
+
+
+@click.command('probe_images')
+@click.option('--osk',
+              default=xdg_config_file(name='osk.txt'),
+              type=click.Path(dir_okay=True,
+                              writable=False,
+                              resolve_path=False),
+              help='Path file containing OSK, if the guest requires it '
+                   '(default: %s)' % xdg_config_file(name='osk.txt'))
+@click.option('-j', '--jobs',
+              default=DEFAULT_JOBS,
+              type=click.INT,
+              help='Number of images to probe concurrently (default: %d)' % DEFAULT_JOBS)
+@click.option('-o', '--output',
+              default=None,
+              type=click.Path(dir_okay=False, writable=True),
+              help='Write the manifest of all probed images to OUTPUT as JSON')
+@click.argument('images', nargs=-1)
+@pass_context
+def cli(ctx, osk, jobs, output, images):
+    """ Probe all images in all imagesets (or IMAGES) for the metadata needed
+    to name the wheels built on them.
+
+    Each image is run once, and the results (architecture, platform tag, and
+    the version and ABI of each Python) are recorded in the cache, so that
+    `starforge wheel` does not have to run images just to determine the names
+    of the wheels it will build. Images that have already been probed are not
+    run again.
+    """
+    names = set()
+    for imageset in ctx.config.imagesets.values():
+        names.update(imageset.images)
+    for name in images:
+        if name not in ctx.config.images:
+            fatal('Image not found in Starforge config: %s', name)
+    names = sorted(images or names)
+    cache_manager = CacheManager(ctx.config.cache_path)
+
+    def probe(name):
+        image = ctx.config.images[name]
+        if cache_manager.manifest_check(name) is None:
+            info('Probing image %s', name)
+        ectx = execution_context(ctx.config, image, osk_file=osk)
+        try:
+            return cache_manager.manifest_cache(name, ectx.run_context, image.pythons, plat_specific=image.plat_specific)
+        except Exception:
+            error('Failed to probe image %s', name, exception=True)
+            return None
+
+    pool = ThreadPool(max(1, min(jobs, len(names))))
+    try:
+        manifests = dict(zip(names, pool.map(probe, names)))
+    finally:
+        pool.close()
+        pool.join()
+        cache_manager.save_metrics()
+    failed = sorted(name for name, manifest in manifests.items() if manifest is None)
+    for name in sorted(manifests):
+        manifest = manifests[name]
+        if manifest is not None:
+            info('%s: %s %s, %s', name, manifest['arch'], manifest['platform'],
+                 ', '.join(p['version'] for p in manifest['pythons'].values()), bold=False, fg=None, err=False)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(dict((k, v) for k, v in manifests.items() if v is not None), f, indent=2, sort_keys=True)
+    if failed:
+        warn('Failed to probe %d images: %s', len(failed), ', '.join(failed))
+        fatal('Probing failed')
+    info('Probed %d images', len(manifests))
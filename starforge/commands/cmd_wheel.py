@@ -2,28 +2,54 @@
 """
 from __future__ import absolute_import
 
+import json
 import sys
-from os import getcwd, getuid, getgid, makedirs
+import threading
+import uuid
+from multiprocessing.pool import ThreadPool
+from os import chmod, fdopen, getcwd, getuid, getgid, makedirs, rename, unlink
 from os.path import exists, abspath, join, isabs, dirname
-from shutil import copy
+from shutil import copyfileobj, rmtree
+from subprocess import PIPE, Popen, STDOUT
+from tempfile import mkdtemp, mkstemp
 
 import click
 import yaml
 
+from .. import trace
 from ..io import error, info, warn, fatal
 from ..cli import pass_context
 from ..forge.wheels import build_forges
-from ..cache import cache_wheel_sources, check_wheel_source
-from ..util import xdg_cache_dir, xdg_config_file
+from ..cache import cache_wheel_sources, cache_wheel_trees, check_wheel_source
+from ..util import image_cache_path, makedirs_exist_ok, xdg_cache_dir, xdg_config_file
 
 
 LOCAL_BDIST_WHEEL_CMD_TEMPLATE = (
-    'starforge {debug} --config-file {config} bdist_wheel --wheels-config {wheels_config} -i {image} -o {output} {name}')
+    'starforge {debug} --config-file {config} bdist_wheel --wheels-config {wheels_config} -i {image} -o {output} '
+    '{args}{name}')
 BDIST_WHEEL_CMD_TEMPLATE = (
     'starforge {debug} --config-file {config} bdist_wheel --wheels-config {wheels_config} -i {image} -o {output} -u '
-    '{uid} -g {gid} {name}')
+    '{uid} -g {gid} {args}{name}')
 GUEST_HOST = '/host'
 GUEST_SHARE = '/share'
+GUEST_CCACHE = '/ccache'
+# written by the guest to the wheel dir and merged into the trace of `--trace`
+GUEST_TRACE_TEMPLATE = '.starforge_trace_{id}.json'
+# written by the guest to the wheel dir and imported into the cache, which is read-only in the guest
+GUEST_PROBES_TEMPLATE = '.starforge_probes_{id}.json'
+
+
+def trace_option(f):
+    return click.option('--trace', 'trace_file',
+                        default=None,
+                        type=click.Path(dir_okay=False, writable=True),
+                        help='Write the time spent in each phase of the build(s), on the host and in guests, to '
+                             'TRACE_FILE as Chrome trace JSON (open in chrome://tracing or https://ui.perfetto.dev)')(f)
+
+
+def _save_trace(path):
+    trace.save(path)
+    info('Wrote trace to %s', path)
 
 
 @click.command('wheel')
@@ -65,59 +91,68 @@ GUEST_SHARE = '/share'
               help='Immediately exit upon build failure (by default, '
                    'Starforge will try to build on all configured images '
                    'even if a previous image fails)')
+@click.option('--build-cache/--no-build-cache',
+              default=True,
+              help='Restore wheels from the build cache if this wheel has previously been built from the same sources, '
+                   'config, and image, and add newly built wheels to it (Docker images only)')
+@click.option('--cache-stats',
+              default=None,
+              type=click.Path(dir_okay=False, writable=True),
+              help='Write cache hit/miss, transfer, and timing stats for this run to CACHE-STATS as JSON')
+@click.option('-j', '--jobs',
+              default=1,
+              type=click.INT,
+              help='Build on up to JOBS images concurrently, each in a separate Starforge process whose output is '
+                   'prefixed with the image name (default: 1)')
+@trace_option
 @click.argument('wheel')
 @pass_context
-def cli(ctx, wheels_config, wheel_dir, osk, sdist, image, docker, qemu, wheel, qemu_port, exit_on_failure):
+def cli(ctx, wheels_config, wheel_dir, osk, sdist, image, docker, qemu, wheel, qemu_port, exit_on_failure,
+        build_cache, cache_stats, jobs, trace_file):
     """ Build a wheel.
     """
+    cache_manager = None
+    child_stats = []
+    if trace_file:
+        trace.enable()
     try:
         ran_build = False
         failed = False
         wheel_dir = abspath(wheel_dir)
         if not exists(wheel_dir):
             makedirs(wheel_dir)
-        for forge in build_forges(ctx.config, wheels_config, wheel, images=image, osk_file=osk, qemu_port=qemu_port):
+        forges = build_forges(ctx.config, wheels_config, wheel, images=image, osk_file=osk, qemu_port=qemu_port)
+        if jobs > 1:
+            forges = list(forges)
+            ran_build = bool(forges)
+            if forges:
+                cache_manager = forges[0].cache_manager
+                # fetch sources once, rather than in every child
+                with trace.span('fetch sources', wheel=wheel):
+                    try:
+                        check_wheel_source(cache_manager, forges[0].wheel_config)
+                    except AssertionError:
+                        cache_wheel_sources(cache_manager, forges[0].wheel_config)
+                with trace.span('cache source trees', wheel=wheel):
+                    cache_wheel_trees(cache_manager, forges[0].wheel_config)
+                failed = not _build_concurrently(ctx, forges, jobs, wheel, wheels_config, wheel_dir, osk, qemu_port,
+                                                 build_cache, exit_on_failure, child_stats)
+            # the images have been built by the child processes
+            forges = []
+        for forge in forges:
             ran_build = True
+            cache_manager = forge.cache_manager
             # _set_imageset may or may not have already done this
             # TODO: don't run repeatedly
-            try:
-                check_wheel_source(forge.cache_manager, forge.wheel_config)
-            except AssertionError:
-                cache_wheel_sources(forge.cache_manager, forge.wheel_config)
-            build_wheel = False
-            for name in forge.get_expected_names():
-                if exists(join(wheel_dir, name)):
-                    info("%s already built", name)
-                else:
-                    build_wheel = True
-            if build_wheel:
-                if forge.image.type != 'local':
-                    cmd, share, env = _prep_build(ctx.debug, ctx.config, wheels_config, BDIST_WHEEL_CMD_TEMPLATE,
-                                                  forge.image, wheel, wheel_dir)
-                else:
-                    cmd = LOCAL_BDIST_WHEEL_CMD_TEMPLATE.format(
-                        debug='--debug' if ctx.debug else '',
-                        config=ctx.config_file,
-                        wheels_config=wheels_config,
-                        image=forge.image.name,
-                        output=wheel_dir,
-                        name=wheel)
-                    share = None
-                    env = None
-                with forge.exec_context(share=share, env=env) as run:
-                    try:
-                        run(cmd)
-                    except Exception:
-                        failed = True
-                        error("Caught exception while building on image: %s", forge.image.name, exception=True)
-                missing = [n for n in forge.get_expected_names() if not exists(join(wheel_dir, n))]
-                for name in missing:
-                    failed = True
-                    warn("%s missing, build failed?", name)
-                if exit_on_failure and failed:
-                    fatal("Exiting due to previous error(s)")
-            else:
-                info('All wheels from image %s already built', forge.image.name)
+            with trace.span('fetch sources', wheel=wheel):
+                try:
+                    check_wheel_source(forge.cache_manager, forge.wheel_config)
+                except AssertionError:
+                    cache_wheel_sources(forge.cache_manager, forge.wheel_config)
+            if not build_on_image(ctx, forge, wheels_config, wheel_dir, build_cache=build_cache):
+                failed = True
+            if exit_on_failure and failed:
+                fatal("Exiting due to previous error(s)")
         if not ran_build:
             info("Nothing to build: none of the specified images are in the wheel's imageset")
             sys.exit(2)
@@ -129,13 +164,213 @@ def cli(ctx, wheels_config, wheel_dir, osk, sdist, image, docker, qemu, wheel, q
         fatal('Package not found in %s: %s', wheels_config, wheel, exception=True)
     except Exception:
         fatal('Build failed', exception=True)
+    finally:
+        if cache_manager is not None:
+            _save_cache_stats(cache_manager, cache_stats, child_stats)
+        if trace_file:
+            _save_trace(trace_file)
+
+
+def build_on_image(ctx, forge, wheels_config, wheel_dir, build_cache=True):
+    """ Build the wheel of `forge` on its image into `wheel_dir`, unless it is already there or can be restored from
+    the build cache. Sources must already be cached. Returns True if all expected wheels are present afterward.
+    """
+    with trace.span('build', wheel=forge.name, image=forge.image.name):
+        return _build_on_image(ctx, forge, wheels_config, wheel_dir, build_cache=build_cache)
+
+
+def _build_on_image(ctx, forge, wheels_config, wheel_dir, build_cache=True):
+    wheel = forge.name
+    build_wheel = False
+    expected_names = forge.get_expected_names()
+    for name in expected_names:
+        if exists(join(wheel_dir, name)):
+            info("%s already built", name)
+        else:
+            build_wheel = True
+    if not build_wheel:
+        info('All wheels from image %s already built', forge.image.name)
+        return True
+    build_key = None
+    if build_cache:
+        with trace.span('build cache restore'):
+            build_key = forge.build_key()
+            restored = build_key is not None and forge.cache_manager.build_restore(build_key, expected_names, wheel_dir)
+        if build_key is None:
+            info('Not using the build cache for image %s, its contents cannot be identified', forge.image.name)
+        elif restored:
+            info('Restored wheels from image %s from build cache', forge.image.name)
+            return True
+    with trace.span('cache source trees', wheel=wheel):
+        cache_wheel_trees(forge.cache_manager, forge.wheel_config)
+    guest_trace = None
+    guest_probes = None
+    if trace.enabled():
+        guest_trace = GUEST_TRACE_TEMPLATE.format(id=uuid.uuid4().hex)
+    if forge.image.type != 'local':
+        # options of `starforge bdist_wheel` added since the images were built are passed in the environment, which the
+        # Starforge installed in older images ignores, rather than on the command line, which it would reject
+        guest_env = {}
+        if guest_trace is not None:
+            guest_env['STARFORGE_TRACE'] = join(GUEST_HOST, guest_trace)
+        if forge.wheel_config.insert_setuptools is None or forge.wheel_config.install_requires is None:
+            # the build introspects setup.py, the guest cannot store the result in the (read-only) cache
+            guest_probes = GUEST_PROBES_TEMPLATE.format(id=uuid.uuid4().hex)
+            guest_env['STARFORGE_PROBES'] = join(GUEST_HOST, guest_probes)
+            image_id = forge.image_id() if forge.image_id else None
+            if image_id is not None:
+                guest_env['STARFORGE_IMAGE_ID'] = image_id
+        with trace.span('dependency image'):
+            if forge.use_dependency_image():
+                guest_env['STARFORGE_INSTALL_DEPS'] = 'false'
+        cmd, share, env = _prep_build(ctx.debug, ctx.config, wheels_config, BDIST_WHEEL_CMD_TEMPLATE,
+                                      forge.image, wheel, wheel_dir)
+        env.update(guest_env)
+        if forge.image.type == 'docker' and forge.wheel_config.use_ccache(forge.image.name):
+            # persistent per-image compiler cache
+            ccache_dir = image_cache_path(ctx.config.cache_path, 'ccache', forge.image.image)
+            makedirs_exist_ok(ccache_dir)
+            share.append((ccache_dir, GUEST_CCACHE, 'rw'))
+            env['CCACHE_DIR'] = GUEST_CCACHE
+    else:
+        cmd = LOCAL_BDIST_WHEEL_CMD_TEMPLATE.format(
+            debug='--debug' if ctx.debug else '',
+            config=ctx.config_file,
+            wheels_config=wheels_config,
+            image=forge.image.name,
+            output=wheel_dir,
+            args='--trace %s ' % join(wheel_dir, guest_trace) if guest_trace is not None else '',
+            name=wheel)
+        share = None
+        env = None
+    failed = False
+    with forge.exec_context(share=share, env=env) as run:
+        try:
+            with trace.span('guest build'):
+                run(cmd)
+        except Exception:
+            failed = True
+            error("Caught exception while building %s on image: %s", wheel, forge.image.name, exception=True)
+    if guest_probes is not None and exists(join(wheel_dir, guest_probes)):
+        try:
+            forge.cache_manager.import_probes(join(wheel_dir, guest_probes))
+        except (OSError, IOError, ValueError) as exc:
+            warn('Unable to import probe results from guest: %s', exc)
+        unlink(join(wheel_dir, guest_probes))
+    if guest_trace is not None and exists(join(wheel_dir, guest_trace)):
+        trace.merge(join(wheel_dir, guest_trace), 'bdist_wheel %s on %s' % (wheel, forge.image.name))
+        unlink(join(wheel_dir, guest_trace))
+    missing = [n for n in expected_names if not exists(join(wheel_dir, n))]
+    for name in missing:
+        warn("%s missing, build failed?", name)
+    if build_key is not None and not failed and not missing:
+        with trace.span('build cache store'):
+            forge.cache_manager.build_cache(build_key, [join(wheel_dir, n) for n in expected_names])
+    return not failed and not missing
+
+
+def _save_cache_stats(cache_manager, path, child_stats=None):
+    # child processes have already added their own stats to the totals in the cache database
+    stats = cache_manager.save_metrics()
+    for child in child_stats or []:
+        for kind, counters in child.items():
+            totals = stats.setdefault(kind, {})
+            for counter, value in counters.items():
+                totals[counter] = totals.get(counter, 0) + value
+    stats = json.dumps(stats, sort_keys=True)
+    info('Cache stats: %s', stats)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(stats + '\n')
+
+
+def _build_concurrently(ctx, forges, jobs, wheel, wheels_config, wheel_dir, osk, qemu_port, build_cache,
+                        exit_on_failure, child_stats):
+    """ Run `starforge wheel --image` for the image of each of `forges` in a child process, up to `jobs` at a time.
+
+    Child output is prefixed with the image name. If `exit_on_failure` is set, the first failure terminates the other
+    children and no more are started. The cache stats of each child are appended to `child_stats`. Returns True if
+    all builds succeeded.
+    """
+    stop = threading.Event()
+    lock = threading.Lock()
+    procs = {}
+    stats_dir = mkdtemp(prefix='starforge_wheel_stats_')
+
+    def build(item):
+        i, forge = item
+        name = forge.image.name
+        if stop.is_set():
+            return False
+        stats_file = join(stats_dir, '%d.json' % i)
+        cmd = [sys.executable, '-m', 'starforge', '--config-file', ctx.config_file]
+        if ctx.debug:
+            cmd.append('--debug')
+        cmd.extend(['wheel', '--wheels-config', wheels_config, '--wheel-dir', wheel_dir, '--osk', osk,
+                    '--image', name, '--build-cache' if build_cache else '--no-build-cache',
+                    '--cache-stats', stats_file])
+        if qemu_port is not None:
+            cmd.extend(['--qemu-port', qemu_port])
+        trace_file = join(stats_dir, '%d.trace.json' % i)
+        if trace.enabled():
+            cmd.extend(['--trace', trace_file])
+        cmd.append(wheel)
+        info('Starting build on image %s', name)
+        with lock:
+            proc = procs[name] = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+        for line in iter(proc.stdout.readline, b''):
+            click.echo('[%s] %s' % (name, line.decode('utf-8', 'replace').rstrip()), err=True)
+        returncode = proc.wait()
+        with lock:
+            del procs[name]
+        if exists(stats_file):
+            with open(stats_file) as f:
+                child_stats.append(json.load(f))
+        if trace.enabled() and exists(trace_file):
+            trace.merge(trace_file, 'starforge wheel --image %s' % name)
+        if returncode != 0:
+            error('Build on image %s failed with exit code %d', name, returncode)
+            if exit_on_failure:
+                stop.set()
+                with lock:
+                    for other in procs.values():
+                        other.terminate()
+            return False
+        return True
+
+    pool = ThreadPool(min(jobs, len(forges)))
+    try:
+        results = pool.map(build, enumerate(forges))
+    finally:
+        pool.close()
+        pool.join()
+        rmtree(stats_dir)
+    if exit_on_failure and not all(results):
+        fatal("Exiting due to previous error(s)")
+    return all(results)
+
+
+def _replace_file(path, write):
+    """ Replace `path` with the contents written by `write(handle)`, via a temporary file unique to this call, since
+    builds in other threads of this process (`starforge wheels`) and other processes may be writing it concurrently.
+    """
+    fd, tmp = mkstemp(dir=dirname(path), suffix='.tmp')
+    try:
+        with fdopen(fd, 'w') as f:
+            write(f)
+        # mkstemp creates the file 0600, but it is read by build guests
+        chmod(tmp, 0o644)
+        rename(tmp, path)
+    finally:
+        if exists(tmp):
+            unlink(tmp)
 
 
-def _prep_build(debug, global_config, wheels_config, template, image, wheel_name, wheel_dir):
-    # make wheels.yml accessible in guest
-    copy(wheels_config, join(xdg_cache_dir(), 'wheels.yml'))
-    with open(join(xdg_cache_dir(), 'config.yml'), 'w') as f:
-        yaml.dump(global_config.dump_config(), f)
+def _prep_build(debug, global_config, wheels_config, template, image, wheel_name, wheel_dir, args=''):
+    # make wheels.yml accessible in guest, written atomically since concurrent builds may be reading them
+    with open(wheels_config) as src:
+        _replace_file(join(xdg_cache_dir(), 'wheels.yml'), lambda f: copyfileobj(src, f))
+    _replace_file(join(xdg_cache_dir(), 'config.yml'), lambda f: yaml.dump(global_config.dump_config(), f))
     cmd = template.format(
         debug='--debug' if debug else '',
         config=join(GUEST_SHARE, 'galaxy-starforge', 'config.yml'),
@@ -144,6 +379,7 @@ def _prep_build(debug, global_config, wheels_config, template, image, wheel_name
         output=GUEST_HOST,
         uid=getuid(),
         gid=getgid(),
+        args=args,
         name=wheel_name)
     # if buildpy is not just `python` assume starforge is installed
     # along with buildpy and probably isn't on $PATH
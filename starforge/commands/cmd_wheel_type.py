@@ -8,7 +8,6 @@ from ..cache import CacheManager, cache_wheel_sources
 from ..cli import pass_context
 from ..config.wheels import WheelConfigManager
 from ..io import fatal, info
-from ..packaging.setup import PythonSdist
 from ..util import xdg_config_file
 
 
@@ -39,6 +38,5 @@ def cli(ctx, wheels_config, wheel):
     wheel_type = wheel_config.configured_wheel_type
     if wheel_type is None:
         sdist_tarball = cache_wheel_sources(cache_manager, wheel_config)[0]
-        sdist = PythonSdist.open(sdist_tarball)
-        wheel_type = sdist.wheel_type or 'unknown'
+        wheel_type = cache_manager.wheel_type_cache(sdist_tarball) or 'unknown'
     info(wheel_type, bold=None, fg=None, err=False)
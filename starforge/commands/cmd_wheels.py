@@ -0,0 +1,146 @@
+"""
+"""
+from __future__ import absolute_import
+
+from os import getcwd, makedirs
+from os.path import abspath, exists
+
+import click
+
+from .. import trace
+from ..cache import CacheManager, cache_wheel_sources, check_wheel_source
+from ..cli import pass_context
+from ..config.wheels import WheelConfigManager
+from ..forge.wheels import build_forges
+from ..io import error, fatal, info, warn
+from ..scheduler import CycleError, Scheduler, toposort
+from ..util import xdg_config_file
+from .cmd_wheel import _save_cache_stats, _save_trace, build_on_image, trace_option
+
+
+DEFAULT_JOBS = 2
+
+
+@click.command('wheels')
+@click.option('--wheels-config',
+              default=xdg_config_file(name='wheels.yml'),
+              type=click.Path(file_okay=True,
+                              writable=False,
+                              resolve_path=True),
+              help='Path to wheels config file (default: '
+                   '%s)' % xdg_config_file(name='wheels.yml'))
+@click.option('-w', '--wheel-dir',
+              default=getcwd(),
+              type=click.Path(file_okay=False),
+              help='Build wheels in WHEEL-DIR')
+@click.option('--osk',
+              default=xdg_config_file(name='osk.txt'),
+              type=click.Path(dir_okay=True,
+                              writable=False,
+                              resolve_path=False),
+              help='Path file containing OSK, if the guest requires it '
+                   '(default: %s)' % xdg_config_file(name='osk.txt'))
+@click.option('--image',
+              multiple=True,
+              help="Only build on these image(s) (images not in a wheel's imageset are skipped for that wheel)")
+@click.option('-j', '--jobs',
+              default=DEFAULT_JOBS,
+              type=click.INT,
+              help='Number of (wheel, image) builds to run concurrently (default: %d)' % DEFAULT_JOBS)
+@click.option('--exit-on-failure/--no-exit-on-failure',
+              default=False,
+              help='Start no more builds after a build fails (by default, Starforge builds everything that does not '
+                   'depend on a failed build)')
+@click.option('--build-cache/--no-build-cache',
+              default=True,
+              help='Restore wheels from the build cache if they have previously been built from the same sources, '
+                   'config, and image, and add newly built wheels to it (Docker images only)')
+@click.option('--cache-stats',
+              default=None,
+              type=click.Path(dir_okay=False, writable=True),
+              help='Write cache hit/miss, transfer, and timing stats for this run to CACHE-STATS as JSON')
+@trace_option
+@click.argument('wheels', nargs=-1)
+@pass_context
+def cli(ctx, wheels_config, wheel_dir, osk, image, jobs, exit_on_failure, build_cache, cache_stats, trace_file, wheels):
+    """ Build all wheels (or WHEELS) in the wheels config.
+
+    Wheels named in the `setup_requires`, `install_requires` or `pip_install`
+    of another wheel in the same run are built first (on each image, before
+    that wheel is built on the same image), other builds run concurrently.
+    """
+    wheel_config_manager = WheelConfigManager.open(ctx.config, wheels_config)
+    cache_manager = CacheManager(ctx.config.cache_path, remote=ctx.config.remote_cache)
+    wheel_dir = abspath(wheel_dir)
+    if not exists(wheel_dir):
+        makedirs(wheel_dir)
+    for name in wheels:
+        if name not in wheel_config_manager:
+            fatal('Package not found in %s: %s', wheels_config, name)
+    graph = wheel_config_manager.dependency_graph(wheels or None)
+    try:
+        order = toposort(graph)
+    except CycleError as exc:
+        fatal('Unable to order builds: %s', exc)
+    if trace_file:
+        trace.enable()
+    try:
+        with trace.span('fetch sources'):
+            _prefetch(cache_manager, [wheel_config_manager.get_wheel_config(name) for name in order])
+        forges = {}
+        for name in order:
+            for forge in build_forges(ctx.config, wheels_config, name, images=image, osk_file=osk,
+                                      wheel_config_manager=wheel_config_manager, cache_manager=cache_manager):
+                forges[(name, forge.image.name)] = forge
+        deps = job_dependencies(graph, forges)
+        info('Building %d wheels (%d builds), %d at a time', len(order), len(forges), jobs)
+        scheduler = Scheduler(jobs=jobs, stop_on_failure=exit_on_failure)
+        results = scheduler.run(
+            lambda job: build_on_image(ctx, forges[job], wheels_config, wheel_dir, build_cache=build_cache), deps)
+    finally:
+        _save_cache_stats(cache_manager, cache_stats)
+        if trace_file:
+            _save_trace(trace_file)
+    for (name, image_name), result in results.items():
+        if result is False:
+            error('Failed: %s on %s', name, image_name)
+        elif result is None:
+            warn('Skipped: %s on %s (due to an earlier failure)', name, image_name)
+    if not all(results.values()):
+        fatal('%d of %d builds failed or were skipped', len([r for r in results.values() if not r]), len(results))
+    info('Build OK')
+
+
+def job_dependencies(graph, jobs):
+    """ Return a dict of each (wheel, image) in `jobs` to the set of jobs it depends on, given `graph`, a dict of wheel
+    to the set of wheels it depends on.
+
+    A build only needs the wheels of its dependencies for the same image, or if a dependency is not built on that image
+    (e.g. it is purepy, built on a purepy image), all of its wheels.
+    """
+    deps = {}
+    for name, image_name in jobs:
+        deps[(name, image_name)] = set()
+        for dep in graph[name]:
+            if (dep, image_name) in jobs:
+                deps[(name, image_name)].add((dep, image_name))
+            else:
+                deps[(name, image_name)].update(dep_job for dep_job in jobs if dep_job[0] == dep)
+    return deps
+
+
+def _prefetch(cache_manager, wheel_configs):
+    """ Fetch the sources of all `wheel_configs` concurrently, falling back to pip for sdists not found on the index.
+    """
+    cache_manager.pip_cache_many([(wheel_config.name, wheel_config.version) for wheel_config in wheel_configs])
+    urls = []
+    digests = {}
+    for wheel_config in wheel_configs:
+        urls.extend(wheel_config.sources)
+        digests.update(wheel_config.source_digests)
+    cache_manager.url_cache_many(urls, digests=digests)
+    for wheel_config in wheel_configs:
+        try:
+            check_wheel_source(cache_manager, wheel_config)
+        except AssertionError:
+            cache_wheel_sources(cache_manager, wheel_config)
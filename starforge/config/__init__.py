@@ -10,7 +10,7 @@ except ImportError:
 import yaml
 from six import iteritems
 
-from ..util import dict_merge, xdg_cache_dir
+from ..util import dict_merge, parse_size, xdg_cache_dir
 
 
 DEFAULT_CONFIG_FILE = abspath(join(dirname(__file__), 'default.yml'))
@@ -23,6 +23,9 @@ DEFAULT_IMAGE_PYTHONS = [
     '/python/cp35m-{arch}/bin/python',
     '/python/cp36m-{arch}/bin/python',
 ]
+# config sections used only on the host, which are omitted from the config passed to build guests since they may
+# contain credentials
+HOST_ONLY_CONFIG = ('remote_cache',)
 
 
 class Image(object):
@@ -43,6 +46,7 @@ class Image(object):
         self.postbuild = image.get('postbuild', None)
         self.use_auditwheel = image.get('use_auditwheel', False)
         self.use_delocate = image.get('use_delocate', False)
+        self.ccache = image.get('ccache', False)
         self.insert_osk = image.get('insert_osk', False)
         self.snap_root = image.get('snap_root', None) and expanduser(image['snap_root'])
         self.snap_src = image.get('snap_src', None)
@@ -71,8 +75,11 @@ class ConfigManager(object):
     def __init__(self, config_file=None):
         self.config_file = config_file
         self.cache_path = xdg_cache_dir()
+        self.cache_max_bytes = None
         self.docker = {}
         self.qemu = {}
+        self.index = {}
+        self.remote_cache = {}
         self.images = {}
         self.imagesets = {}
         self.load_config()
@@ -95,9 +102,18 @@ class ConfigManager(object):
         if 'qemu' in config:
             self.qemu = config['qemu']
 
+        if 'index' in config:
+            self.index = config['index']
+
+        if 'remote_cache' in config:
+            self.remote_cache = config['remote_cache']
+
         if 'cache_path' in config:
             self.cache_path = abspath(expanduser(config['cache_path']))
 
+        if 'cache_max_bytes' in config:
+            self.cache_max_bytes = parse_size(config['cache_max_bytes'])
+
         if 'images' in config:
             for (name, image) in iteritems(config['images']):
                 self.images[name] = Image(name, image)
@@ -109,7 +125,9 @@ class ConfigManager(object):
         self.config = config
 
     def dump_config(self):
-        return self.config
+        """ Return the config for build guests, without the `HOST_ONLY_CONFIG` sections.
+        """
+        return dict((k, v) for k, v in iteritems(self.config) if k not in HOST_ONLY_CONFIG)
 
     def make_imageset(self, name, image_names):
         return Imageset(name, image_names, self.images)
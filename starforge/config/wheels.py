@@ -3,6 +3,9 @@ Read wheel forging config
 """
 from __future__ import absolute_import
 
+import re
+from multiprocessing import cpu_count
+
 try:
     from collections import OrderedDict
 except ImportError:
@@ -11,15 +14,16 @@ except ImportError:
 import yaml
 from six import iteritems, string_types
 
-from ..cache import cache_wheel_sources
+from ..cache import cache_wheel_sources, normalize_name
 from ..io import debug, info, fatal
-from ..packaging.setup import PythonSdist
 
 
 DEFAULT_IMAGESET = 'default-wheel'
 DEFAULT_PUREPY_IMAGESET = 'purepy-wheel'
 DEFAULT_UNIVERSAL_IMAGESET = 'universal-wheel'
 DEFAULT_CONFIG_FILE = 'wheels.yml'
+# the project name at the start of a requirement specifier, e.g. `numpy` in `numpy>=1.9`
+REQUIREMENT_NAME_RE = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)')
 
 # FIXME: dedup
 UNIVERSAL = 'universal'
@@ -37,11 +41,22 @@ class WheelConfig(object):
         if purepy is False and universal is True:
             fatal("ERROR: Wheel '%s' set purepy = False, universal = True, which is impossible")
         self.name = name
+        self.global_config = global_config
         self.config = config
         self.purepy = purepy if purepy is not None else universal
         self.universal = universal
         self.version = str(config['version'])
-        self.sources = config.get('src', [])
+        self.sources = []
+        self.source_digests = {}
+        for src in config.get('src', []):
+            # entries are either a URL or a dict with `url` and an optional `sha256` pin
+            if isinstance(src, dict):
+                url = src['url']
+                if 'sha256' in src:
+                    self.source_digests[url] = src['sha256']
+            else:
+                url = src
+            self.sources.append(url)
         self.setup_requires = config.get('setup_requires', [])
         self.install_requires = config.get('install_requires', None)
         self.pip_install = config.get('pip_install', [])
@@ -49,11 +64,21 @@ class WheelConfig(object):
         self.insert_setuptools = config.get('insert_setuptools', None)
         self.force_pythons = config.get('force_pythons', None)
         self.build_args = config.get('build_args', 'bdist_wheel')
+        # number of interpreters to build for concurrently, each in its own copy of the source tree, or `auto` for the
+        # number of CPUs
+        self.build_jobs = config.get('build_jobs', 1)
+        if self.build_jobs == 'auto':
+            self.build_jobs = cpu_count()
+        elif isinstance(self.build_jobs, bool) or not isinstance(self.build_jobs, int) or self.build_jobs < 1:
+            fatal("ERROR: Wheel '%s' set build_jobs = %r, which must be a positive integer or 'auto'", name,
+                  self.build_jobs)
         self.buildpy = config.get('buildpy', 'python')
         self.buildenv = config.get('buildenv', {})
         self.skip_tests = config.get('skip_tests', [])
         self.auditwheel_args = config.get('auditwheel_args', None)
         self.delocate_args = config.get('delocate_args', None)
+        # overrides `ccache` of the image if set
+        self.ccache = config.get('ccache', None)
         self.imagesets = imagesets
         self.configured_imageset = config.get('imageset')
         self.configured_wheel_type = None
@@ -73,8 +98,7 @@ class WheelConfig(object):
         # TODO: probably refactor this
         if wheel_type is None:
             sdist_tarball = cache_wheel_sources(cache_manager, self)[0]
-            sdist = PythonSdist.open(sdist_tarball)
-            wheel_type = sdist.wheel_type
+            wheel_type = cache_manager.wheel_type_cache(sdist_tarball)
             debug("Detected wheel type: %s", wheel_type)
         assert wheel_type is not None, \
             "Unable to determine wheel type of '%s', set `purepy`, `universal`, and/or `imageset` in wheel config" \
@@ -122,6 +146,24 @@ class WheelConfig(object):
     def get_image(self, name):
         return self.images[name]
 
+    def requirement_names(self):
+        """ Return the set of normalized names of the packages required to build this wheel: those in
+        `setup_requires`, `install_requires` and `pip_install`.
+        """
+        names = set()
+        for requirement in self.setup_requires + (self.install_requires or []) + self.pip_install:
+            match = REQUIREMENT_NAME_RE.match(requirement)
+            if match and '://' not in requirement:
+                names.add(normalize_name(match.group(1)))
+        return names
+
+    def use_ccache(self, image):
+        """ Return True if C extensions should be compiled with ccache on `image`.
+        """
+        if self.ccache is not None:
+            return self.ccache
+        return image is not None and self.images[image].ccache
+
     def get_dependencies(self, image):
         if image is None:
             return []
@@ -170,6 +212,18 @@ class WheelConfigManager(object):
     def get_wheel_images(self, name):
         return self.get_wheel_config(name).get_images()
 
+    def dependency_graph(self, names=None):
+        """ Return an OrderedDict of each wheel in `names` (default: all wheels) to the set of wheels in `names` that
+        must be built before it, because they are required to build it.
+        """
+        names = list(names or self.wheels)
+        normalized = dict((normalize_name(name), name) for name in names)
+        graph = OrderedDict()
+        for name in names:
+            requirements = self.wheels[name].requirement_names()
+            graph[name] = set(normalized[r] for r in requirements if r in normalized and normalized[r] != name)
+        return graph
+
     def __iter__(self):
         for name, wheel in iteritems(self.wheels):
             yield name, wheel
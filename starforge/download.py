@@ -0,0 +1,195 @@
+"""
+Parallel, resumable downloads over pooled connections
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import re
+import threading
+from multiprocessing.pool import ThreadPool
+from os import fstat, makedirs, unlink
+from os.path import exists, join
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .io import debug, info, warn
+
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_JOBS = 8
+DEFAULT_TIMEOUT = 60
+CONTENT_RANGE_RE = re.compile(r'^bytes\s+(\d+)-\d+/(?:\d+|\*)$')
+
+
+class DownloadResult(object):
+    def __init__(self, url, path, digest, size):
+        self.url = url
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+
+class Downloader(object):
+    """ Fetch URLs into partial files under `partial_path`, hashing them (sha256) as they are written.
+
+    One `requests.Session` (and so one connection pool) is shared per host. Partial files are named for the URL and
+    locked while in use, so an interrupted transfer is resumed with an HTTP Range request by the next attempt, from any
+    process. Completed files must be moved to their final location by the caller (see `BlobStore.add`), so a partial
+    file never looks like a cache hit.
+    """
+    def __init__(self, partial_path, jobs=DEFAULT_JOBS, chunk_size=CHUNK_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.partial_path = partial_path
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        with self.lock:
+            if key not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.jobs)
+                session.mount(parsed.scheme + '://', adapter)
+                self.sessions[key] = session
+            return self.sessions[key]
+
+    def partial(self, url):
+        return join(self.partial_path, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def fetch(self, url, complete=None, cached=None):
+        """ Download `url`, resuming a previous partial download if there is one, and return a `DownloadResult`.
+
+        If set, `complete` is called with the `DownloadResult` while the partial file is still locked, and should move
+        the file to its final location. If it raises an exception, the partial file is discarded.
+
+        If set, `cached` is called once the partial file is locked, and should return True if `url` has been cached in
+        the meantime (e.g. by another process that held the lock), in which case nothing is downloaded and None is
+        returned.
+        """
+        if not exists(self.partial_path):
+            try:
+                makedirs(self.partial_path)
+            except OSError:
+                if not exists(self.partial_path):
+                    raise
+        path = self.partial(url)
+        while True:
+            handle = open(path, 'ab+')
+            if fcntl is not None:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            if fstat(handle.fileno()).st_nlink == 0:
+                # another process completed the download and moved the partial file while we waited for the lock
+                handle.close()
+                continue
+            break
+        try:
+            if cached is not None and cached():
+                debug('Already cached while waiting for the download lock: %s', url)
+                self._discard(path)
+                return None
+            result = self._fetch(url, path, handle)
+            if complete is not None:
+                try:
+                    complete(result)
+                except Exception:
+                    self._discard(path)
+                    raise
+            return result
+        finally:
+            handle.close()
+
+    def _discard(self, path):
+        for discard in (path, path + '.json'):
+            if exists(discard):
+                unlink(discard)
+
+    def _fetch(self, url, path, handle):
+        sha = hashlib.sha256()
+        meta_path = path + '.json'
+        headers = {}
+        handle.seek(0, 2)
+        offset = handle.tell()
+        if offset:
+            meta = self._read_meta(meta_path)
+            headers['Range'] = 'bytes=%d-' % offset
+            if meta.get('etag') or meta.get('last_modified'):
+                headers['If-Range'] = meta.get('etag') or meta['last_modified']
+        r = self.session(url).get(url, stream=True, headers=headers, timeout=self.timeout)
+        try:
+            resumed = offset and r.status_code == 206 and self._range_start(r) == offset
+            if offset and not resumed and r.status_code in (206, 416):
+                # a 416 means our partial file is not a prefix of what the server has, and a 206 that does not start
+                # at our offset would corrupt it, start over
+                if r.status_code == 206:
+                    warn('Server returned Content-Range %s for %s, expected a range starting at byte %d, restarting '
+                         'download', r.headers.get('Content-Range'), url, offset)
+                r.close()
+                r = self.session(url).get(url, stream=True, timeout=self.timeout)
+            if resumed:
+                info('Resuming download of %s at byte %d', url, offset)
+                handle.seek(0)
+                for chunk in iter(lambda: handle.read(self.chunk_size), b''):
+                    sha.update(chunk)
+            else:
+                r.raise_for_status()
+                offset = 0
+                handle.seek(0)
+                handle.truncate()
+            self._write_meta(meta_path, r)
+            size = offset
+            for chunk in r.iter_content(chunk_size=self.chunk_size):
+                sha.update(chunk)
+                handle.write(chunk)
+                size += len(chunk)
+            handle.flush()
+        finally:
+            r.close()
+        if exists(meta_path):
+            unlink(meta_path)
+        debug('Downloaded %s (%d bytes) to %s', url, size, path)
+        return DownloadResult(url, path, sha.hexdigest(), size)
+
+    def _range_start(self, r):
+        """ Return the first byte position of the Content-Range of response `r`, or None if it is missing or invalid.
+        """
+        match = CONTENT_RANGE_RE.match(r.headers.get('Content-Range', '').strip())
+        return int(match.group(1)) if match else None
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path) as handle:
+                return json.load(handle)
+        except (OSError, IOError, ValueError):
+            return {}
+
+    def _write_meta(self, meta_path, r):
+        meta = {'etag': r.headers.get('ETag'), 'last_modified': r.headers.get('Last-Modified')}
+        with open(meta_path, 'w') as handle:
+            json.dump(meta, handle)
+
+    def map(self, func, items):
+        """ Apply `func` to `items` in a pool of `jobs` threads and return the results in order.
+        """
+        items = list(items)
+        if len(items) < 2 or self.jobs < 2:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self.jobs, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
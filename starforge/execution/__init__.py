@@ -11,6 +11,8 @@ from six import (
     with_metaclass
 )
 
+from .. import trace
+
 
 class ExecutionContext(with_metaclass(ABCMeta, object)):
     def __init__(self, image, **kwargs):
@@ -21,13 +23,32 @@ class ExecutionContext(with_metaclass(ABCMeta, object)):
             cmd = shlex.split(cmd)
         return cmd
 
+    def image_id(self):
+        """ Return an identifier of the exact image contents, if the execution context can determine one.
+        """
+        return None
+
+    def image_metadata(self):
+        """ Return a dict of metadata stored in the image, e.g. the `platform` and `pyversion` that would otherwise be
+        probed by running it, if the execution context can read it without running the image.
+        """
+        return {}
+
+    def use_dependency_image(self, pkgs, pkgtool):
+        """ Run commands in an image with the system packages `pkgs` already installed with `pkgtool`, if the execution
+        context supports it. Returns True if so.
+        """
+        return False
+
     @contextmanager
     def run_context(self, **kwargs):
-        self.start(**kwargs)
+        with trace.span('start', cat='execution', image=self.image.name):
+            self.start(**kwargs)
         try:
             yield self.run
         finally:
-            self.destroy()
+            with trace.span('destroy', cat='execution', image=self.image.name):
+                self.destroy()
 
     @abstractmethod
     def start(self, **kwargs):
@@ -2,8 +2,16 @@
 """
 from __future__ import absolute_import
 
-from os import unlink
+import calendar
+import hashlib
+import json
+import threading
+import time
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
 from subprocess import (
+    CalledProcessError,
     check_call,
     check_output
 )
@@ -11,21 +19,239 @@ from subprocess import (
 from six import iteritems
 
 from . import ExecutionContext
-from ..io import info
-from ..util import stringify_cmd
+from .. import trace
+from ..io import debug, info, warn
+from ..util import image_cache_path, locked_file, makedirs_exist_ok, stringify_cmd
+
+
+# labels with this prefix are read by image_metadata(), e.g. `org.galaxyproject.starforge.platform`
+METADATA_LABEL_PREFIX = 'org.galaxyproject.starforge.'
+DEPENDENCY_IMAGE_REPO = 'starforge-deps'
+DEPENDENCY_IMAGE_LABEL = 'org.galaxyproject.starforge.deps'
+# run with the packages as arguments, apt multiarch installs i386 packages on 32-bit images with a 64-bit libdir, as
+# in ForgeWheel.bdist_wheel()
+DEPENDENCY_INSTALL_SCRIPTS = {
+    'apt': ('if [ "$(uname -m)" = i686 ] && [ -d /usr/lib/x86_64-linux-gnu ]; then '
+            'for pkg; do shift; set -- "$@" "$pkg:i386"; done; fi; '
+            'export DEBIAN_FRONTEND=noninteractive; '
+            'apt-get -qq update && apt-get install --no-install-recommends -y "$@"'),
+    'yum': 'yum install -y ${STARFORGE_PACKAGE_CACHE_LOCK:+--setopt=keepcache=1} "$@"',
+    'zypper': 'if [ -n "$STARFORGE_PACKAGE_CACHE_LOCK" ]; then zypper -n mr -k -a; fi; zypper -n in "$@"',
+}
+# package tool cache directories in the guest, mounted from `package_caches/<image>/<name>` in the cache when
+# `docker.package_cache` is enabled
+PACKAGE_CACHE_DIRS = {
+    'apt': (('archives', '/var/cache/apt/archives'), ('lists', '/var/lib/apt/lists')),
+    'yum': (('yum', '/var/cache/yum'),),
+    'zypper': (('zypp', '/var/cache/zypp'),),
+}
+# the official Debian and Ubuntu images delete downloaded packages after installation, this is replaced with an empty
+# file when the package cache is mounted
+APT_DOCKER_CLEAN = '/etc/apt/apt.conf.d/docker-clean'
+# guests hold this lock while using the package cache, since yum and zypper do not lock their caches
+PACKAGE_CACHE_LOCK_ENV = 'STARFORGE_PACKAGE_CACHE_LOCK'
+GUEST_PACKAGE_CACHE_LOCK = '/var/run/starforge-package-cache.lock'
+
+# concurrent builds in the same process that need the same dependency image build it once
+_dependency_image_locks = {}
+_dependency_image_locks_lock = threading.Lock()
+
+
+def dependency_image_tag(base_id, pkgs, pkgtool):
+    """ Return the tag of the image derived from base image `base_id` with `pkgs` installed with `pkgtool`.
+    """
+    key = json.dumps({'base_id': base_id, 'packages': sorted(set(pkgs)), 'pkgtool': pkgtool}, sort_keys=True)
+    return '%s:%s' % (DEPENDENCY_IMAGE_REPO, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def _dependency_image_lock(tag):
+    with _dependency_image_locks_lock:
+        return _dependency_image_locks.setdefault(tag, threading.Lock())
+
+
+def _docker_cmd(args, use_sudo=False):
+    cmd = ['docker'] + args
+    if use_sudo:
+        cmd = ['sudo'] + cmd
+    return cmd
+
+
+def _inspect_image_id(image, use_sudo=False):
+    try:
+        return check_output(_docker_cmd(['image', 'inspect', '--format', '{{.Id}}', image], use_sudo)).decode('utf-8').strip()
+    except CalledProcessError:
+        return None
+
+
+def gc_dependency_images(docker_config, older_than=None, remove_all=False):
+    """ Remove stale dependency images: those whose base image has since been updated or removed, those created before
+    the time `older_than` (if set), or all of them if `remove_all` is set.
+
+    Returns a list of the tags of removed images. Images still in use by a container are not removed.
+    """
+    use_sudo = docker_config.get('use_sudo', False)
+    tags = check_output(_docker_cmd(['image', 'ls', '--filter', 'dangling=false', '--filter', 'label=%s.base_id' % DEPENDENCY_IMAGE_LABEL,
+                                     '--format', '{{.Repository}}:{{.Tag}}'], use_sudo)).decode('utf-8').split()
+    if not tags:
+        return []
+    base_ids = {}
+    removed = []
+    for image in json.loads(check_output(_docker_cmd(['image', 'inspect'] + tags, use_sudo)).decode('utf-8')):
+        labels = image['Config'].get('Labels') or {}
+        base = labels.get('%s.base_image' % DEPENDENCY_IMAGE_LABEL)
+        if base not in base_ids:
+            base_ids[base] = _inspect_image_id(base, use_sudo) if base else None
+        # e.g. 2018-03-01T12:34:56.123456789Z
+        created = calendar.timegm(time.strptime(image['Created'][:19], '%Y-%m-%dT%H:%M:%S'))
+        if remove_all:
+            reason = 'all'
+        elif base_ids[base] != labels.get('%s.base_id' % DEPENDENCY_IMAGE_LABEL):
+            reason = 'base image %s updated or removed' % base
+        elif older_than is not None and created < older_than:
+            reason = 'created %s' % image['Created']
+        else:
+            continue
+        for tag in image.get('RepoTags') or []:
+            if not tag.startswith(DEPENDENCY_IMAGE_REPO + ':'):
+                continue
+            info('Removing dependency image %s (%s)', tag, reason)
+            try:
+                check_call(_docker_cmd(['rmi', tag], use_sudo))
+                removed.append(tag)
+            except CalledProcessError:
+                warn('Unable to remove dependency image (in use?): %s', tag)
+    return removed
 
 
 class DockerExecutionContext(ExecutionContext):
-    def __init__(self, image, docker_config=None, **kwargs):
+    def __init__(self, image, docker_config=None, cache_path=None, **kwargs):
         self.image = image
         self.docker_config = docker_config
+        self.cache_path = cache_path
         self.use_sudo = docker_config.get('use_sudo', False)
+        self.session = docker_config.get('session', False)
         self.share_args = []
         self.env = {}
         self.container_ids = []
         self.image_ids = []
+        self.session_id = None
+        # ENTRYPOINT of the image, which `docker exec` does not run, so it is prepended to commands run in a session
+        self.entrypoint = []
+        # set to the dependency image, if any, that commands are run in instead of the configured image
+        self.run_image = None
+        self.metadata = None
+
+    def image_id(self):
+        image_id = _inspect_image_id(self.image.image, self.use_sudo)
+        if image_id is None:
+            warn('Unable to determine ID of image: %s', self.image.image)
+        return image_id
+
+    def image_metadata(self):
+        """ Return the labels of the image starting with METADATA_LABEL_PREFIX, with the prefix removed. Set them with
+        e.g. `LABEL org.galaxyproject.starforge.platform=manylinux1_x86_64` in the image's Dockerfile.
+        """
+        if self.metadata is None:
+            self.metadata = {}
+            try:
+                labels = json.loads(check_output(self._docker(
+                    ['image', 'inspect', '--format', '{{json .Config.Labels}}', self.image.image])).decode('utf-8'))
+            except (CalledProcessError, ValueError):
+                debug('Unable to read labels of image: %s', self.image.image)
+                labels = None
+            for k, v in iteritems(labels or {}):
+                if k.startswith(METADATA_LABEL_PREFIX):
+                    self.metadata[k[len(METADATA_LABEL_PREFIX):]] = v
+        return self.metadata
+
+    def use_dependency_image(self, pkgs, pkgtool):
+        """ Run commands in an image derived from the configured image with `pkgs` installed, building it if it does
+        not exist.
+
+        Dependency images are tagged with a hash of the base image ID, package list and package tool, so they are
+        reused by all builds with the same dependencies, and not reused once the base image is updated.
+        """
+        if not self.docker_config.get('dependency_images', False) or pkgtool not in DEPENDENCY_INSTALL_SCRIPTS:
+            return False
+        base_id = self.image_id()
+        if base_id is None:
+            return False
+        tag = dependency_image_tag(base_id, pkgs, pkgtool)
+        with _dependency_image_lock(tag):
+            if _inspect_image_id(tag, self.use_sudo) is not None:
+                info('Using dependency image %s for %s: %s', tag, self.image.image, ', '.join(pkgs))
+            else:
+                try:
+                    with trace.span('build dependency image', cat='execution', image=self.image.image,
+                                    packages=' '.join(pkgs)):
+                        self._build_dependency_image(tag, base_id, pkgs, pkgtool)
+                except CalledProcessError:
+                    warn('Failed to build dependency image for %s, dependencies will be installed during the build',
+                         self.image.image)
+                    return False
+        self.run_image = tag
+        return True
+
+    def _build_dependency_image(self, tag, base_id, pkgs, pkgtool):
+        info('Building dependency image %s for %s: %s', tag, self.image.image, ', '.join(pkgs))
+        cid_dir = mkdtemp(prefix='starforge_cid_')
+        cidfile = join(cid_dir, 'cid')
+        container_id = None
+        try:
+            run_cmd = self._docker(['run', '--cidfile', cidfile] + self._package_cache_args() +
+                                   [self.image.image, 'sh', '-c', DEPENDENCY_INSTALL_SCRIPTS[pkgtool],
+                                    DEPENDENCY_IMAGE_REPO] + sorted(set(pkgs)))
+            info('Running docker: %s', stringify_cmd(run_cmd))
+            try:
+                path = self.package_cache_path()
+                if path is not None:
+                    with locked_file(join(path, 'lock')):
+                        check_call(run_cmd)
+                else:
+                    check_call(run_cmd)
+            finally:
+                if exists(cidfile):
+                    container_id = open(cidfile).read().strip()
+            labels = {'base_image': self.image.image, 'base_id': base_id, 'pkgtool': pkgtool,
+                      'packages': ' '.join(sorted(set(pkgs)))}
+            commit_cmd = ['commit']
+            for k, v in sorted(labels.items()):
+                commit_cmd.extend(['--change', 'LABEL %s.%s="%s"' % (DEPENDENCY_IMAGE_LABEL, k, v)])
+            check_output(self._docker(commit_cmd + [container_id, tag]))
+        finally:
+            if container_id is not None:
+                check_call(self._docker(['rm', '-v', container_id]))
+            rmtree(cid_dir)
+        debug('Built dependency image: %s', tag)
+
+    def package_cache_path(self):
+        """ Return the host directory of this image's package tool cache, or None if package caching is disabled.
+        """
+        if (not self.docker_config.get('package_cache', False) or self.cache_path is None or
+                self.image.pkgtool not in PACKAGE_CACHE_DIRS):
+            return None
+        return image_cache_path(self.cache_path, 'package_caches', self.image.image)
+
+    def _package_cache_args(self):
+        """ Return the `docker run` arguments that mount this image's package tool cache, creating it if necessary.
+        """
+        path = self.package_cache_path()
+        if path is None:
+            return []
+        args = []
+        for name, guest in PACKAGE_CACHE_DIRS[self.image.pkgtool]:
+            makedirs_exist_ok(join(path, name, 'partial') if self.image.pkgtool == 'apt' else join(path, name))
+            args.append('--volume={host}:{guest}:rw'.format(host=join(path, name), guest=guest))
+        if self.image.pkgtool == 'apt':
+            open(join(path, 'docker-clean'), 'a').close()
+            args.append('--volume={host}:{guest}:ro'.format(host=join(path, 'docker-clean'), guest=APT_DOCKER_CLEAN))
+        open(join(path, 'lock'), 'a').close()
+        args.append('--volume={host}:{guest}:rw'.format(host=join(path, 'lock'), guest=GUEST_PACKAGE_CACHE_LOCK))
+        args.append('--env={k}={v}'.format(k=PACKAGE_CACHE_LOCK_ENV, v=GUEST_PACKAGE_CACHE_LOCK))
+        return args
 
     def start(self, share=None, env=None, **kwargs):
+        self.share_args.extend(self._package_cache_args())
         if share is not None:
             for host, guest, read in share:
                 self.share_args.append(
@@ -35,14 +261,53 @@ class DockerExecutionContext(ExecutionContext):
         if env is not None:
             self.env = env
 
+    def _docker(self, args):
+        return _docker_cmd(args, self.use_sudo)
+
+    def _env_args(self):
+        return ['--env={k}={v}'.format(k=k, v=v) for (k, v) in iteritems(self.env)]
+
+    def _image_entrypoint(self, image):
+        """ Return the ENTRYPOINT of `image` (e.g. `linux32` on the i686 images) as a list.
+        """
+        out = check_output(self._docker(['image', 'inspect', '--format', '{{json .Config.Entrypoint}}', image]))
+        return json.loads(out.decode('utf-8')) or []
+
+    def _start_session(self):
+        """ Start a long-lived container for the session: `cat` with stdin held open waits forever without using CPU.
+        """
+        image = self.run_image or self.image.image
+        self.entrypoint = self._image_entrypoint(image)
+        run_cmd = self._docker(['run', '--detach', '--interactive', '--entrypoint', 'cat'] + self.share_args +
+                               self._env_args() + [image])
+        info('Starting docker session: %s', stringify_cmd(run_cmd))
+        with trace.span('docker session start', cat='execution', image=self.image.image):
+            self.session_id = check_output(run_cmd).decode('utf-8').strip()
+
+    def _exec(self, cmd, capture_output=False):
+        if self.session_id is None:
+            self._start_session()
+        exec_cmd = self._docker(['exec'] + self._env_args() + [self.session_id] + self.entrypoint + cmd)
+        info('Running docker: %s', stringify_cmd(exec_cmd))
+        with trace.span('docker exec', cat='execution', cmd=stringify_cmd(cmd)):
+            if capture_output:
+                return check_output(exec_cmd)
+            check_call(exec_cmd)
+
     def run(self, cmd, capture_output=False, **kwargs):
-        image = self.image.image
+        if self.session:
+            return self._exec(self.normalize_cmd(cmd), capture_output=capture_output)
+        image = self.run_image or self.image.image
         if self.container_ids:
             image = ':'.join([image.split(':')[0], self.container_ids[-1]])
             check_call(['docker', 'commit', self.container_ids[-1], image])
             self.image_ids.append(image)
         cmd = self.normalize_cmd(cmd)
-        run_cmd = 'docker run --cidfile __cid.txt'.split()
+        # unique per run so that concurrent builds in the same directory do not collide, docker requires that the
+        # cidfile not exist
+        cid_dir = mkdtemp(prefix='starforge_cid_')
+        cidfile = join(cid_dir, 'cid')
+        run_cmd = ['docker', 'run', '--cidfile', cidfile]
         run_cmd.extend(self.share_args)
         for (k, v) in iteritems(self.env):
             run_cmd.append('--env={k}={v}'.format(k=k, v=v))
@@ -52,15 +317,23 @@ class DockerExecutionContext(ExecutionContext):
             run_cmd = ['sudo'] + run_cmd
         info('Running docker: %s', stringify_cmd(run_cmd))
         output = None
-        if capture_output:
-            output = check_output(run_cmd)
-        else:
-            check_call(run_cmd)
-        self.container_ids.append(open('__cid.txt').read().strip())
-        unlink('__cid.txt')
+        try:
+            with trace.span('docker run', cat='execution', cmd=stringify_cmd(cmd)):
+                if capture_output:
+                    output = check_output(run_cmd)
+                else:
+                    check_call(run_cmd)
+        finally:
+            # record the container even if the command failed so that it is removed by destroy()
+            if exists(cidfile):
+                self.container_ids.append(open(cidfile).read().strip())
+            rmtree(cid_dir)
         return output
 
     def destroy(self, **kwargs):
+        if self.session_id is not None:
+            check_call(self._docker(['rm', '--force', '--volumes', self.session_id]))
+            self.session_id = None
         for i in self.container_ids:
             check_call(['docker', 'rm', '-v', i])
         for i in self.image_ids:
@@ -8,6 +8,7 @@ from subprocess import (
 )
 
 from . import ExecutionContext
+from .. import trace
 from ..io import info
 from ..util import stringify_cmd
 
@@ -19,13 +20,14 @@ class LocalExecutionContext(ExecutionContext):
     def start(self, **kwargs):
         pass
 
-    def run(self, cmd, cwd=None, capture_output=False, **kwargs):
+    def run(self, cmd, cwd=None, capture_output=False, env=None, **kwargs):
         cmd = self.normalize_cmd(cmd)
         info('Running local: %s', stringify_cmd(cmd))
-        if capture_output:
-            return check_output(cmd, cwd=cwd)
-        else:
-            check_call(cmd, cwd=cwd)
+        with trace.span('local run', cat='execution', cmd=stringify_cmd(cmd)):
+            if capture_output:
+                return check_output(cmd, cwd=cwd, env=env)
+            else:
+                check_call(cmd, cwd=cwd, env=env)
 
     def destroy(self, **kwargs):
         pass
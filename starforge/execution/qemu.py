@@ -304,7 +304,7 @@ class QEMUExecutionContext(ExecutionContext):
         if env is not None:
             with tempfile.NamedTemporaryFile() as envfile:
                 for (k, v) in iteritems(env):
-                    envfile.write(b('{k}={v}'.format(k=k, v=v)))
+                    envfile.write(b('{k}={v}\n'.format(k=k, v=v)))
                 envfile.flush()
                 self._scp('{f} {userhost}:.ssh/environment'
                           .format(f=envfile.name,
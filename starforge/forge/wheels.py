@@ -3,9 +3,16 @@ Forge wheels
 """
 from __future__ import absolute_import
 
+import hashlib
+import json
 import os
+import re
 import shlex
 import subprocess
+import time
+from distutils.spawn import find_executable
+from glob import glob
+from multiprocessing import cpu_count
 from os import (
     chdir,
     chown,
@@ -14,37 +21,52 @@ from os import (
     makedirs,
     uname
 )
+from multiprocessing.pool import ThreadPool
 from os.path import (
     abspath,
+    basename,
     exists,
     join
 )
 from shutil import (
     copy,
+    move,
     rmtree
 )
+from tempfile import mkdtemp
 
 from pkg_resources import parse_version
 from six import iteritems
 
+from .. import __version__, trace
 from ..cache import CacheManager, cache_wheel_sources
 from ..config.wheels import WheelConfigManager
-from ..execution.docker import DockerExecutionContext
+from ..execution.docker import DockerExecutionContext, PACKAGE_CACHE_LOCK_ENV
 from ..execution.local import LocalExecutionContext
 from ..execution.qemu import QEMUExecutionContext
 from ..io import debug, info, warn
-from ..packaging.setup import check_setup, wheel_info, wrap_setup
-from ..util import Archive, pip_install, py_to_pip
+from ..packaging.setup import setup_info, wrap_setup
+from ..util import Archive, checkout_tree, locked_file, pip_download, pip_install, py_to_pip, stringify_cmd
 
 
-AUDITWHEEL_CMD = 'for whl in dist/*.whl; do auditwheel {auditwheel_args} $whl; rm $whl; done'
-DELOCATE_CMD = 'for whl in dist/*.whl; do delocate-wheel {delocate_args} $whl; done'
+AUDITWHEEL_CMD = 'auditwheel'
+DELOCATE_CMD = 'delocate-wheel'
 DEFAULT_AUDITWHEEL_ARGS = 'repair -w dist'
 DEFAULT_DELOCATE_ARGS = '-v'
+PARALLEL_BUILD_DIR_TEMPLATE = '__starforge_build_{i}'
+# compilers that are run through ccache by putting symlinks with their names to ccache first on $PATH
+CCACHE_COMPILERS = ('cc', 'c++', 'gcc', 'g++', 'clang', 'clang++')
+# `ccache --print-stats` (ccache >= 3.7) counters
+CCACHE_HIT_COUNTERS = ('direct_cache_hit', 'preprocessed_cache_hit')
+CCACHE_MISS_COUNTERS = ('cache_miss',)
+# `ccache -s` counters of older ccache 3.x (`cache hit (direct)   12`), which has no --print-stats
+CCACHE_STATS_RE = re.compile(r'^(?:(?P<hit>cache hit \((?:direct|preprocessed)\))|(?P<miss>cache miss))\s+(?P<n>\d+)',
+                             re.MULTILINE)
 
 
 class ForgeWheel(object):
-    def __init__(self, wheel_config, cache_manager, exec_context, image=None):
+    def __init__(self, wheel_config, cache_manager, exec_context, image=None, image_id=None, dependency_image=None,
+                 image_metadata=None):
         self.wheel_config = wheel_config
         self.name = wheel_config.name
         self.version = wheel_config.version
@@ -52,6 +74,43 @@ class ForgeWheel(object):
         self.cache_manager = cache_manager
         self.exec_context = exec_context
         self.image = image
+        self.image_id = image_id
+        self.dependency_image = dependency_image
+        self.image_metadata = image_metadata
+
+    def build_key(self):
+        """ Return a key identifying the products of this build: the wheel config, image config and contents, source
+        contents, and Starforge version. Returns None if the image contents cannot be identified (e.g. `local` and
+        `qemu` images, whose environment can change without any change to their config), so the build is not cached.
+        """
+        image_id = self.image_id() if self.image_id else None
+        if image_id is None:
+            return None
+        source_paths = [self.cache_manager.pip_check(self.name, self.version)]
+        source_paths.extend(self.cache_manager.url_check(url) for url in self.wheel_config.sources)
+        key = {
+            'starforge': __version__,
+            'wheel': self.wheel_config.config,
+            'purepy': self.wheel_config.purepy,
+            'universal': self.wheel_config.universal,
+            'image': vars(self.image) if self.image else None,
+            'image_id': image_id,
+            'sources': [self.cache_manager.source_digest(path) for path in source_paths if path is not None],
+        }
+        key = json.dumps(key, sort_keys=True, default=str)
+        debug('Build key data: %s', key)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def use_dependency_image(self):
+        """ Build in an image with this wheel's system dependencies preinstalled, if the execution context supports
+        it. Returns True if so, in which case `bdist_wheel` should be run with `install_deps=False`.
+        """
+        if self.dependency_image is None or self.image is None:
+            return False
+        pkgs = self.wheel_config.get_dependencies(self.image.name)
+        if not pkgs:
+            return False
+        return self.dependency_image(pkgs, self.image.pkgtool)
 
     def cache_sources(self):
         return cache_wheel_sources(self.cache_manager, self.wheel_config)
@@ -66,7 +125,8 @@ class ForgeWheel(object):
                 py = self.cache_manager.pyversion_cache(
                     self.image.name,
                     self.exec_context,
-                    self.image.pythons[0])
+                    self.image.pythons[0],
+                    metadata=self.image_metadata)
             whl = ('{name}-{version}-{py}-none-any.whl'
                    .format(name=self.name.replace('-', '_'),
                            version=str(parse_version(self.version)),
@@ -82,8 +142,13 @@ class ForgeWheel(object):
                     self.image.name,
                     self.exec_context,
                     self.image.pythons[0],
-                    self.image.plat_specific)
+                    self.image.plat_specific,
+                    metadata=self.image_metadata)
+            manifest = self.cache_manager.manifest_check(self.image.name) or {}
             for python, py_abi_tag in zip(self.image.pythons, self.image.py_abi_tags):
+                if not py_abi_tag:
+                    # from `starforge probe_images`
+                    py_abi_tag = manifest_py_abi_tag(manifest.get('pythons', {}).get(python))
                 if not py_abi_tag:
                     # FIXME: this forces a very specific naming (i.e. '/pythons/cp{py}{flags}-{arch}/')
                     for py_abi_tag in python.split('/'):
@@ -107,10 +172,10 @@ class ForgeWheel(object):
                                     ext=ext))
         return tarballs
 
-    def execute(self, cmd, cwd=None, capture_output=False):
+    def execute(self, cmd, cwd=None, capture_output=False, env=None):
         debug('Executing: %s', ' '.join(cmd))
         with self.exec_context() as run:
-            return run(cmd, cwd=cwd, capture_output=capture_output)
+            return run(cmd, cwd=cwd, capture_output=capture_output, env=env)
 
     def _get_prebuild_command(self, step):
         prebuild = self.wheel_config.prebuild
@@ -124,32 +189,65 @@ class ForgeWheel(object):
         debug("Prebuild command for '%s' step is: %s", step, prebuild)
         return prebuild
 
-    def _prep_build(self, build, output, uid, gid):
-        if output:
-            if not exists(output):
-                makedirs(output)
-            chown(output, uid, gid)
-
+    def _source_paths(self):
         src_paths = []
         pip_path = self.cache_manager.pip_check(self.name, self.version)
         if pip_path is not None:
             src_paths.append(pip_path)
         for src_url in self.wheel_config.sources:
             src_paths.append(self.cache_manager.url_check(src_url))
+        return src_paths
+
+    def _setup_info(self):
+        """ Introspect the setup script in the current directory, or reuse the result for the same sdist, image,
+        interpreter and build config from the cache.
+        """
+        src_paths = self._source_paths()
+        if not src_paths or src_paths[0] is None:
+            return setup_info()
+        image = None
+        if self.image.type != 'local':
+            image_id = self.image_id() if self.image_id else None
+            image = '%s@%s' % (self.image.name, image_id) if image_id else self.image.name
+        buildenv = dict(self.image.buildenv or {})
+        buildenv.update(self.wheel_config.buildenv or {})
+        prebuild = [self._get_prebuild_command('all'), self._get_prebuild_command('wheel')]
+        return self.cache_manager.setup_info_cache(
+            src_paths[0], setup_info,
+            image=image,
+            prebuild=prebuild if any(prebuild) else None,
+            buildenv=buildenv,
+            setup_requires=self.wheel_config.setup_requires,
+            dependencies=self.wheel_config.get_dependencies(self.image.name))
+
+    def _prep_build(self, build, output, uid, gid):
+        if output:
+            if not exists(output):
+                makedirs(output)
+            chown(output, uid, gid)
 
         root = None
 
-        for i, arc_path in enumerate(src_paths):
-            arc = Archive.open(arc_path)
-            root_t = abspath(join(getcwd(), arc.root))
+        for i, arc_path in enumerate(self._source_paths()):
+            tree = self.cache_manager.tree_check(arc_path)
+            if tree is not None:
+                roots = listdir(tree)
+                assert len(roots) == 1, "Could not determine root directory in source tree: %s" % tree
+                root_t = abspath(join(getcwd(), roots[0]))
+            else:
+                arc = Archive.open(arc_path)
+                root_t = abspath(join(getcwd(), arc.root))
             os.environ['SRC_ROOT_%d' % i] = root_t
             # will cd to first root
             if i == 0:
                 os.environ['SRC_ROOT'] = root_t
                 root = root_t
-            # TODO: don't use extractall (but since we *should* be running
-            # under docker, we shouldn't need to care)
-            arc.extractall(build)
+            if tree is not None:
+                self._checkout_tree(tree, build, 'source tree of %s' % arc_path)
+            else:
+                # TODO: don't use extractall (but since we *should* be running
+                # under docker, we shouldn't need to care)
+                arc.extractall(build)
 
         assert root is not None, "Unable to determine root directory"
 
@@ -159,14 +257,134 @@ class ForgeWheel(object):
 
         return root
 
-    def _build_py_pip_install(self, pythons, packages, dependency_type=None):
+    def _checkout_tree(self, src, dst, desc):
+        methods = checkout_tree(src, dst)
+        info('Checked out %s (%s)', desc, ', '.join('%s: %d' % m for m in sorted(methods.items())))
+        if methods.get('copy'):
+            # e.g. the cache is mounted from another filesystem, or the filesystem does not support reflinks
+            warn('Unable to reflink %d files of %s from %s to %s, copied them instead', methods['copy'], desc, src, dst)
+
+    def _build_py_pip_install(self, pythons, packages, dependency_type=None, download_dir=None):
+        """ Install `packages` into each of `pythons`, concurrently if there are multiple. If set and there are multiple
+        `pythons`, distributions are first downloaded to `download_dir` and then installed from it without the index:
+        the first Python resolves and downloads everything into `download_dir`, then the others concurrently download
+        only what they cannot use from it (e.g. binary wheels for their own ABI) into their own subdirectories.
+        """
         if not packages:
             return
-        for py in pythons:
+        index = self.wheel_config.global_config.index
+        py_args = dict((py, None) for py in pythons)
+
+        def download(item):
+            py, dest, args = item
+            info("Downloading %s dependencies for build Python '%s': %s", dependency_type, py, ', '.join(packages))
+            with trace.span('pip download', python=py):
+                pip_download(dest, pip=py_to_pip(py), args=args, packages=packages, executor=self.execute, index=index)
+
+        if download_dir and len(pythons) > 1:
+            download((pythons[0], download_dir, None))
+            items = [(py, join(download_dir, 'py%d' % i), ['--find-links', download_dir])
+                     for i, py in enumerate(pythons) if i > 0]
+            self._map(download, items)
+            py_args[pythons[0]] = ['--no-index', '--find-links', download_dir]
+            for py, dest, args in items:
+                py_args[py] = ['--no-index', '--find-links', download_dir, '--find-links', dest]
+
+        def install(py):
             info("Installing %s dependencies for build Python '%s': %s", dependency_type, py, ', '.join(packages))
-            pip_install(pip=py_to_pip(py), packages=packages, executor=self.execute)
-
-    def bdist_wheel(self, output=None, uid=-1, gid=-1):
+            with trace.span('pip install', python=py):
+                pip_install(pip=py_to_pip(py), args=py_args[py], packages=packages, executor=self.execute,
+                            add_galaxy_index=py_args[py] is None, index=index)
+
+        self._map(install, pythons)
+
+    def _map(self, func, items):
+        """ Apply `func` to `items`, in a pool of one thread per item if there are multiple.
+        """
+        if len(items) < 2:
+            return [func(item) for item in items]
+        pool = ThreadPool(len(items))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _install_dependencies(self, pkgtool, pkgs, arch, keep_packages=False):
+        """ Install the system packages `pkgs` with `pkgtool`. If `keep_packages` is set, downloaded packages are kept
+        in the package tool's cache.
+        """
+        if pkgtool == 'apt':
+            if arch == 'i686' and exists('/usr/lib/x86_64-linux-gnu'):
+                # multiarch install
+                pkgs = ['%s:i386' % x for x in pkgs]
+            os.environ['DEBIAN_FRONTEND'] = 'noninteractive'
+            self.execute(['apt-get', '-qq', 'update'])
+            self.execute(['apt-get', 'install',
+                          '--no-install-recommends', '-y'] + pkgs)
+        elif pkgtool == 'yum':
+            keepcache = ['--setopt=keepcache=1'] if keep_packages else []
+            self.execute(['yum', 'install', '-y'] + keepcache + pkgs)
+        elif pkgtool == 'zypper':
+            if keep_packages:
+                self.execute(['zypper', '-n', 'mr', '-k', '-a'])
+            self.execute(['zypper', '-n', 'in'] + pkgs)
+        elif pkgtool == 'brew':
+            if '/usr/local/bin' not in os.environ['PATH']:
+                os.environ['PATH'] = '/usr/local/bin:' + os.environ['PATH']
+            # brew exits 1 if a package is already installed
+            installed = set(self.execute(['brew', 'list', '-1'], cwd='/tmp', capture_output=True).splitlines())
+            needed = set(pkgs) - installed
+            if needed:
+                self.execute(['brew', 'install'] + list(needed), cwd='/tmp')
+        else:
+            warn('Skipping installation of dependencies: %s',
+                 ', '.join(pkgs))
+
+    def _setup_ccache(self, build):
+        """ Compile with ccache, if it is installed, and return the directory of compiler symlinks to it (to be removed by
+        `_cleanup_ccache()`) and its stats, or None if it is not installed.
+
+        The compiler commands that distutils takes from each interpreter's sysconfig (e.g. `gcc -pthread`) are run
+        through ccache with symlinks on $PATH, and absolute $CC/$CXX set in `buildenv` are prefixed with ccache.
+        """
+        ccache = find_executable('ccache')
+        if ccache is None:
+            warn('ccache is enabled but is not installed on image %s, compiling without it', self.image.name)
+            return None
+        bindir = mkdtemp(prefix='starforge_ccache_')
+        for compiler in CCACHE_COMPILERS:
+            os.symlink(ccache, join(bindir, compiler))
+        os.environ['PATH'] = bindir + ':' + os.environ['PATH']
+        for var in ('CC', 'CXX'):
+            if os.environ.get(var, '').startswith('/'):
+                os.environ[var] = 'ccache ' + os.environ[var]
+        # hash paths relative to the build directory so that rebuilds and parallel builds (in other directories) hit
+        os.environ['CCACHE_BASEDIR'] = build
+        os.environ['CCACHE_NOHASHDIR'] = '1'
+        stats = ccache_stats()
+        info('Compiling with ccache (cache: %s)', os.environ.get('CCACHE_DIR', 'default'))
+        return (bindir, stats)
+
+    def _cleanup_ccache(self, bindir, uid, gid):
+        rmtree(bindir)
+        ccache_dir = os.environ.get('CCACHE_DIR')
+        if ccache_dir and uid >= 0 and os.getuid() == 0:
+            # the cache is mounted from the host, give anything created in it by root back to the host user
+            for root, dirs, files in os.walk(ccache_dir):
+                for path in [root] + [join(root, name) for name in dirs + files]:
+                    if os.lstat(path).st_uid != uid:
+                        os.lchown(path, uid, gid)
+
+    def _report_ccache(self, start_stats):
+        # the cache may be shared with concurrent builds on the same image, whose compilations are also counted
+        stats = ccache_stats()
+        hits = stats['hits'] - start_stats['hits']
+        misses = stats['misses'] - start_stats['misses']
+        info('ccache: %d hits, %d misses (%.1f%% hit rate)', hits, misses,
+             100.0 * hits / (hits + misses) if hits + misses else 0)
+
+    def bdist_wheel(self, output=None, uid=-1, gid=-1, install_deps=True):
         # TODO: a lot of stuff in this method like installing from the package
         # manager and changing permissions should be abstracted out for
         # non-wheel executions
@@ -199,33 +417,56 @@ class ForgeWheel(object):
                     os.environ[k] = str(v)
 
         pkgs = self.wheel_config.get_dependencies(self.image.name)
-        if pkgs:
-            if pkgtool == 'apt':
-                if arch == 'i686' and exists('/usr/lib/x86_64-linux-gnu'):
-                    # multiarch install
-                    pkgs = ['%s:i386' % x for x in pkgs]
-                os.environ['DEBIAN_FRONTEND'] = 'noninteractive'
-                self.execute(['apt-get', '-qq', 'update'])
-                self.execute(['apt-get', 'install',
-                              '--no-install-recommends', '-y'] + pkgs)
-            elif pkgtool == 'yum':
-                self.execute(['yum', 'install', '-y'] + pkgs)
-            elif pkgtool == 'zypper':
-                self.execute(['zypper', '-n', 'in'] + pkgs)
-            elif pkgtool == 'brew':
-                if '/usr/local/bin' not in os.environ['PATH']:
-                    os.environ['PATH'] = '/usr/local/bin:' + os.environ['PATH']
-                # brew exits 1 if a package is already installed
-                installed = set(self.execute(['brew', 'list', '-1'], cwd='/tmp', capture_output=True).splitlines())
-                needed = set(pkgs) - installed
-                if needed:
-                    self.execute(['brew', 'install'] + list(needed), cwd='/tmp')
-            else:
-                warn('Skipping installation of dependencies: %s',
-                     ', '.join(pkgs))
+        if pkgs and not install_deps:
+            info('Skipping installation of dependencies (preinstalled in image): %s', ', '.join(pkgs))
+        elif pkgs and os.environ.get(PACKAGE_CACHE_LOCK_ENV):
+            # the package tool cache is shared with other guests of this image
+            info('Waiting for package cache lock: %s', os.environ[PACKAGE_CACHE_LOCK_ENV])
+            with locked_file(os.environ[PACKAGE_CACHE_LOCK_ENV]):
+                with trace.span('install system dependencies', packages=' '.join(pkgs)):
+                    self._install_dependencies(pkgtool, pkgs, arch, keep_packages=True)
+        elif pkgs:
+            with trace.span('install system dependencies', packages=' '.join(pkgs)):
+                self._install_dependencies(pkgtool, pkgs, arch)
+
+        with trace.span('prepare source'):
+            root = self._prep_build(build, output, uid, gid)
+
+        ccache = None
+        if self.wheel_config.use_ccache(self.image.name):
+            ccache = self._setup_ccache(build)
+        try:
+            self._build(build, root, pythons, platform, pkgs, pkgtool)
+            if ccache is not None:
+                self._report_ccache(ccache[1])
+        finally:
+            if ccache is not None:
+                self._cleanup_ccache(ccache[0], uid, gid)
 
-        root = self._prep_build(build, output, uid, gid)
+        if self.image.use_auditwheel:
+            # auditwheel writes the repaired wheels to dist/ under new names
+            self._repair_wheels([AUDITWHEEL_CMD] + shlex.split(self.wheel_config.auditwheel_args or DEFAULT_AUDITWHEEL_ARGS),
+                                remove=True)
 
+        if self.image.use_delocate:
+            # delocate repairs wheels in place
+            self._repair_wheels([DELOCATE_CMD] + shlex.split(self.wheel_config.delocate_args or DEFAULT_DELOCATE_ARGS))
+
+        if self.image.postbuild is not None:
+            info('Running image postbuild command: %s', self.image.postbuild)
+            with trace.span('postbuild'):
+                subprocess.check_call(self.image.postbuild, shell=True)
+
+        if output:
+            with trace.span('copy out'):
+                for f in listdir('dist'):
+                    copy(join('dist', f), output)
+                    chown(join(output, f), uid, gid)
+
+    def _build(self, build, root, pythons, platform, pkgs, pkgtool):
+        """ Run the wheel prebuild command, install the build dependencies, and build wheels for each of `pythons` in
+        the prepared source tree `root`.
+        """
         prebuild = self._get_prebuild_command('wheel')
         if prebuild is not None:
             subprocess.check_call(prebuild, shell=True)
@@ -236,15 +477,21 @@ class ForgeWheel(object):
         # guest user, and with docker run --user, the pythons aren't writable
 
         # install setup requirements (these can be defined by the setup script but that presents a catch-22, so only
-        # check the wheel config
+        # check the wheel config. The image Python needs them to run the setup script for setup_info()
         self._build_py_pip_install([self.image.buildpy], self.wheel_config.setup_requires,
                                    dependency_type='Starforge image Python setup_requires')
-        self._build_py_pip_install(pythons, self.wheel_config.setup_requires, dependency_type='setup_requires')
+
+        introspection = None
+        if self.wheel_config.insert_setuptools is None or self.wheel_config.install_requires is None:
+            # a single run of the setup script answers both
+            with trace.span('setup.py introspection'):
+                introspection = self._setup_info()
+            assert introspection is not None, "Unable to introspect setup script"
 
         insert_setuptools = self.wheel_config.insert_setuptools
         if insert_setuptools is None:
-            # if set explicitly to false, do not override with check_setup()
-            insert_setuptools = not check_setup()
+            # if set explicitly to false, do not override with setup_info()
+            insert_setuptools = not introspection['setuptools']
 
         if insert_setuptools or self.image.plat_specific:
             wrap_setup(
@@ -254,12 +501,25 @@ class ForgeWheel(object):
         # install anything defined by the package itself, overrideable by the wheel config
         install_requires = self.wheel_config.install_requires
         if install_requires is None:
-            install_requires = wheel_info()['install_requires']
-        self._build_py_pip_install(pythons, install_requires, dependency_type='install_requires')
-
-        # install anything else the wheel config author wants installed
-        self._build_py_pip_install(pythons, self.wheel_config.pip_install, dependency_type='wheel config pip_install')
-
+            install_requires = introspection['install_requires']
+
+        # install setup requirements first, since building an sdist of an install requirement may import them (e.g.
+        # numpy or Cython), then install requirements and anything else the wheel config author wants installed in a
+        # single pip run per build Python, so that they are resolved together
+        packages = []
+        for package in list(install_requires) + list(self.wheel_config.pip_install):
+            if package not in packages:
+                packages.append(package)
+        pip_download_dir = mkdtemp(prefix='starforge_pip_download_')
+        try:
+            self._build_py_pip_install(pythons, self.wheel_config.setup_requires, dependency_type='setup_requires',
+                                       download_dir=pip_download_dir)
+            self._build_py_pip_install(pythons, packages, dependency_type='install_requires and pip_install',
+                                       download_dir=pip_download_dir)
+        finally:
+            rmtree(pip_download_dir)
+
+        build_cmds = []
         for py in pythons:
             build_args = []
             if pkgs and pkgtool == 'brew':
@@ -271,27 +531,85 @@ class ForgeWheel(object):
             cmd = [py, 'setup.py'] + build_args
             if platform is not None and self.image.force_plat:
                 cmd.append('--plat-name=%s' % platform)
-            self.execute(cmd)
-            rmtree('build')
-
-        if self.image.use_auditwheel:
-            auditwheel_cmd = AUDITWHEEL_CMD.format(auditwheel_args=self.wheel_config.auditwheel_args or DEFAULT_AUDITWHEEL_ARGS)
-            info('Running auditwheel command: %s', auditwheel_cmd)
-            subprocess.check_call(auditwheel_cmd, shell=True)
+            build_cmds.append(cmd)
 
-        if self.image.use_delocate:
-            delocate_cmd = DELOCATE_CMD.format(delocate_args=self.wheel_config.delocate_args or DEFAULT_DELOCATE_ARGS)
-            info('Running delocate command: %s', delocate_cmd)
-            subprocess.check_call(delocate_cmd, shell=True)
-
-        if self.image.postbuild is not None:
-            info('Running image postbuild command: %s', self.image.postbuild)
-            subprocess.check_call(self.image.postbuild, shell=True)
+        jobs = min(self.wheel_config.build_jobs, len(build_cmds))
+        if jobs > 1:
+            self._parallel_build(build, root, build_cmds, jobs)
+        else:
+            for cmd in build_cmds:
+                with trace.span('setup.py', python=cmd[0]):
+                    self.execute(cmd)
+                rmtree('build')
+
+    def _parallel_build(self, build, root, build_cmds, jobs):
+        """ Run `build_cmds` in a pool of `jobs` threads, each command in its own copy of the prepared source tree at
+        `root`, and collect the products in `root`/dist.
+        """
+        def run(item):
+            i, cmd = item
+            py_root = join(build, PARALLEL_BUILD_DIR_TEMPLATE.format(i=i), basename(root))
+            with trace.span('checkout build tree', python=cmd[0]):
+                self._checkout_tree(root, py_root, 'build tree for %s' % cmd[0])
+            env = os.environ.copy()
+            env['SRC_ROOT'] = py_root
+            info('Building with %s in %s', cmd[0], py_root)
+            with trace.span('setup.py', python=cmd[0]):
+                self.execute(cmd, cwd=py_root, env=env)
+            return join(py_root, 'dist')
+
+        info('Building for %d interpreters, %d at a time', len(build_cmds), jobs)
+        pool = ThreadPool(jobs)
+        try:
+            dists = pool.map(run, enumerate(build_cmds))
+            if not exists('dist'):
+                makedirs('dist')
+            for dist in dists:
+                for f in listdir(dist):
+                    move(join(dist, f), join('dist', f))
+        finally:
+            pool.close()
+            pool.join()
+            # remove the copies of the tree even if a build failed
+            for i in range(len(build_cmds)):
+                py_build = join(build, PARALLEL_BUILD_DIR_TEMPLATE.format(i=i))
+                if exists(py_build):
+                    rmtree(py_build)
+
+    def _repair_wheels(self, cmd, remove=False):
+        """ Run `cmd` with each wheel in dist/ as its last argument, in a pool of up to one process per CPU, and
+        remove the original wheels afterward if `remove` is set.
+
+        Failed repairs do not fail the build: a warning is logged and the unrepaired wheel is kept.
+        """
+        wheels = sorted(glob(join('dist', '*.whl')))
+        if not wheels:
+            return
 
-        if output:
-            for f in listdir('dist'):
-                copy(join('dist', f), output)
-                chown(join(output, f), uid, gid)
+        def repair(whl):
+            repair_cmd = cmd + [whl]
+            info('Running repair command: %s', stringify_cmd(repair_cmd))
+            start = time.time()
+            with trace.span('repair', tool=cmd[0], wheel=basename(whl)):
+                returncode = subprocess.call(repair_cmd)
+            if remove and returncode == 0:
+                os.unlink(whl)
+            return (whl, repair_cmd, returncode, time.time() - start)
+
+        jobs = min(len(wheels), cpu_count())
+        info('Repairing %d wheels with %s, %d at a time', len(wheels), cmd[0], jobs)
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(repair, wheels)
+        finally:
+            pool.close()
+            pool.join()
+        for whl, repair_cmd, returncode, seconds in results:
+            if returncode == 0:
+                info('Repaired %s in %.1fs', basename(whl), seconds)
+            else:
+                warn('Repair of %s failed with exit code %d after %.1fs, keeping the unrepaired wheel', basename(whl),
+                     returncode, seconds)
 
     def sdist(self, output=None, uid=-1, gid=-1):
         uid = int(uid)
@@ -315,9 +633,52 @@ class ForgeWheel(object):
                 chown(join(output, f), uid, gid)
 
 
-def build_forges(global_config, wheels_config, wheel, images=None, **kwargs):
-    wheel_config_manager = WheelConfigManager.open(global_config, wheels_config)
-    cache_manager = CacheManager(global_config.cache_path)
+def manifest_py_abi_tag(python):
+    """ Return the Python and ABI tags (e.g. `cp36-cp36m`) of a CPython from its entry in an image manifest (see
+    `starforge.cache.ImageManifestCacher`), or None if it is not known.
+    """
+    if not python:
+        return None
+    soabi = python.get('soabi') or ''
+    if soabi.startswith('cpython-'):
+        # e.g. `cpython-36m-x86_64-linux-gnu`
+        abi = 'cp' + soabi.split('-')[1]
+        return '%s-%s' % (re.match(r'cp\d+', abi).group(0), abi)
+    version = python.get('version', '').split('.')
+    if not soabi and version[0] == '2' and len(version) > 1 and python.get('maxunicode'):
+        # Python 2 has no SOABI, the ABI depends on the unicode width
+        py = 'cp2%s' % version[1]
+        return '%s-%s%s' % (py, py, 'mu' if python['maxunicode'] > 0xffff else 'm')
+    return None
+
+
+def ccache_stats():
+    """ Return the total ccache hits and misses of the cache in $CCACHE_DIR.
+    """
+    stats = {'hits': 0, 'misses': 0}
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['ccache', '--print-stats'], stderr=devnull).decode('utf-8', 'replace')
+    except subprocess.CalledProcessError:
+        output = subprocess.check_output(['ccache', '-s']).decode('utf-8', 'replace')
+        for match in CCACHE_STATS_RE.finditer(output):
+            stats['hits' if match.group('hit') else 'misses'] += int(match.group('n'))
+        return stats
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2 and fields[0] in CCACHE_HIT_COUNTERS:
+            stats['hits'] += int(fields[1])
+        elif len(fields) == 2 and fields[0] in CCACHE_MISS_COUNTERS:
+            stats['misses'] += int(fields[1])
+    return stats
+
+
+def build_forges(global_config, wheels_config, wheel, images=None, wheel_config_manager=None, cache_manager=None,
+                 **kwargs):
+    if wheel_config_manager is None:
+        wheel_config_manager = WheelConfigManager.open(global_config, wheels_config)
+    if cache_manager is None:
+        cache_manager = CacheManager(global_config.cache_path, remote=global_config.remote_cache)
     wheel_config = wheel_config_manager.get_wheel_config(wheel)
     wheel_config.detect_imageset(cache_manager)
     if images:
@@ -337,10 +698,17 @@ def build_forges(global_config, wheels_config, wheel, images=None, **kwargs):
     for (image_name, image_conf) in iteritems(images):
         debug("Read image config: %s, image: %s, plat_name: %s, force_plat: %s",
               image_name, image_conf.image, image_conf.plat_name, image_conf.force_plat)
-        if image_conf.type == 'local':
-            ectx = LocalExecutionContext(image_conf, **kwargs)
-        if image_conf.type == 'docker':
-            ectx = DockerExecutionContext(image_conf, global_config.docker, **kwargs)
-        elif image_conf.type == 'qemu':
-            ectx = QEMUExecutionContext(image_conf, global_config.qemu, **kwargs)
-        yield ForgeWheel(wheel_config, cache_manager, ectx.run_context, image=image_conf)
+        ectx = execution_context(global_config, image_conf, **kwargs)
+        yield ForgeWheel(wheel_config, cache_manager, ectx.run_context, image=image_conf, image_id=ectx.image_id,
+                         dependency_image=ectx.use_dependency_image, image_metadata=ectx.image_metadata)
+
+
+def execution_context(global_config, image_conf, **kwargs):
+    """ Return the execution context for the image `image_conf`.
+    """
+    if image_conf.type == 'local':
+        return LocalExecutionContext(image_conf, **kwargs)
+    if image_conf.type == 'docker':
+        return DockerExecutionContext(image_conf, global_config.docker, cache_path=global_config.cache_path, **kwargs)
+    elif image_conf.type == 'qemu':
+        return QEMUExecutionContext(image_conf, global_config.qemu, **kwargs)
@@ -0,0 +1,202 @@
+"""
+Serve cached sdists and built wheels as a PEP 503 simple package index
+"""
+from __future__ import absolute_import
+
+import os
+import shutil
+import threading
+from os import listdir, stat
+from os.path import isfile, join
+
+from six.moves.BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from six.moves.socketserver import ThreadingMixIn
+from six.moves.urllib.parse import quote, unquote
+
+from .cache import normalize_name, parse_tarball_name
+from .io import debug, info
+
+
+DEFAULT_INDEX_HOST = '127.0.0.1'
+DEFAULT_INDEX_PORT = 8080
+SIMPLE_ROOT_TEMPLATE = '''<!DOCTYPE html>
+<html><head><title>Simple index</title></head><body>
+{links}
+</body></html>
+'''
+SIMPLE_PROJECT_TEMPLATE = '''<!DOCTYPE html>
+<html><head><title>Links for {project}</title></head><body>
+<h1>Links for {project}</h1>
+{links}
+</body></html>
+'''
+
+
+def project_name(filename):
+    """ Return the normalized project name of an sdist or wheel filename, or None if it is neither.
+    """
+    if filename.endswith('.whl'):
+        return normalize_name(filename.split('-')[0])
+    keys = parse_tarball_name(filename)
+    if keys:
+        # the split with the longest name is the most likely, e.g. `python-dateutil-2.7.0.tar.gz`
+        return keys[-1][0]
+    return None
+
+
+class SimpleIndex(object):
+    """ PEP 503 index pages over a set of directories.
+
+    Each directory is rescanned only when its mtime changes, and only the pages of projects whose files changed are
+    regenerated.
+    """
+    def __init__(self, directories):
+        self.directories = list(directories)
+        self.mtimes = [None] * len(self.directories)
+        # per directory, {project: {filename: path}}
+        self.files = [{} for _ in self.directories]
+        self.pages = {}
+        self.root_page = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            for i, directory in enumerate(self.directories):
+                try:
+                    mtime = stat(directory).st_mtime
+                except OSError:
+                    continue
+                if mtime == self.mtimes[i]:
+                    continue
+                debug('Rescanning index directory: %s', directory)
+                files = {}
+                for filename in listdir(directory):
+                    project = project_name(filename)
+                    if project is not None:
+                        files.setdefault(project, {})[filename] = join(directory, filename)
+                changed = set(
+                    project for project in set(files) | set(self.files[i])
+                    if files.get(project) != self.files[i].get(project))
+                for project in changed:
+                    self.pages.pop(project, None)
+                if set(files) != set(self.files[i]):
+                    self.root_page = None
+                self.files[i] = files
+                self.mtimes[i] = mtime
+
+    def projects(self):
+        projects = set()
+        for files in self.files:
+            projects.update(files)
+        return sorted(projects)
+
+    def root(self):
+        self.refresh()
+        if self.root_page is None:
+            links = '\n'.join('<a href="{0}/">{0}</a><br/>'.format(project) for project in self.projects())
+            self.root_page = SIMPLE_ROOT_TEMPLATE.format(links=links)
+        return self.root_page
+
+    def project(self, project):
+        self.refresh()
+        project = normalize_name(project)
+        if project not in self.pages:
+            links = []
+            for i, files in enumerate(self.files):
+                for filename in sorted(files.get(project, {})):
+                    links.append('<a href="../../files/{i}/{quoted}">{filename}</a><br/>'.format(
+                        i=i, quoted=quote(filename), filename=filename))
+            if not links:
+                return None
+            self.pages[project] = SIMPLE_PROJECT_TEMPLATE.format(project=project, links='\n'.join(links))
+        return self.pages[project]
+
+    def file(self, i, filename):
+        """ Return the path of `filename` in directory number `i`, or None if it is not indexed.
+        """
+        self.refresh()
+        try:
+            path = self.files[i].get(project_name(filename), {}).get(filename)
+        except IndexError:
+            return None
+        if path is not None and isfile(path):
+            return path
+        return None
+
+
+class SimpleIndexRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._handle(body=True)
+
+    def do_HEAD(self):
+        self._handle(body=False)
+
+    def _handle(self, body=True):
+        index = self.server.index
+        parts = [unquote(p) for p in self.path.split('?', 1)[0].split('/') if p]
+        if parts == ['simple']:
+            self._send_page(index.root(), body)
+        elif len(parts) == 2 and parts[0] == 'simple':
+            self._send_page(index.project(parts[1]), body)
+        elif len(parts) == 3 and parts[0] == 'files' and parts[1].isdigit():
+            self._send_file(index.file(int(parts[1]), parts[2]), body)
+        else:
+            self.send_error(404)
+
+    def _send_page(self, page, body):
+        if page is None:
+            self.send_error(404)
+            return
+        page = page.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        if body:
+            self.wfile.write(page)
+
+    def _send_file(self, path, body):
+        if path is None:
+            self.send_error(404)
+            return
+        with open(path, 'rb') as handle:
+            size = os.fstat(handle.fileno()).st_size
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            if not body:
+                return
+            self.wfile.flush()
+            if hasattr(os, 'sendfile'):
+                offset = 0
+                while offset < size:
+                    sent = os.sendfile(self.connection.fileno(), handle.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            else:
+                shutil.copyfileobj(handle, self.wfile, 1024 * 1024)
+
+    def log_message(self, format, *args):
+        debug('%s - %s', self.address_string(), format % args)
+
+
+class SimpleIndexServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, index, host=DEFAULT_INDEX_HOST, port=DEFAULT_INDEX_PORT):
+        HTTPServer.__init__(self, (host, port), SimpleIndexRequestHandler)
+        self.index = index
+
+
+def serve(directories, host=DEFAULT_INDEX_HOST, port=DEFAULT_INDEX_PORT):
+    index = SimpleIndex(directories)
+    server = SimpleIndexServer(index, host=host, port=port)
+    info('Serving simple index of %s at http://%s:%s/simple/', ', '.join(directories), host, server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
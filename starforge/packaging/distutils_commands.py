@@ -82,21 +82,7 @@ class wheel_info(Command):
             self.dump = dump_human
 
     def run(self):
-        bdist_wheel = self.get_finalized_command('bdist_wheel')
-        tag = bdist_wheel.get_tag()
-        info = {
-            'distribution': bdist_wheel.wheel_dist_name,
-            'purepy': bdist_wheel.root_is_pure,
-            'universal': bdist_wheel.universal,
-            'tag': {
-                'implementation': tag[0],
-                'abi': tag[1],
-                'platform': tag[2],
-                'str': '-'.join(tag),
-            },
-        }
-        for key in DISTRIBUTION_KEYS:
-            info[key] = getattr(bdist_wheel.distribution, key)
+        info = get_wheel_info(self.get_finalized_command('bdist_wheel'))
         fh = None
         if self.output:
             with open(self.output, 'w') as fh:
@@ -105,6 +91,26 @@ class wheel_info(Command):
             print(self.dump(info), end=self.end)
 
 
+def get_wheel_info(bdist_wheel):
+    """ Return the wheel info of the finalized `bdist_wheel` command as a dict.
+    """
+    tag = bdist_wheel.get_tag()
+    info = {
+        'distribution': bdist_wheel.wheel_dist_name,
+        'purepy': bdist_wheel.root_is_pure,
+        'universal': bdist_wheel.universal,
+        'tag': {
+            'implementation': tag[0],
+            'abi': tag[1],
+            'platform': tag[2],
+            'str': '-'.join(tag),
+        },
+    }
+    for key in DISTRIBUTION_KEYS:
+        info[key] = getattr(bdist_wheel.distribution, key)
+    return info
+
+
 def dump_human(info):
     format_data = info.copy()
     format_data.update({
@@ -1,7 +1,11 @@
 """ setuptools/distutils hackery
 """
+import hashlib
 import json
+import platform
+import re
 import sys
+import sysconfig
 import tempfile
 from os import (
     getcwd,
@@ -9,12 +13,12 @@ from os import (
 )
 from os.path import (
     exists,
-    join
+    join,
+    splitext
 )
 from subprocess import (
     CalledProcessError,
-    check_call,
-    check_output
+    check_call
 )
 
 try:
@@ -30,9 +34,15 @@ from ..io import (
 )
 from ..util import (
     Archive,
+    asbool,
     stringify_cmd
 )
 
+try:
+    from configparser import ConfigParser, Error as ConfigParserError
+except ImportError:
+    from ConfigParser import ConfigParser, Error as ConfigParserError
+
 
 IMPORT_INTERFACE_WHEEL = 'import starforge.interface.wheel'
 IMPORT_SETUPTOOLS = 'import setuptools'
@@ -50,6 +60,22 @@ UNIVERSAL = 'universal'
 PUREPY = 'purepy'
 C_EXTENSION = 'c-extension'
 
+# source files that indicate the package (probably) builds extension modules
+EXTENSION_SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.pyx', '.f', '.f90', '.rs', '.go')
+# setup.py contents that indicate the package (probably) builds extension modules
+EXTENSION_SETUP_RE = re.compile(r'\b(?:Extension|cythonize)\s*\(|'
+                                r'\b(?:ext_modules|cffi_modules|rust_extensions)\s*=\s*(?!\[\s*\])')
+# setup.py contents that can force a platform wheel without extension modules (e.g. a Distribution subclass whose
+# has_ext_modules() returns True), which only running it can determine
+SETUP_PLATFORM_RE = re.compile(r'\b(has_ext_modules|distclass|is_pure)\b')
+# setup.py contents that indicate bdist_wheel options (e.g. `options={'bdist_wheel': {'universal': 1}}`) are set in the
+# setup script, which only running it can determine
+SETUP_WHEEL_OPTIONS_RE = re.compile(r'\b(bdist_wheel|universal)\b')
+BUILD_BACKEND_RE = re.compile(r'^\s*build-backend\s*=\s*["\']([^"\']+)["\']', re.M)
+# build backends that can only build pure Python wheels
+PUREPY_BUILD_BACKENDS = ('flit_core.buildapi', 'flit.buildapi', 'hatchling.build', 'poetry.core.masonry.api',
+                         'poetry.masonry.api', 'pdm.backend', 'pdm.pep517.api')
+
 
 def wrap_setup(package_dir=None, import_interface_wheel=False, import_setuptools=True):
     setup = 'setup.py'
@@ -71,26 +97,13 @@ def wrap_setup(package_dir=None, import_interface_wheel=False, import_setuptools
         ))
 
 
-def check_setup(package_dir=None):
-    package_dir = package_dir or getcwd()
-    cmd = [sys.executable, 'setup.py', '--help-commands']
-    out = _check_output(cmd, cwd=package_dir)
-    for line in out.splitlines():
-        try:
-            if line.strip().split()[0] == 'bdist_wheel':
-                debug("Package uses setuptools")
-                return True
-        except IndexError:
-            pass
-    return False
-
-
-def wheel_type(package_dir=None):
-    info = wheel_info(package_dir=package_dir)
-    if not info:
+def wheel_type_from_info(setup_info):
+    """ Return the wheel type of a package from its `setup_info()`.
+    """
+    if not setup_info:
         return None
-    if info['purepy']:
-        if info['universal']:
+    if setup_info['purepy']:
+        if setup_info['universal']:
             return UNIVERSAL
         else:
             return PUREPY
@@ -98,31 +111,128 @@ def wheel_type(package_dir=None):
         return C_EXTENSION
 
 
-def wheel_info(package_dir=None):
+def setup_info(package_dir=None):
+    """ Run the setup script in `package_dir` once to determine whether it uses setuptools (`setuptools`), its wheel
+    tag and purity, and its `DISTRIBUTION_KEYS` (see `starforge.packaging.setup_info`). Returns None on failure.
+    """
     package_dir = package_dir or getcwd()
-    wheel_info = None
+    setup_info = None
     try:
         with tempfile.NamedTemporaryFile(mode='w+') as tfh:
-            cmd = [sys.executable, 'setup.py', '-q', 'wheel_info', '--json', '--output', tfh.name]
+            cmd = [sys.executable, '-m', 'starforge.packaging.setup_info', tfh.name]
             debug('Executing in %s: %s', package_dir, stringify_cmd(cmd))
             check_call(cmd, cwd=package_dir)
-            wheel_info = json.load(tfh)
+            setup_info = json.load(tfh)
     except (CalledProcessError, ValueError) as exc:
-        error("Failed to get wheel info: %s", exc)
-    return wheel_info
-
-
-def _check_output(cmd, cwd):
-    debug('Executing in %s: %s', cwd, stringify_cmd(cmd))
-    out = check_output(cmd, cwd=cwd)
-    return out.decode('UTF-8')
+        error("Failed to introspect setup script: %s", exc)
+    return setup_info
+
+
+def interpreter_id():
+    """ Return a string identifying this interpreter, for caching the results of running setup scripts with it.
+    """
+    return '%s-%s-%s:%s' % (platform.python_implementation().lower(), platform.python_version(),
+                            sysconfig.get_platform(), sys.executable)
+
+
+def setup_info_key(digest, image=None, prebuild=None, buildenv=None, setup_requires=None, dependencies=None):
+    """ Return the key for caching the `setup_info()` of the sdist with `digest` by this interpreter.
+
+    `image` identifies the image running this interpreter (its name and ID, if known), or is None on the host (which
+    includes `local` images). The rest is the build config that can change the results: the `prebuild` commands run on
+    the source, the `buildenv` environment, and the `setup_requires` and system package `dependencies` installed. The
+    host introspects sdists without any of them, so it shares results with builds without them on the same interpreter.
+    """
+    key = {
+        'sdist': digest,
+        'image': image,
+        'interpreter': interpreter_id(),
+        'prebuild': prebuild or None,
+        'buildenv': buildenv or {},
+        'setup_requires': list(setup_requires or []),
+        'dependencies': sorted(dependencies or []),
+    }
+    key = json.dumps(key, sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
 
 
 class PythonSdist(Archive):
     @property
     def wheel_type(self):
-        with TemporaryDirectory(prefix='starforge_sdist_wheel_type_') as td:
+        return self.detect_wheel_type()
+
+    def detect_wheel_type(self, introspect=None):
+        """ Return the wheel type from the setup files in the archive if possible, otherwise by introspecting the setup
+        script. `introspect`, if set, is called instead of `setup_info()` to get the introspection (e.g. from a cache).
+        """
+        wheel_type = self.probe_wheel_type()
+        if wheel_type is not None:
+            debug("Probed wheel type of '%s' from its setup files: %s", self._arcfile, wheel_type)
+            return wheel_type
+        debug("Wheel type of '%s' is ambiguous from its setup files, running setup.py", self._arcfile)
+        return wheel_type_from_info(introspect() if introspect is not None else self.setup_info())
+
+    def _read(self, name):
+        """ Return the contents of member `name` as text, or None if it does not exist.
+        """
+        try:
+            fh = self.extractfile(name)
+        except KeyError:
+            return None
+        if fh is None:
+            return None
+        try:
+            return fh.read().decode('utf-8', 'replace')
+        finally:
+            fh.close()
+
+    def probe_wheel_type(self):
+        """ Determine the wheel type by reading only setup.py, setup.cfg, pyproject.toml and the member list from the
+        archive, without extracting or running anything. Returns None if the result is ambiguous.
+        """
+        root = self.root
+        has_extension_sources = any(splitext(name)[1].lower() in EXTENSION_SOURCE_EXTENSIONS
+                                    for name in self.getnames())
+        setup_py = self._read(join(root, 'setup.py'))
+        setup_cfg = self._read(join(root, 'setup.cfg'))
+        pyproject = self._read(join(root, 'pyproject.toml'))
+        if setup_py is None:
+            backend = BUILD_BACKEND_RE.search(pyproject or '')
+            if backend and backend.group(1) in PUREPY_BUILD_BACKENDS and not has_extension_sources:
+                return PUREPY
+            return None
+        builds_extensions = EXTENSION_SETUP_RE.search(setup_py) is not None
+        if has_extension_sources and builds_extensions:
+            return C_EXTENSION
+        if has_extension_sources or builds_extensions:
+            # e.g. C sources shipped as data, or extensions defined in another module
+            return None
+        if SETUP_WHEEL_OPTIONS_RE.search(setup_py) or SETUP_PLATFORM_RE.search(setup_py):
+            return None
+        return UNIVERSAL if _setup_cfg_universal(setup_cfg) else PUREPY
+
+    def setup_info(self):
+        with TemporaryDirectory(prefix='starforge_sdist_setup_info_') as td:
             debug("Extracting '%s' to '%s'", self._arcfile, td)
             self.extractall(td)
             root = join(td, self.root)
-            return wheel_type(root)
+            return setup_info(root)
+
+
+def _setup_cfg_universal(setup_cfg):
+    if not setup_cfg:
+        return False
+    cp = ConfigParser()
+    try:
+        if hasattr(cp, 'read_string'):
+            cp.read_string(setup_cfg)
+        else:
+            from StringIO import StringIO
+            cp.readfp(StringIO(setup_cfg))
+        # this isn't documented but works, and PasteDeploy uses it
+        for section in ('bdist_wheel', 'wheel'):
+            if cp.has_option(section, 'universal'):
+                return asbool(cp.get(section, 'universal'))
+    except (ConfigParserError, ValueError) as exc:
+        debug('Unable to parse setup.cfg: %s', exc)
+    return False
@@ -0,0 +1,49 @@
+""" Introspect a setup script in a single run of the interpreter.
+
+Run as `python -m starforge.packaging.setup_info OUTPUT` in the directory containing setup.py, writes JSON to OUTPUT.
+"""
+from __future__ import absolute_import
+
+import json
+import sys
+
+# setuptools must be imported first so that the Distribution is setuptools', even if the setup script uses distutils
+import setuptools
+from distutils.core import run_setup
+
+from .distutils_commands import get_wheel_info
+
+
+def setup_info(script='setup.py'):
+    """ Return the wheel info (see the `wheel_info` command) of the setup script `script`, and whether the script
+    itself uses setuptools, without running any of its commands.
+    """
+    calls = []
+    _setup = setuptools.setup
+
+    def setup(**attrs):
+        calls.append(True)
+        return _setup(**attrs)
+
+    setuptools.setup = setup
+    try:
+        # parse setup.cfg (e.g. `[bdist_wheel] universal`), but not the command line
+        dist = run_setup(script, script_args=[], stop_after='config')
+    finally:
+        setuptools.setup = _setup
+    bdist_wheel = dist.get_command_obj('bdist_wheel')
+    bdist_wheel.ensure_finalized()
+    info = get_wheel_info(bdist_wheel)
+    info['setuptools'] = bool(calls)
+    return info
+
+
+def main():
+    output = sys.argv[1]
+    info = setup_info()
+    with open(output, 'w') as fh:
+        json.dump(info, fh)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+"""
+Remote cache backends, for sharing cached sources and build products between build hosts
+"""
+from __future__ import absolute_import
+
+import hashlib
+import io
+import json
+import tempfile
+from abc import ABCMeta, abstractmethod
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from os import fdopen, makedirs, rename, unlink
+from os.path import exists, dirname, join
+
+import requests
+from requests.adapters import HTTPAdapter
+from six import with_metaclass
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+from .download import CHUNK_SIZE, DEFAULT_JOBS, DEFAULT_TIMEOUT
+from .io import debug
+
+
+class RemoteCacheError(Exception):
+    pass
+
+
+class RemoteCache(with_metaclass(ABCMeta, object)):
+    """ A flat key/value object store shared by multiple build hosts.
+
+    Blobs are stored by digest under `blobs/sha256/`. Refs are small JSON documents under `refs/<kind>/` that map a
+    source or build (e.g. `pip`, `name==version`) to the filenames and digests of its files, and are written after the
+    blobs they refer to, so a ref that can be read always refers to complete blobs.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.jobs = config.get('jobs', DEFAULT_JOBS)
+        self.readonly = config.get('readonly', False)
+
+    @abstractmethod
+    def get(self, key):
+        """ Return an iterator over the contents of `key` in chunks, or None if `key` does not exist.
+        """
+
+    @abstractmethod
+    def put(self, key, handle):
+        """ Store the contents of the open file `handle` as `key`.
+        """
+
+    @abstractmethod
+    def exists(self, key):
+        """
+        """
+
+    def blob_key(self, digest):
+        return 'blobs/sha256/%s/%s' % (digest[:2], digest)
+
+    def ref_key(self, kind, name):
+        return 'refs/%s/%s.json' % (kind, hashlib.sha256(name.encode('utf-8')).hexdigest())
+
+    def get_blob(self, digest):
+        return self.get(self.blob_key(digest))
+
+    def put_blob(self, digest, path):
+        """ Upload the file at `path` as blob `digest` unless the remote already has it.
+        """
+        key = self.blob_key(digest)
+        if self.exists(key):
+            debug('Blob already in remote cache: %s', digest)
+            return False
+        with open(path, 'rb') as handle:
+            self.put(key, handle)
+        debug('Uploaded blob to remote cache: %s', digest)
+        return True
+
+    def get_ref(self, kind, name):
+        """ Return the ref `name` of `kind` as a dict of filename to digest, or None if the remote does not have it.
+        """
+        chunks = self.get(self.ref_key(kind, name))
+        if chunks is None:
+            return None
+        try:
+            return json.loads(b''.join(chunks).decode('utf-8'))['files']
+        except (ValueError, KeyError) as exc:
+            raise RemoteCacheError('Invalid remote cache ref %s %s: %s' % (kind, name, exc))
+
+    def put_ref(self, kind, name, files):
+        ref = json.dumps({'kind': kind, 'name': name, 'files': files}, sort_keys=True)
+        self.put(self.ref_key(kind, name), io.BytesIO(ref.encode('utf-8')))
+
+    def map(self, func, items):
+        """ Apply `func` to `items` in a pool of `jobs` threads and return the results in order.
+        """
+        items = list(items)
+        if len(items) < 2 or self.jobs < 2:
+            return [func(item) for item in items]
+        pool = ThreadPool(min(self.jobs, len(items)))
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class DirectoryRemoteCache(RemoteCache):
+    """ Remote cache in a (typically network mounted) directory.
+    """
+    def __init__(self, config):
+        super(DirectoryRemoteCache, self).__init__(config)
+        self.path = config['path']
+
+    def _path(self, key):
+        return join(self.path, *key.split('/'))
+
+    def get(self, key):
+        try:
+            handle = open(self._path(key), 'rb')
+        except (OSError, IOError):
+            return None
+        return self._iter(handle)
+
+    def _iter(self, handle):
+        with handle:
+            for chunk in iter(partial(handle.read, CHUNK_SIZE), b''):
+                yield chunk
+
+    def put(self, key, handle):
+        path = self._path(key)
+        if not exists(dirname(path)):
+            try:
+                makedirs(dirname(path))
+            except OSError:
+                if not exists(dirname(path)):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dirname(path), suffix='.tmp')
+        try:
+            with fdopen(fd, 'wb') as out:
+                for chunk in iter(partial(handle.read, CHUNK_SIZE), b''):
+                    out.write(chunk)
+            rename(tmp, path)
+        finally:
+            if exists(tmp):
+                unlink(tmp)
+
+    def exists(self, key):
+        return exists(self._path(key))
+
+
+class HttpRemoteCache(RemoteCache):
+    """ Remote cache on an HTTP server that supports GET and PUT, e.g. nginx with WebDAV enabled.
+
+    Uploads are streamed from disk, downloads are streamed in chunks.
+    """
+    def __init__(self, config):
+        super(HttpRemoteCache, self).__init__(config)
+        self.url = config['url'].rstrip('/') + '/'
+        self.timeout = config.get('timeout', DEFAULT_TIMEOUT)
+        self.session = requests.Session()
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=self.jobs))
+        self.session.headers.update(config.get('headers', {}))
+        if 'username' in config:
+            self.session.auth = (config['username'], config.get('password', ''))
+
+    def get(self, key):
+        r = self.session.get(self.url + key, stream=True, timeout=self.timeout)
+        if r.status_code == 404:
+            r.close()
+            return None
+        r.raise_for_status()
+        return self._iter(r)
+
+    def _iter(self, r):
+        try:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                yield chunk
+        finally:
+            r.close()
+
+    def put(self, key, handle):
+        r = self.session.put(self.url + key, data=handle, timeout=self.timeout)
+        r.raise_for_status()
+
+    def exists(self, key):
+        r = self.session.head(self.url + key, timeout=self.timeout)
+        if r.status_code == 404:
+            return False
+        r.raise_for_status()
+        return True
+
+
+class S3RemoteCache(RemoteCache):
+    """ Remote cache in an S3 (or S3-compatible, e.g. minio) bucket. Requires boto3.
+
+    Credentials are read from the usual boto3 sources (environment, `~/.aws`), or the optional `profile`.
+    """
+    def __init__(self, config):
+        super(S3RemoteCache, self).__init__(config)
+        if boto3 is None:
+            raise RemoteCacheError('The s3 remote cache requires boto3, install it with `pip install starforge[s3]`')
+        self.bucket = config['bucket']
+        self.prefix = config.get('prefix', '').strip('/')
+        session = boto3.session.Session(profile_name=config.get('profile'))
+        self.client = session.client('s3', endpoint_url=config.get('endpoint_url'))
+
+    def _key(self, key):
+        return self.prefix + '/' + key if self.prefix else key
+
+    def get(self, key):
+        try:
+            r = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return r['Body'].iter_chunks(CHUNK_SIZE)
+
+    def put(self, key, handle):
+        # upload_fileobj uses concurrent multipart uploads for large files
+        self.client.upload_fileobj(handle, self.bucket, self._key(key))
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as exc:
+            if exc.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+        return True
+
+
+REMOTE_CACHE_TYPES = {
+    'directory': DirectoryRemoteCache,
+    'http': HttpRemoteCache,
+    's3': S3RemoteCache,
+}
+
+
+def remote_cache(config):
+    """ Return the remote cache described by the `remote_cache` section of the Starforge config, or None if unset.
+    """
+    if not config:
+        return None
+    try:
+        return REMOTE_CACHE_TYPES[config.get('type', 'http')](config)
+    except KeyError as exc:
+        raise RemoteCacheError('Invalid remote cache config, missing or unknown: %s' % exc)
@@ -0,0 +1,102 @@
+"""
+Run jobs that depend on each other in a pool of worker threads
+"""
+from __future__ import absolute_import
+
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from .io import error
+
+
+class CycleError(Exception):
+    pass
+
+
+def toposort(deps):
+    """ Return the jobs in `deps`, a dict of job to the set of jobs it depends on, with every job after its dependencies.
+
+    Dependencies that are not themselves keys of `deps` are ignored. Raises CycleError if there is a dependency cycle.
+    """
+    order = []
+    state = {}
+
+    def visit(job, path):
+        if state.get(job) == 'done':
+            return
+        if state.get(job) == 'visiting':
+            raise CycleError('Dependency cycle: %s' % ' -> '.join(str(j) for j in path + [job]))
+        state[job] = 'visiting'
+        for dep in sorted(deps[job], key=str):
+            if dep in deps:
+                visit(dep, path + [job])
+        state[job] = 'done'
+        order.append(job)
+
+    for job in deps:
+        visit(job, [])
+    return order
+
+
+class Scheduler(object):
+    """ Run a function on each of a set of jobs, up to `jobs` at a time, starting each job as soon as all of the jobs it
+    depends on have succeeded.
+
+    Jobs whose dependencies failed (or were skipped) are skipped. If `stop_on_failure` is set, no jobs are started after
+    the first failure.
+    """
+    def __init__(self, jobs=1, stop_on_failure=False):
+        self.jobs = jobs
+        self.stop_on_failure = stop_on_failure
+        self.cond = threading.Condition()
+        self.results = OrderedDict()
+        self.running = 0
+        self.failed = False
+
+    def _run_job(self, func, job):
+        try:
+            result = bool(func(job))
+        except Exception:
+            error('Caught exception running job: %s', job, exception=True)
+            result = False
+        with self.cond:
+            self.results[job] = result
+            self.running -= 1
+            self.failed = self.failed or not result
+            self.cond.notify()
+
+    def run(self, func, deps):
+        """ Run `func(job)` for each job in `deps`, a dict of job to the set of jobs it depends on. `func` returns True if
+        the job succeeded.
+
+        Returns an OrderedDict of job to result, in order of completion: True (succeeded), False (failed) or None
+        (skipped).
+        """
+        deps = OrderedDict((job, set(d for d in job_deps if d in deps)) for job, job_deps in deps.items())
+        pending = OrderedDict((job, None) for job in toposort(deps))
+        pool = ThreadPool(max(1, min(self.jobs, len(deps))))
+        try:
+            with self.cond:
+                while len(self.results) < len(deps):
+                    ready = []
+                    for job in list(pending):
+                        dep_results = [self.results.get(dep, 'pending') for dep in deps[job]]
+                        if (self.failed and self.stop_on_failure) or any(r in (False, None) for r in dep_results):
+                            del pending[job]
+                            self.results[job] = None
+                        elif all(r is True for r in dep_results):
+                            ready.append(job)
+                    for job in ready:
+                        del pending[job]
+                        self.running += 1
+                        pool.apply_async(self._run_job, (func, job))
+                    if len(self.results) < len(deps):
+                        self.cond.wait()
+        finally:
+            pool.close()
+            pool.join()
+        return self.results
@@ -0,0 +1,107 @@
+"""
+Record the time spent in each phase of a build as Chrome trace event JSON (viewable in chrome://tracing or Perfetto)
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from itertools import count
+
+
+# merged traces (e.g. from guests, whose pids are in another namespace) are given pids from here up
+MERGED_PID_START = 1000000
+
+
+class Tracer(object):
+    """ Collects complete ("X") events for spans in all threads of this process.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.merged_pids = count(MERGED_PID_START)
+
+    def _thread_event(self, pid, tid):
+        if tid in self.threads:
+            return []
+        self.threads.add(tid)
+        return [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                 'args': {'name': threading.current_thread().name}}]
+
+    @contextmanager
+    def span(self, name, cat='build', **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            pid = os.getpid()
+            tid = threading.current_thread().ident
+            event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                     'pid': pid, 'tid': tid, 'args': dict((k, str(v)) for k, v in args.items())}
+            with self.lock:
+                self.events.extend(self._thread_event(pid, tid))
+                self.events.append(event)
+
+    def merge(self, path, process_name):
+        """ Add the events from the trace at `path` (e.g. written by a guest) as separate processes named
+        `process_name`, or prefixed with it if the trace names them (e.g. traces that have merged guest traces).
+        """
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        with self.lock:
+            pids = {}
+            names = {}
+            for event in events:
+                if event['pid'] not in pids:
+                    pids[event['pid']] = next(self.merged_pids)
+                if event.get('ph') == 'M' and event.get('name') == 'process_name':
+                    names[event['pid']] = event['args']['name']
+                    continue
+                event['pid'] = pids[event['pid']]
+                self.events.append(event)
+            for pid, merged_pid in sorted(pids.items()):
+                name = '%s: %s' % (process_name, names[pid]) if pid in names else process_name
+                self.events.append({'name': 'process_name', 'ph': 'M', 'pid': merged_pid, 'args': {'name': name}})
+
+    def save(self, path, process_name=None):
+        with self.lock:
+            events = list(self.events)
+        if process_name is not None:
+            events.insert(0, {'name': 'process_name', 'ph': 'M', 'pid': os.getpid(), 'args': {'name': process_name}})
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        os.rename(tmp, path)
+
+
+TRACER = Tracer()
+
+
+def enable():
+    TRACER.enabled = True
+
+
+def enabled():
+    return TRACER.enabled
+
+
+def span(name, cat='build', **args):
+    """ Context manager that records the time spent in its body as span `name`, if tracing is enabled.
+    """
+    return TRACER.span(name, cat=cat, **args)
+
+
+def merge(path, process_name):
+    TRACER.merge(path, process_name)
+
+
+def save(path, process_name='starforge'):
+    TRACER.save(path, process_name=process_name)
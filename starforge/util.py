@@ -3,10 +3,15 @@ Utility things
 """
 from __future__ import absolute_import
 
+import errno
 import os
+import re
 import shlex
+import stat
 import tarfile
+import time
 import zipfile
+from contextlib import contextmanager
 from os import pardir
 from os.path import (
     abspath,
@@ -16,8 +21,14 @@ from os.path import (
     join,
     normpath
 )
+from shutil import copy2, copyfileobj, copystat
 from subprocess import check_call
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     import lzma
 except ImportError:
@@ -39,6 +50,14 @@ from six.moves import shlex_quote
 
 from .io import debug
 
+GALAXY_INDEX_URL = 'https://wheels.galaxyproject.org/simple/'
+PYPI_INDEX_URL = 'https://pypi.python.org/simple/'
+# from linux/fs.h, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# errnos indicating that a hardlink or reflink is not possible between two paths, as opposed to a real failure
+LINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                           errno.EACCES)
+COPY_BUFFER_SIZE = 1024 * 1024
 UNSUPPORTED_ARCHIVE_MESSAGE = "Missing support for '{arctype}' archives, use `pip install starforge[{extra}]` to install"
 
 
@@ -77,6 +96,85 @@ def xdg_cache_dir():
     return abspath(join(cache_home, 'galaxy-starforge'))
 
 
+def image_cache_path(cache_path, kind, image):
+    """ Return the directory for per-image cache `kind` (e.g. `ccache`) of `image` in the cache at `cache_path`.
+    """
+    return join(cache_path, kind, re.sub(r'[^A-Za-z0-9_.-]', '_', image))
+
+
+def reflink(src, dst):
+    """ Create `dst` as a copy-on-write clone of `src` if the filesystem supports it (e.g. btrfs, XFS).
+
+    Returns True on success, False (with `dst` not created) if cloning is unsupported.
+    """
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as sfh:
+        try:
+            with open(dst, 'wb') as dfh:
+                fcntl.ioctl(dfh.fileno(), FICLONE, sfh.fileno())
+        except (IOError, OSError) as exc:
+            if exc.errno not in LINK_UNSUPPORTED_ERRNOS:
+                raise
+            os.unlink(dst)
+            return False
+    return True
+
+
+def link_or_copy(src, dst):
+    """ Place `src` at `dst` as cheaply as possible: hardlink, then reflink, then copy.
+
+    Returns the method used, one of 'link', 'reflink' or 'copy'.
+    """
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError as exc:
+        if exc.errno not in LINK_UNSUPPORTED_ERRNOS:
+            raise
+    if reflink(src, dst):
+        return 'reflink'
+    copy2(src, dst)
+    return 'copy'
+
+
+def clone_or_copy(src, dst):
+    """ Place a writable copy of `src` at `dst`: reflink, then copy. Returns 'reflink' or 'copy'.
+    """
+    if reflink(src, dst):
+        copystat(src, dst)
+        return 'reflink'
+    copy2(src, dst)
+    return 'copy'
+
+
+def checkout_tree(src, dst):
+    """ Recreate the directory tree `src` at `dst` without reading through the files in it where possible.
+
+    Files are reflinked (or copied, if reflinking is not possible, e.g. across filesystems), so the checkout can be
+    freely modified without affecting `src`. Returns a dict of method to count of files placed with it.
+    """
+    methods = {}
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        dest_root = normpath(join(dst, rel))
+        makedirs_exist_ok(dest_root)
+        for name in dirs + files:
+            path = join(root, name)
+            dest = join(dest_root, name)
+            if (name in files or os.path.islink(path)) and os.path.lexists(dest):
+                os.unlink(dest)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), dest)
+                method = 'symlink'
+            elif name in files:
+                method = clone_or_copy(path, dest)
+            else:
+                continue
+            methods[method] = methods.get(method, 0) + 1
+    return methods
+
+
 def py_to_pip(py):
     if dirname(py):
         return join(dirname(py), 'pip')
@@ -84,14 +182,39 @@ def py_to_pip(py):
         return 'pip'
 
 
-def pip_install(pip='pip', args=None, packages=None, executor=check_call, add_galaxy_index=True, **kwargs):
+def pip_install(pip='pip', args=None, packages=None, executor=check_call, add_galaxy_index=True, index=None, **kwargs):
+    """ Install `packages` with `pip`.
+
+    `index` is the `index` section of the Starforge config. If it sets a `url` (e.g. of `starforge index serve`), that
+    index is used first, with the Galaxy and PyPI indexes as extra indexes unless `exclusive` is set.
+    """
+    return _pip('install', pip=pip, args=args, packages=packages, executor=executor, add_galaxy_index=add_galaxy_index,
+                index=index, **kwargs)
+
+
+def pip_download(dest, pip='pip', args=None, packages=None, executor=check_call, add_galaxy_index=True, index=None,
+                 **kwargs):
+    """ Download `packages` (and their dependencies) with `pip` to directory `dest`. Distributions already in `dest`
+    are not downloaded again.
+    """
+    args = ['--dest', dest] + (shlex.split(args) if isinstance(args, string_types) else list(args or []))
+    return _pip('download', pip=pip, args=args, packages=packages, executor=executor,
+                add_galaxy_index=add_galaxy_index, index=index, **kwargs)
+
+
+def _pip(command, pip='pip', args=None, packages=None, executor=check_call, add_galaxy_index=True, index=None,
+         **kwargs):
     args = args or []
     packages = packages or []
-    cmd = [pip, 'install']
+    index = index or {}
+    cmd = [pip, command]
     if add_galaxy_index and '--index-url' not in args:
-        cmd.extend(shlex.split(
-            '--index-url https://wheels.galaxyproject.org/simple/ --extra-index-url https://pypi.python.org/simple/'
-        ))
+        if index.get('url'):
+            cmd.extend(['--index-url', index['url']])
+            if not index.get('exclusive', False):
+                cmd.extend(['--extra-index-url', GALAXY_INDEX_URL, '--extra-index-url', PYPI_INDEX_URL])
+        else:
+            cmd.extend(['--index-url', GALAXY_INDEX_URL, '--extra-index-url', PYPI_INDEX_URL])
     if not isinstance(args, list):
         args = shlex.split(args)
     cmd.extend(args)
@@ -101,6 +224,20 @@ def pip_install(pip='pip', args=None, packages=None, executor=check_call, add_ga
     return executor(cmd, **kwargs)
 
 
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """ Convert a size like `500M` or `20G` (or an integer number of bytes) to bytes.
+    """
+    if size is None or isinstance(size, int):
+        return size
+    size = str(size).strip().lower().rstrip('b')
+    if size and size[-1] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
 # asbool implementation pulled from PasteDeploy
 truthy = frozenset(['true', 'yes', 'on', 'y', 't', '1'])
 falsy = frozenset(['false', 'no', 'off', 'n', 'f', '0'])
@@ -170,11 +307,68 @@ class Archive(object):
     def extract(self):
         return self.arc.extract
 
-    def extractall(self, path):
-        for name in self.getnames():
-            debug(name)
-            assert safe_relpath(name), "%s: path is outside its root: %s" % (self._arcfile, name)
-            self.extract(name, path)
+    def extractall(self, path, buffer_size=COPY_BUFFER_SIZE):
+        """ Extract all members to directory `path` in a single pass over the archive, preserving file modes.
+
+        Member paths are checked with `safe_relpath` as they are reached, and file contents are copied in
+        `buffer_size` chunks.
+        """
+        if self.arctype == 'tar':
+            self._extractall_tar(path, buffer_size)
+        elif self.arctype == 'zip':
+            self._extractall_zip(path, buffer_size)
+
+    def _extract_dest(self, path, name):
+        debug(name)
+        assert safe_relpath(name), "%s: path is outside its root: %s" % (self._arcfile, name)
+        return join(path, name)
+
+    def _extract_fileobj(self, src, dest, mode, mtime, buffer_size):
+        makedirs_exist_ok(dirname(dest))
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        with open(dest, 'wb') as out:
+            copyfileobj(src, out, buffer_size)
+        if mode:
+            os.chmod(dest, mode)
+        if mtime is not None:
+            os.utime(dest, (mtime, mtime))
+
+    def _extractall_tar(self, path, buffer_size):
+        # iterating the TarFile reads each member header once, unlike getnames() + extract(name), which looks each
+        # member up by name
+        for member in self.arc:
+            dest = self._extract_dest(path, member.name)
+            if member.isdir():
+                makedirs_exist_ok(dest)
+            elif member.isreg():
+                src = self.arc.extractfile(member)
+                try:
+                    self._extract_fileobj(src, dest, member.mode & 0o7777, member.mtime, buffer_size)
+                finally:
+                    src.close()
+            else:
+                # links and special files, passing the TarInfo avoids the lookup by name
+                if member.issym() or member.islnk():
+                    target = member.linkname if member.islnk() else join(dirname(member.name), member.linkname)
+                    assert safe_relpath(target), "%s: link target is outside its root: %s -> %s" % (
+                        self._arcfile, member.name, member.linkname)
+                self.arc.extract(member, path)
+
+    def _extractall_zip(self, path, buffer_size):
+        for info in self.arc.infolist():
+            dest = self._extract_dest(path, info.filename)
+            if info.filename.endswith('/'):
+                makedirs_exist_ok(dest)
+                continue
+            mode = info.external_attr >> 16
+            src = self.arc.open(info)
+            try:
+                # zips created on non-Unix systems carry no mode
+                self._extract_fileobj(src, dest, mode & 0o7777 if stat.S_ISREG(mode) else 0,
+                                      time.mktime(info.date_time + (0, 0, -1)), buffer_size)
+            finally:
+                src.close()
 
     @property
     def universal(self):
@@ -217,6 +411,24 @@ class UnsupportedArchiveType(Exception):
     pass
 
 
+def makedirs_exist_ok(path):
+    try:
+        os.makedirs(path)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+@contextmanager
+def locked_file(path):
+    """ Hold an exclusive lock on `path` (created if it does not exist) for the duration of the context.
+    """
+    with open(path, 'a') as handle:
+        if fcntl is not None:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        yield
+
+
 def safe_relpath(path):
     return not (isabs(path) or normpath(path).startswith(pardir))
 
@@ -0,0 +1,83 @@
+""" Fixtures for the Starforge tests
+"""
+from __future__ import absolute_import
+
+import hashlib
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+
+class FileServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ HTTP server on a free local port serving (and accepting PUTs to) the in-memory `files`, a dict of path to
+    contents. Every request is recorded in `requests` as (method, path, headers with lowercase names). If
+    `misread_range` is set, Range requests get the whole file in a 206 response, as from a broken server.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FileRequestHandler)
+        self.files = {}
+        self.requests = []
+        self.misread_range = False
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def etag(self, path):
+        return '"%s"' % hashlib.sha256(self.files[path]).hexdigest()[:16]
+
+
+class FileRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Supports Range requests, and If-Range with the ETag of the current contents.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def _record(self):
+        headers = dict((k.lower(), v) for k, v in self.headers.items())
+        self.server.requests.append((self.command, self.path, headers))
+
+    def _respond(self, status, headers=None, body=b''):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self._record()
+        data = self.server.files.get(self.path)
+        if data is None:
+            return self._respond(404)
+        etag = self.server.etag(self.path)
+        range_ = self.headers.get('Range')
+        if range_ is None or self.headers.get('If-Range', etag) != etag:
+            return self._respond(200, {'ETag': etag}, data)
+        start = 0 if self.server.misread_range else int(range_.split('=', 1)[1].rstrip('-'))
+        if start >= len(data):
+            return self._respond(416, {'Content-Range': 'bytes */%d' % len(data)})
+        self._respond(206, {'ETag': etag, 'Content-Range': 'bytes %d-%d/%d' % (start, len(data) - 1, len(data))},
+                      data[start:])
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        self._record()
+        self.server.files[self.path] = self.rfile.read(int(self.headers['Content-Length']))
+        self._respond(201)
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,22 @@
+""" Tests for starforge.cache
+"""
+from __future__ import absolute_import
+
+import time
+
+from starforge.cache import CacheDatabase, ProbeStore
+
+
+def test_probe_prune_by_last_use(tmpdir):
+    db = CacheDatabase(str(tmpdir))
+    store = ProbeStore(db)
+    store.set('platform', 'used', 'linux_x86_64')
+    store.set('platform', 'unused', 'linux_i686')
+    with db.transaction() as cursor:
+        cursor.execute('UPDATE probes SET updated = ?', (time.time() - 3600,))
+    # a later process uses one of them
+    assert ProbeStore(db).get('platform', 'used') == 'linux_x86_64'
+    store = ProbeStore(db)
+    assert store.prune(time.time() - 60) == 1
+    assert store.get('platform', 'used') == 'linux_x86_64'
+    assert store.get('platform', 'unused') is None
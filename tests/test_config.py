@@ -0,0 +1,22 @@
+""" Tests for starforge.config
+"""
+from __future__ import absolute_import
+
+import yaml
+
+from starforge.config import ConfigManager
+
+
+def test_dump_config_omits_remote_cache(tmpdir):
+    config_file = tmpdir.join('config.yml')
+    config_file.write(yaml.dump({
+        'cache_path': str(tmpdir.join('cache')),
+        'remote_cache': {'url': 'http://cache.example.org/', 'username': 'starforge', 'password': 'secret'},
+    }))
+    config = ConfigManager.open(str(config_file))
+    assert config.remote_cache['password'] == 'secret'
+    dumped = config.dump_config()
+    assert 'remote_cache' not in dumped
+    assert 'secret' not in yaml.dump(dumped)
+    assert dumped['cache_path'] == str(tmpdir.join('cache'))
+    assert 'images' in dumped
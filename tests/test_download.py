@@ -0,0 +1,181 @@
+""" Tests for starforge.download, against a local HTTP server
+"""
+from __future__ import absolute_import
+
+import fcntl
+import hashlib
+import json
+import threading
+from os import makedirs, rename
+from os.path import exists
+
+import pytest
+
+from starforge.cache import CacheManager, DigestMismatch
+from starforge.download import Downloader
+
+
+# several chunks of the downloader under test
+DATA = b''.join(b'%05d\n' % i for i in range(1000))
+CHUNK_SIZE = 1024
+
+
+def _downloader(tmpdir):
+    return Downloader(str(tmpdir.join('partial')), chunk_size=CHUNK_SIZE)
+
+
+def _write_partial(downloader, url, data, etag=None):
+    """ Leave a partial download of `url` as an interrupted fetch would.
+    """
+    if not exists(downloader.partial_path):
+        makedirs(downloader.partial_path)
+    with open(downloader.partial(url), 'wb') as handle:
+        handle.write(data)
+    if etag is not None:
+        with open(downloader.partial(url) + '.json', 'w') as handle:
+            json.dump({'etag': etag, 'last_modified': None}, handle)
+
+
+def _check_result(result, data):
+    assert result.digest == hashlib.sha256(data).hexdigest()
+    assert result.size == len(data)
+    with open(result.path, 'rb') as handle:
+        assert handle.read() == data
+    assert not exists(result.path + '.json')
+
+
+def test_fetch(file_server, tmpdir):
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    result = _downloader(tmpdir).fetch(url)
+    _check_result(result, DATA)
+    assert result.url == url
+    assert 'range' not in file_server.requests[-1][2]
+
+
+def test_fetch_missing(file_server, tmpdir):
+    with pytest.raises(Exception):
+        _downloader(tmpdir).fetch(file_server.url + '/missing.tar.gz')
+
+
+def test_resume(file_server, tmpdir):
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    downloader = _downloader(tmpdir)
+    _write_partial(downloader, url, DATA[:2500], etag=file_server.etag('/foo-1.0.tar.gz'))
+    result = downloader.fetch(url)
+    _check_result(result, DATA)
+    headers = file_server.requests[-1][2]
+    assert headers['range'] == 'bytes=2500-'
+    assert headers['if-range'] == file_server.etag('/foo-1.0.tar.gz')
+    assert len(file_server.requests) == 1
+
+
+def test_resume_without_validator(file_server, tmpdir):
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    downloader = _downloader(tmpdir)
+    _write_partial(downloader, url, DATA[:100])
+    _check_result(downloader.fetch(url), DATA)
+    headers = file_server.requests[-1][2]
+    assert headers['range'] == 'bytes=100-'
+    assert 'if-range' not in headers
+
+
+def test_if_range_mismatch_restarts(file_server, tmpdir):
+    """ The file changed on the server since the partial download, so the server ignores the Range.
+    """
+    old = b'old contents of the file ' * 100
+    file_server.files['/foo-1.0.tar.gz'] = old
+    old_etag = file_server.etag('/foo-1.0.tar.gz')
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    downloader = _downloader(tmpdir)
+    _write_partial(downloader, url, old[:1000], etag=old_etag)
+    _check_result(downloader.fetch(url), DATA)
+    assert file_server.requests[-1][2]['if-range'] == old_etag
+    assert len(file_server.requests) == 1
+
+
+def test_unsatisfiable_range_restarts(file_server, tmpdir):
+    """ The partial file is longer than the file on the server (e.g. it was replaced by a smaller one).
+    """
+    file_server.files['/foo-1.0.tar.gz'] = DATA[:500]
+    url = file_server.url + '/foo-1.0.tar.gz'
+    downloader = _downloader(tmpdir)
+    _write_partial(downloader, url, DATA)
+    _check_result(downloader.fetch(url), DATA[:500])
+    assert [r[2].get('range') for r in file_server.requests] == ['bytes=%d-' % len(DATA), None]
+
+
+def test_content_range_mismatch_restarts(file_server, tmpdir):
+    """ The server answers a resumed download with a range that does not start at the requested offset.
+    """
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    file_server.misread_range = True
+    url = file_server.url + '/foo-1.0.tar.gz'
+    downloader = _downloader(tmpdir)
+    _write_partial(downloader, url, DATA[:2500], etag=file_server.etag('/foo-1.0.tar.gz'))
+    _check_result(downloader.fetch(url), DATA)
+    assert [r[2].get('range') for r in file_server.requests] == ['bytes=2500-', None]
+
+
+def test_cached_while_waiting(file_server, tmpdir):
+    """ Another process completes the download while this one waits for the lock on the partial file.
+    """
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    downloader = _downloader(tmpdir)
+    _write_partial(downloader, url, DATA[:2500])
+    done = str(tmpdir.join('done'))
+    results = []
+    with open(downloader.partial(url), 'ab') as handle:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        waiter = threading.Thread(target=lambda: results.append(downloader.fetch(url, cached=lambda: exists(done))))
+        waiter.start()
+        handle.write(DATA[2500:])
+        handle.flush()
+        rename(downloader.partial(url), done)
+    waiter.join()
+    assert results == [None]
+    assert file_server.requests == []
+    assert not exists(downloader.partial(url))
+
+
+def test_complete_failure_discards_partial(file_server, tmpdir):
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    downloader = _downloader(tmpdir)
+
+    def complete(result):
+        raise ValueError('rejected')
+
+    with pytest.raises(ValueError):
+        downloader.fetch(url, complete=complete)
+    assert not exists(downloader.partial(url))
+
+
+def test_map(file_server, tmpdir):
+    urls = []
+    for i in range(5):
+        file_server.files['/f%d.tar.gz' % i] = DATA[i:]
+        urls.append(file_server.url + '/f%d.tar.gz' % i)
+    downloader = _downloader(tmpdir)
+    results = downloader.map(lambda url: downloader.fetch(url, complete=lambda r: None), urls)
+    assert [r.digest for r in results] == [hashlib.sha256(DATA[i:]).hexdigest() for i in range(5)]
+
+
+def test_url_cache_digest_mismatch(file_server, tmpdir):
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    cache_manager = CacheManager(str(tmpdir.join('cache')))
+    with pytest.raises(DigestMismatch):
+        cache_manager.url_cache(url, sha256='0' * 64)
+    # nothing is stored, and the rejected download is not resumed from
+    assert cache_manager.blobs.blobs() == []
+    assert cache_manager.url_check(url) is None
+    assert not exists(cache_manager.downloader.partial(url))
+    path = cache_manager.url_cache(url, sha256=hashlib.sha256(DATA).hexdigest())
+    with open(path, 'rb') as handle:
+        assert handle.read() == DATA
+    assert file_server.requests[-1][2].get('range') is None
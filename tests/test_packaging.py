@@ -0,0 +1,67 @@
+""" Tests for starforge.packaging
+"""
+from __future__ import absolute_import
+
+import io
+import tarfile
+
+import pytest
+
+from starforge.packaging.setup import C_EXTENSION, PUREPY, UNIVERSAL, PythonSdist, setup_info_key
+
+
+DIGEST = '0' * 64
+
+
+def test_setup_info_key_host_matches_unconfigured_build():
+    # the host introspects sdists without build config, as a build on a local image without any does
+    assert setup_info_key(DIGEST) == setup_info_key(DIGEST, image=None, prebuild=None, buildenv={}, setup_requires=[],
+                                                    dependencies=[])
+
+
+def test_setup_info_key_varies():
+    key = setup_info_key(DIGEST)
+    others = [
+        setup_info_key('1' * 64),
+        setup_info_key(DIGEST, image='starforge/manylinux1:latest'),
+        setup_info_key(DIGEST, image='starforge/manylinux1:latest@sha256:abc'),
+        setup_info_key(DIGEST, prebuild=['sed -i s/foo/bar/ setup.py', None]),
+        setup_info_key(DIGEST, buildenv={'CFLAGS': '-O3'}),
+        setup_info_key(DIGEST, setup_requires=['numpy']),
+        setup_info_key(DIGEST, dependencies=['zlib-devel']),
+    ]
+    assert len(set([key] + others)) == len(others) + 1
+
+
+def _sdist(tmpdir, files):
+    path = str(tmpdir.join('foo-1.0.tar.gz'))
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, contents in files.items():
+            contents = contents.encode('utf-8')
+            member = tarfile.TarInfo('foo-1.0/' + name)
+            member.size = len(contents)
+            tar.addfile(member, io.BytesIO(contents))
+    return PythonSdist.open(path)
+
+
+@pytest.mark.parametrize('files, wheel_type', [
+    ({'setup.py': 'from setuptools import setup\nsetup(name="foo")\n'}, PUREPY),
+    ({'setup.py': 'from setuptools import setup\nsetup(name="foo")\n', 'setup.cfg': '[bdist_wheel]\nuniversal = 1\n'},
+     UNIVERSAL),
+    ({'setup.py': 'from setuptools import setup, Extension\nsetup(ext_modules=[Extension("foo", ["foo.c"])])\n',
+      'foo.c': ''}, C_EXTENSION),
+    # C sources shipped as data, with common words that are not extension definitions
+    ({'setup.py': '# uses shared libraries\nfrom setuptools import setup\nsetup(name="foo", ext_modules=[])\n',
+      'foo/data/example.c': ''}, None),
+    ({'setup.py': 'from setuptools import setup\nsetup(name="foo", package_data={"foo": ["libraries/*"]})\n'},
+     PUREPY),
+    # platform wheels forced without extension modules
+    ({'setup.py': 'from setuptools import setup, Distribution\n'
+                  'class D(Distribution):\n    def has_ext_modules(self):\n        return True\n'
+                  'setup(name="foo", distclass=D)\n'}, None),
+    ({'setup.py': 'from setuptools import setup\nsetup(name="foo", options={"bdist_wheel": {"universal": 1}})\n'},
+     None),
+    ({'pyproject.toml': '[build-system]\nbuild-backend = "flit_core.buildapi"\n'}, PUREPY),
+])
+def test_probe_wheel_type(tmpdir, files, wheel_type):
+    assert _sdist(tmpdir, files).probe_wheel_type() == wheel_type
@@ -0,0 +1,123 @@
+""" Tests for starforge.remote, against a directory, a local HTTP server and (if configured) an S3 service like minio
+"""
+from __future__ import absolute_import
+
+import hashlib
+import io
+import json
+import os
+import uuid
+
+import pytest
+
+from starforge.cache import CacheManager
+from starforge.remote import DirectoryRemoteCache, RemoteCacheError, remote_cache
+
+
+DATA = b''.join(b'%05d\n' % i for i in range(1000))
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def _s3_config():
+    """ Set STARFORGE_TEST_S3_ENDPOINT (e.g. http://127.0.0.1:9000 for minio) and STARFORGE_TEST_S3_BUCKET, with
+    credentials in the usual AWS environment variables, to test the S3 remote cache.
+    """
+    pytest.importorskip('boto3')
+    endpoint = os.environ.get('STARFORGE_TEST_S3_ENDPOINT')
+    bucket = os.environ.get('STARFORGE_TEST_S3_BUCKET')
+    if not endpoint or not bucket:
+        pytest.skip('STARFORGE_TEST_S3_ENDPOINT and STARFORGE_TEST_S3_BUCKET are not set')
+    return {'type': 's3', 'endpoint_url': endpoint, 'bucket': bucket, 'prefix': 'starforge-test-%s' % uuid.uuid4().hex}
+
+
+@pytest.fixture(params=['directory', 'http', 's3'])
+def remote_config(request, tmpdir):
+    if request.param == 'directory':
+        return {'type': 'directory', 'path': str(tmpdir.join('remote'))}
+    elif request.param == 'http':
+        file_server = request.getfixturevalue('file_server')
+        return {'type': 'http', 'url': file_server.url + '/remote/', 'headers': {'X-Test': 'yes'}}
+    return _s3_config()
+
+
+def _read(chunks):
+    return b''.join(chunks)
+
+
+def test_get_put_exists(remote_config):
+    remote = remote_cache(remote_config)
+    assert remote.get('foo/bar') is None
+    assert not remote.exists('foo/bar')
+    remote.put('foo/bar', io.BytesIO(DATA))
+    assert remote.exists('foo/bar')
+    assert _read(remote.get('foo/bar')) == DATA
+
+
+def test_blob_and_ref(remote_config, tmpdir):
+    remote = remote_cache(remote_config)
+    path = tmpdir.join('foo-1.0.tar.gz')
+    path.write_binary(DATA)
+    assert remote.put_blob(DIGEST, str(path))
+    # already uploaded
+    assert not remote.put_blob(DIGEST, str(path))
+    assert _read(remote.get_blob(DIGEST)) == DATA
+    assert remote.get_ref('url', 'https://example.org/foo-1.0.tar.gz') is None
+    remote.put_ref('url', 'https://example.org/foo-1.0.tar.gz', {'foo-1.0.tar.gz': DIGEST})
+    assert remote.get_ref('url', 'https://example.org/foo-1.0.tar.gz') == {'foo-1.0.tar.gz': DIGEST}
+
+
+def test_invalid_ref(tmpdir):
+    remote = DirectoryRemoteCache({'path': str(tmpdir)})
+    remote.put(remote.ref_key('url', 'foo'), io.BytesIO(b'not json'))
+    with pytest.raises(RemoteCacheError):
+        remote.get_ref('url', 'foo')
+
+
+def test_invalid_config():
+    with pytest.raises(RemoteCacheError):
+        remote_cache({'type': 'ftp'})
+    with pytest.raises(RemoteCacheError):
+        remote_cache({'type': 'directory'})
+
+
+def test_http_headers(file_server):
+    remote = remote_cache({'url': file_server.url + '/remote', 'headers': {'X-Test': 'yes'}, 'username': 'u'})
+    remote.put('foo', io.BytesIO(DATA))
+    assert remote.exists('foo')
+    assert [r[:2] for r in file_server.requests] == [('PUT', '/remote/foo'), ('HEAD', '/remote/foo')]
+    for method, path, headers in file_server.requests:
+        assert headers['x-test'] == 'yes'
+        assert headers['authorization'].startswith('Basic ')
+
+
+def test_url_cache_push_pull(file_server, tmpdir):
+    remote = {'type': 'directory', 'path': str(tmpdir.join('remote'))}
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    CacheManager(str(tmpdir.join('a')), remote=remote).url_cache(url)
+    assert json.loads(tmpdir.join('remote', remote_cache(remote).ref_key('url', url)).read())['files'] == \
+        {'foo-1.0.tar.gz': DIGEST}
+    # the origin is gone, so this must come from the remote cache
+    del file_server.files['/foo-1.0.tar.gz']
+    requests = len(file_server.requests)
+    path = CacheManager(str(tmpdir.join('b')), remote=remote).url_cache(url)
+    with open(path, 'rb') as handle:
+        assert handle.read() == DATA
+    assert len(file_server.requests) == requests
+
+
+def test_url_cache_pull_digest_mismatch(file_server, tmpdir):
+    """ A corrupt blob in the remote cache is rejected, and the URL is fetched from its origin instead.
+    """
+    remote_config = {'type': 'directory', 'path': str(tmpdir.join('remote'))}
+    remote = remote_cache(remote_config)
+    file_server.files['/foo-1.0.tar.gz'] = DATA
+    url = file_server.url + '/foo-1.0.tar.gz'
+    remote.put(remote.blob_key(DIGEST), io.BytesIO(b'corrupt'))
+    remote.put_ref('url', url, {'foo-1.0.tar.gz': DIGEST})
+    cache_manager = CacheManager(str(tmpdir.join('cache')), remote=remote_config)
+    path = cache_manager.url_cache(url)
+    with open(path, 'rb') as handle:
+        assert handle.read() == DATA
+    assert [r[:2] for r in file_server.requests] == [('GET', '/foo-1.0.tar.gz')]
+    assert [digest for digest, size, atime in cache_manager.blobs.blobs()] == [DIGEST]
@@ -0,0 +1,15 @@
+""" Tests for starforge.scheduler and the job dependencies of `starforge wheels`
+"""
+from __future__ import absolute_import
+
+from starforge.commands.cmd_wheels import job_dependencies
+
+
+def test_job_dependencies_per_image():
+    graph = {'foo': set(['bar', 'six']), 'bar': set(), 'six': set()}
+    jobs = [('foo', 'linux'), ('foo', 'macos'), ('bar', 'linux'), ('bar', 'macos'), ('six', 'purepy')]
+    deps = job_dependencies(graph, jobs)
+    assert deps[('foo', 'linux')] == set([('bar', 'linux'), ('six', 'purepy')])
+    assert deps[('foo', 'macos')] == set([('bar', 'macos'), ('six', 'purepy')])
+    assert deps[('bar', 'linux')] == set()
+    assert deps[('six', 'purepy')] == set()
@@ -0,0 +1,19 @@
+""" Tests for starforge.forge.wheels
+"""
+from __future__ import absolute_import
+
+import pytest
+
+from starforge.forge.wheels import manifest_py_abi_tag
+
+
+@pytest.mark.parametrize('python, tag', [
+    ({'version': '3.6.8', 'major': 3, 'soabi': 'cpython-36m-x86_64-linux-gnu', 'maxunicode': 1114111}, 'cp36-cp36m'),
+    ({'version': '3.11.7', 'major': 3, 'soabi': 'cpython-311-x86_64-linux-gnu', 'maxunicode': 1114111}, 'cp311-cp311'),
+    ({'version': '2.7.18', 'major': 2, 'soabi': None, 'maxunicode': 1114111}, 'cp27-cp27mu'),
+    ({'version': '2.7.18', 'major': 2, 'soabi': None, 'maxunicode': 65535}, 'cp27-cp27m'),
+    ({'version': '3.6.12', 'major': 3, 'soabi': 'pypy36-pp73', 'maxunicode': 1114111}, None),
+    (None, None),
+])
+def test_manifest_py_abi_tag(python, tag):
+    assert manifest_py_abi_tag(python) == tag